@@ -8,11 +8,20 @@ import pandas as pd
 import talib
 import ccxt
 from exchange import ExchangeInterface
+from order_tracker import OrderTracker
+from exchange_cache import start_exchange_cache
 from market import datafeed
+from market import shared_candles
+from market import compaction
+from market import orderbook_recorder
 import yaml
 import time as tm
+import metrics
+import tracing
 from logics.strategies.cdl_test import CDL_Test
 from logics.strategies.backtest_optim import Backtest_Optim
+from logics.strategies.indicator_cache import start_shared_cache
+from logics.risk_management.position_ledger import Position_Ledger
 import logging
 from multiprocessing.pool import Pool
 logger = logging.getLogger(__name__)
@@ -44,41 +53,88 @@ def cdl_back_test(exchangeInterface,exchange,market_pair,interval,data_loaded,ma
 #####################
 
 
-def start_strategy_(exchange, market_pair, Backtest_Optim, params, interval):
+# one indicator cache for the lifetime of the process, shared by every strategy worker
+_indicator_cache = None
+
+
+def get_indicator_cache():
+    global _indicator_cache
+    if _indicator_cache is None:
+        _indicator_cache = start_shared_cache()
+    return _indicator_cache[1]
+
+
+def start_strategy_(exchange, market_pair, Backtest_Optim, params, interval, indicator_cache=None, trace=False):
     """
     :param Backtest_Optim: a pre-fitted Backtest_Optim object
     :param params: the best parameters
+    :param indicator_cache: optional IndicatorCache proxy shared by the strategies of the cycle
+    :param trace: record spans in this worker and return them with the signal
     :return:
     """
     lookback = params['trailing_window']
-    ohlcv_new = datafeed.get_latest_data_from_db(exchange, market_pair, interval, periods=lookback + 1)
+    with tracing.collect(trace) as worker_trace, tracing.span('strategy', strategy=Backtest_Optim.__name__):
+        # candles published by the ticker in shared memory; the database only if nothing is published
+        reader = shared_candles.get_reader(exchange, market_pair, interval)
+        if reader is not None:
+            ohlcv_new = reader.latest_candles(lookback + 1)
+        else:
+            ohlcv_new = datafeed.get_latest_data_from_db(exchange, market_pair, interval, periods=lookback + 1)
 
-    backtest_optim = Backtest_Optim()
-    strategy_signal = backtest_optim.refit(ohlcv=ohlcv_new, params=params)
+        backtest_optim = Backtest_Optim()
+        start = tm.perf_counter()
+        with tracing.span('refit'):
+            strategy_signal = backtest_optim.refit(ohlcv=ohlcv_new, params=params, indicator_cache=indicator_cache)
     print(strategy_signal)
+    if strategy_signal is not None:
+        # timed here in the pool worker, recorded by the parent that owns the metrics and the trace
+        strategy_signal = dict(strategy_signal, strategy=Backtest_Optim.__name__,
+                               refit_seconds=tm.perf_counter() - start,
+                               spans=worker_trace.spans if worker_trace is not None else None)
     return strategy_signal
 
 # FIXME; only able to use talib now
 # strategies are specified in the config file
-def start_strategy(exchange, market_pair, interval,strategies):
+@tracing.traced('start_strategy')
+def start_strategy(exchange, market_pair, interval,strategies, pool=None):
+    """
+    :param pool: optional long-lived Pool to refit in, i.e. a runner shard's; one is started for the call otherwise
+    """
     buy = []
     sell = []
 
     def log_result(result):
         # This is called whenever start_strategy_ returns a result
         # result_list is modified only by the main process, not the pool workers.
+        if result is None:
+            return
+        metrics.observe('refit_seconds', result['refit_seconds'], strategy=result['strategy'])
+        if result['spans']:
+            trace.add(result['spans'])
         buy.append(result['buy'])
         sell.append(result['sell'])
 
-    pool = Pool()
+    # log_result runs on the pool's result thread, outside of the cycle's thread local trace
+    trace = tracing.current()
+    indicator_cache = get_indicator_cache()
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool()
+    pending = []
     for key, val in strategies.items():
         Backtest_Optim = globals()[val['backtest_optim']]  # extract the strategy
         assert interval == val['interval'], "strategy is not optimized for the given interval"
         params = {'trailing_window': val['trailing_window'], 'indicator': getattr(talib, val['indicator'])}
-        pool.apply_async(start_strategy_, args=(exchange, market_pair, Backtest_Optim, params, interval),
-                         callback=log_result)
-    pool.close()
-    pool.join()
+        pending.append(pool.apply_async(start_strategy_, args=(exchange, market_pair, Backtest_Optim, params, interval,
+                                                               indicator_cache, trace is not None),
+                                        callback=log_result))
+    if own_pool:
+        pool.close()
+        pool.join()
+    else:
+        # a result is ready once its callback has run
+        for result in pending:
+            result.wait()
     return {'buy': buy, 'sell': sell}
 
 def main():
@@ -87,20 +143,24 @@ def main():
         data_loaded = yaml.load(stream)
 
     exchangeInterface = ExchangeInterface(data_loaded['exchanges'])
+    start_exchange_cache(exchangeInterface, data_loaded.get('exchange_cache'))
     exchange = list(data_loaded['exchanges'].keys())[0]
     market_pair = data_loaded['settings']['market_pairs'][0]
     interval = data_loaded['settings']['update_interval']
     strategies = data_loaded['strategies']
 
-    engine = database.engine
-    conn = engine.connect()
-
     params = cdl_back_test(exchangeInterface,exchange,market_pair,interval,data_loaded,max_periods=1000,pre_trained=True)
 
 
-    database.reset_db()
+    metrics.start_metrics(data_loaded.get('metrics'))
+    tracing.start_tracing(data_loaded.get('tracing'))
+    # positions are rebuilt from the recorded fills, so those outlive a reset
+    database.reset_db(keep=(database.TradeBook, database.Position))
+    compaction.start_compactor(data_loaded.get('compaction'))
+    orderbook_recorder.start_recorder(exchangeInterface, data_loaded.get('order_book_recorder'))
     # get historical & live data for the strategies
-    datafeed.start_ticker(exchangeInterface, exchange, market_pair, interval=interval)
+    datafeed.start_ticker(exchangeInterface, exchange, market_pair, interval=interval,
+                          derived_intervals=data_loaded['settings'].get('derived_intervals', ()))
 
     # start all the strategies
     strategy_result = start_strategy(exchange, market_pair, interval,strategies)
@@ -108,13 +168,10 @@ def main():
     ### RISK MANAGEMENT
     #####################
     # Position control
-    # let's conjure up a position book
-    fake_position_data = pd.DataFrame({
-        'exchange': 'gdax',
-        'symbol': 'BTC/USD',
-        'position': 'long',
-        'amount': 0.1,
-        'price': 3600}, index=range(1))
+    # positions are replayed from the recorded fills, then kept up to date by the order tracker
+    position_ledger = Position_Ledger()
+    position_ledger.rebuild()
+    position_data = position_ledger.snapshot()
 
     # TODO: use config file to list all the exchanges, market pair and update interval
     # that we need to pull for position control
@@ -122,10 +179,13 @@ def main():
 
     # Look at the collected market data
     s = db.select([database.OHLCV])
-    result = conn.execute(s)
-    data = result.fetchall()
+    # the shared connection is also written by the ticker thread
+    with database.lock:
+        result = database.connection().execute(s)
+        data = result.fetchall()
+        columns = result.keys()
     df = pd.DataFrame(data)
-    df.columns = result.keys()
+    df.columns = columns
 
     order_book_raw = exchangeInterface.get_order_book('gdax', 'BTC/USD')
 
@@ -133,25 +193,29 @@ def main():
 
     from logics.risk_management import position_control
 
-    position_control_simple = position_control.Position_Control(fake_position_data, ohlcv_new, 0.2, 0.2)
-    # produce sell signals only
-    rm_result = position_control_simple.control()
+    # produce sell signals only, so there is nothing to control without positions
+    risk_sell = False
+    if len(position_data):
+        position_control_simple = position_control.Position_Control(position_data, ohlcv_new, 0.2, 0.2)
+        rm_result = position_control_simple.control()
+        risk_sell = rm_result['sell'][0]
 
     # Order execution
     from logics.risk_management import order_control
 
     def order_execution(exchangeInterface, exchange, market_pair, position_book, order_book, orderType='market', ):
-        if (strategy_result['sell'][0] or rm_result['sell'][0]):
+        if (strategy_result['sell'][0] or risk_sell):
             free_balance = exchangeInterface.get_free_balance(exchange)
-            position = \
-            position_book.loc[(position_book.exchange == exchange) & (position_book.symbol == market_pair)]['position'][
-                0]
+            position_book = position_book.loc[(position_book.exchange == exchange) & (position_book.symbol == market_pair)]
+            position = position_book['position'].iloc[0] if len(position_book) else 'long'
             order_control_simple = order_control.Order_Control(exchange, market_pair, free_balance, position,
-                                                               position_book, order_book)
+                                                               position_book if len(position_book) else None, order_book)
             return order_control_simple.simple_control()
 
-    exec_price, exec_size = order_execution(exchangeInterface, exchange, market_pair, fake_position_data,
-                                            order_book_raw)
+    # None without a sell signal
+    exec_price, exec_size = order_execution(exchangeInterface, exchange, market_pair,
+                                            position_ledger.snapshot(exchange, market_pair), order_book_raw) \
+        or (None, None)
 
     ###### ACTUAL ORDER EXECUTION
     # exchangeInterface.create_order(exchange,market_pair,'limit','buy',exec_size,exec_price)
@@ -163,15 +227,23 @@ def main():
         def log_result(result):
             # This is called whenever start_strategy_ returns a result
             # result_list is modified only by the main process, not the pool workers.
+            if result is None:
+                return
+            metrics.observe('refit_seconds', result['refit_seconds'], strategy=result['strategy'])
+            if result['spans']:
+                trace.add(result['spans'])
             buy.append(result['buy'])
             sell.append(result['sell'])
 
+        trace = tracing.current()
+        indicator_cache = get_indicator_cache()
         pool = Pool()
         for key, val in strategies.items():
             Backtest_Optim = globals()[val['backtest_optim']]  # extract the strategy
             assert interval == val['interval'], "strategy is not optimized for the given interval"
             params = {'trailing_window': val['trailing_window'], 'indicator': getattr(talib, val['indicator'])}
-            pool.apply_async(start_strategy_, args=(exchange, market_pair, Backtest_Optim, params, interval),
+            pool.apply_async(start_strategy_, args=(exchange, market_pair, Backtest_Optim, params, interval,
+                                                    indicator_cache, trace is not None),
                              callback=log_result)
         pool.close()
         pool.join()
@@ -181,35 +253,16 @@ def main():
 
     order_info = exchangeInterface.exchanges['gdax'].fetch_orders('BTC/USD')[0]
 
-    def log_trade(exchangeInterface, exchange, orderID):
-        """
-        :param exchangeInterface:
-        :param exchange:
-        :param market_pair:
-        :param orderID:
-        :return: True if the trade is logged, False otherwise
-        """
-        status = None
-
-        timeout = tm.time() + 120
-
-        while status != 'filled' and tm.time() < timeout:
-            status = exchangeInterface.get_order_info(exchange, orderID)['status']
-            tm.sleep(exchange.rateLimit / 1000)
-
-        if status == 'filled':
-            info = exchangeInterface.get_order_info(exchange, orderID)['info']
-            with database.lock:
-                ins = database.TradeBook.insert().values(info)
-                conn.execute(ins)
-            return True
-
-        else:
-            return False
-
-    orderID = exchangeInterface.create_order()[0]['id']
+    # one tracker polls all open orders in batches and records their fills in TradeBook
+    order_tracker = OrderTracker(exchangeInterface)
+    order_tracker.subscribe(position_ledger.on_event)
+    order_tracker.subscribe(exchangeInterface.balances.on_event)
+    order_tracker.start()
 
-    log_trade(exchangeInterface, exchange, orderID)
+    if exec_price and exec_size:
+        order = exchangeInterface.create_order(exchange, market_pair, 'limit', 'buy', exec_size, exec_price)
+        order_tracker.track(exchange, order)
+        order_tracker.wait(exchange, order['id'], timeout=120)
 
 
 if __name__ == "__main__":
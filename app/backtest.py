@@ -9,6 +9,7 @@ cdl = all_indicator[all_indicator.str.startswith("CDL")]
 
 from exchange import ExchangeInterface
 from logics.strategies.cdl_test import CDL_Test
+from logics.strategies.robustness import robustness_test
 import yaml
 import pyfolio as pf
 
@@ -32,6 +33,9 @@ def main():
     first.optim_grid.sort_values(by='sharpe',ascending=False)
     result = first.run_algorithm(params)
 
+    # how fragile is the best sharpe? re-run it over bootstrapped paths and perturbed fills
+    distribution, summary = robustness_test(CDL_Test, ohlcv, params, n_resamples=1000)
+    print(summary)
 
 
     pf.create_full_tear_sheet(result.returns)
@@ -0,0 +1,145 @@
+# Full account balances per exchange, kept current locally from our own orders and fills
+
+import logging
+import time as time_
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+BALANCE_FIELDS = ('free', 'used', 'total')
+
+
+class BalanceCache:
+    """
+    The last fetchBalance snapshot of each exchange, updated in place as we trade
+
+    Placing an order moves what it may spend from free to used (quote for buys, base for
+    sells); each fill consumes that reservation and credits what was bought; a cancel gives
+    back the rest. Reads are served from memory and only go to the exchange when a snapshot
+    is older than max_age, or when drift was detected: a balance went negative locally, or a
+    resync found the local view off by more than drift_tolerance.
+    """
+
+    def __init__(self, exchanges, max_age=300, drift_tolerance=1e-4):
+        """
+        :param exchanges: dict of exchange id: ccxt client
+        :param max_age: seconds before a snapshot is fetched again, number or dict per exchange
+        :param drift_tolerance: relative difference between local and fetched totals that counts as drift
+        """
+        self.exchanges = exchanges
+        self.max_age = max_age
+        self.drift_tolerance = drift_tolerance
+        self._balances = {}     # exchange -> {currency: {free, used, total}}
+        self._fetched_at = {}
+        self._stale = set()
+        self._reserved = {}     # (exchange, orderID) -> [currency, remaining reservation]
+        self._lock = Lock()
+        self.drift_count = 0
+
+    def _max_age(self, exchange):
+        return self.max_age.get(exchange, 300) if isinstance(self.max_age, dict) else self.max_age
+
+    def refresh(self, exchange):
+        """Fetch the exchange's balance and replace the local snapshot, logging any drift"""
+        fetched = self.exchanges[exchange].fetch_balance()
+        snapshot = dict((currency, dict((f, balance.get(f) or 0) for f in BALANCE_FIELDS))
+                        for currency, balance in fetched.items()
+                        if isinstance(balance, dict) and 'total' in balance)
+        with self._lock:
+            local = self._balances.get(exchange)
+            if local is not None:
+                for currency in set(local) | set(snapshot):
+                    ours = local.get(currency, {}).get('total', 0)
+                    theirs = snapshot.get(currency, {}).get('total', 0)
+                    if abs(ours - theirs) > self.drift_tolerance * max(abs(theirs), 1):
+                        self.drift_count += 1
+                        logger.warning("{} {} balance drifted: {} locally, {} on the exchange".format(
+                            exchange, currency, ours, theirs))
+            self._balances[exchange] = snapshot
+            self._fetched_at[exchange] = time_.time()
+            self._stale.discard(exchange)
+        return snapshot
+
+    def balance(self, exchange):
+        """:return: {currency: {free, used, total}} of an exchange, fetched only if stale"""
+        with self._lock:
+            stale = (exchange not in self._balances or exchange in self._stale or
+                     time_.time() - self._fetched_at[exchange] > self._max_age(exchange))
+        if stale:
+            self.refresh(exchange)
+        with self._lock:
+            return dict((currency, dict(b)) for currency, b in self._balances[exchange].items())
+
+    def free(self, exchange, currency):
+        """:return: free balance of a currency, None if the exchange does not report it"""
+        return self.balance(exchange).get(currency, {}).get('free')
+
+    def aggregate(self, currencies=None):
+        """
+        Balances summed across every exchange with a snapshot, without fetching
+
+        :param currencies: optional list of currencies to include
+        :return: {currency: {free, used, total}}
+        """
+        total = {}
+        with self._lock:
+            for balances in self._balances.values():
+                for currency, balance in balances.items():
+                    if currencies is not None and currency not in currencies:
+                        continue
+                    summed = total.setdefault(currency, dict.fromkeys(BALANCE_FIELDS, 0))
+                    for f in BALANCE_FIELDS:
+                        summed[f] += balance[f]
+        return total
+
+    def _adjust(self, exchange, currency, free=0, used=0, total=0):
+        balance = self._balances[exchange].setdefault(currency, dict.fromkeys(BALANCE_FIELDS, 0))
+        balance['free'] += free
+        balance['used'] += used
+        balance['total'] += total
+        if balance['free'] < 0 or balance['used'] < 0:
+            # our view is missing something, i.e. a trade made elsewhere
+            self._stale.add(exchange)
+
+    def on_order(self, exchange, symbol, side, amount, price=None, orderID=None):
+        """Reserve what a newly placed order may spend"""
+        base, quote = symbol.split('/')
+        currency, reserve = (base, amount) if side != 'buy' else (quote, amount * price if price else 0)
+        with self._lock:
+            if exchange not in self._balances or not reserve:
+                return
+            self._adjust(exchange, currency, free=-reserve, used=reserve)
+            if orderID is not None:
+                self._reserved[(exchange, str(orderID))] = [currency, reserve]
+
+    def on_event(self, event):
+        """OrderTracker callback, applies fills and releases the reservation of finished orders"""
+        exchange = event['exchange']
+        with self._lock:
+            if exchange not in self._balances:
+                return
+            key = (exchange, str(event['orderID']))
+            reservation = self._reserved.get(key)
+            if event['type'] == 'fill':
+                base, quote = event['symbol'].split('/')
+                # ccxt leaves a trade's cost None on many exchanges
+                cost = event.get('cost')
+                if cost is None:
+                    cost = event['amount'] * event['price']
+                if event.get('side') == 'buy':
+                    spent, spend, got, gets = quote, cost, base, event['amount']
+                else:
+                    spent, spend, got, gets = base, event['amount'], quote, cost
+                from_used = min(spend, reservation[1]) if reservation and reservation[0] == spent else 0
+                if reservation and from_used:
+                    reservation[1] -= from_used
+                self._adjust(exchange, spent, free=-(spend - from_used), used=-from_used, total=-spend)
+                # fees are charged in the quote currency on most exchanges
+                fee = event.get('fee') or 0
+                self._adjust(exchange, got, free=gets, total=gets)
+                if fee:
+                    self._adjust(exchange, quote, free=-fee, total=-fee)
+            elif reservation is not None:
+                # closed, canceled, expired or rejected: what is still reserved is free again
+                self._adjust(exchange, reservation[0], free=reservation[1], used=-reservation[1])
+                del self._reserved[key]
@@ -0,0 +1,230 @@
+# Deadlines, hedged reads, backoff and circuit breakers for the calls to an exchange
+
+import logging
+import random
+import threading
+import time as time_
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+import ccxt
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(ccxt.ExchangeNotAvailable):
+    """Raised without calling the exchange while an endpoint's circuit is open"""
+
+
+class DeadlineExceeded(ccxt.RequestTimeout):
+    """Raised when a call, retries and hedges included, ran out of its deadline"""
+
+
+class CircuitBreaker:
+    """
+    Fails calls to an endpoint fast after consecutive failures, then lets it recover gradually
+
+    closed: calls go through; `failures` network errors in a row open the circuit.
+    open: calls fail with CircuitOpen for `cooldown` seconds.
+    half open: one probe call at a time goes through; `recovery` successes in a row close the
+    circuit, a failure opens it again for twice as long, up to max_cooldown.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, failures=5, cooldown=5, max_cooldown=300, recovery=3):
+        self.failures = failures
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.recovery = recovery
+        self.state = self.CLOSED
+        self.cooldown = cooldown
+        self._failed = 0
+        self._succeeded = 0
+        self._opened = 0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """:return: True if a call may go through; the caller must then record its outcome"""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN:
+                if time_.monotonic() - self._opened < self.cooldown:
+                    return False
+                self.state = self.HALF_OPEN
+                self._succeeded = 0
+            if self._probing:
+                return False
+            self._probing = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._failed = 0
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                self._succeeded += 1
+                if self._succeeded >= self.recovery:
+                    self.state = self.CLOSED
+                    self.cooldown = self.base_cooldown
+
+    def record_failure(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._probing = False
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self._open()
+                return
+            self._failed += 1
+            if self.state == self.CLOSED and self._failed >= self.failures:
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened = time_.monotonic()
+        self._failed = 0
+
+
+class LatencyWindow:
+    """Latencies of the latest successful calls to an endpoint"""
+
+    def __init__(self, size=100):
+        self._latencies = deque(maxlen=size)
+
+    def add(self, seconds):
+        self._latencies.append(seconds)
+
+    def quantile(self, q, min_samples=20):
+        """:return: the q quantile in seconds, or None with fewer than min_samples latencies"""
+        latencies = sorted(self._latencies)
+        if len(latencies) < min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def _timed(func, args, kwargs):
+    start = time_.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time_.perf_counter() - start
+
+
+class CallPolicy:
+    """
+    How the calls to one exchange are made
+
+    Every idempotent call gets a deadline covering all of its attempts, and is retried on
+    network errors with exponential backoff and jitter while the deadline allows; the others
+    are made once, since a request that timed out may still have been executed. Hedged calls
+    (idempotent reads) send a duplicate request when the first one is slower than the endpoint's
+    p95 latency and take whichever answers first. Each endpoint has a CircuitBreaker.
+
+    Idempotent calls run on the policy's threads so the caller can stop waiting at the deadline;
+    a request still in flight then finishes in the background, bounded by the client's own timeout.
+    The others, i.e. orders, run on the caller's thread and are waited for up to the client's
+    timeout: an order abandoned at the deadline could still be sent and filled unseen.
+    """
+
+    def __init__(self, name, deadline=10, deadlines=None, attempts=3, backoff=0.5, max_backoff=8,
+                 hedge_quantile=0.95, hedge_min_samples=20, failures=5, cooldown=5, max_cooldown=300,
+                 recovery=3, max_workers=16):
+        """
+        :param name: the exchange, used in logs and metrics
+        :param deadline: seconds a call may take, retries and hedges included
+        :param deadlines: optional dict of endpoint: deadline, i.e. for slow endpoints
+        :param attempts: tries of an idempotent call
+        :param backoff: seconds before the first retry, doubled for each following one
+        :param hedge_quantile: latency quantile of an endpoint after which a hedged call is duplicated
+        :param hedge_min_samples: calls to an endpoint to see before hedging it
+        :param failures, cooldown, max_cooldown, recovery: see CircuitBreaker
+        """
+        self.name = name
+        self.deadline = deadline
+        self.deadlines = deadlines or {}
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self._breaker_config = dict(failures=failures, cooldown=cooldown, max_cooldown=max_cooldown,
+                                    recovery=recovery)
+        self._breakers = {}
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='call-{}'.format(name))
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(**self._breaker_config)
+                self._latencies[endpoint] = LatencyWindow()
+            return self._breakers[endpoint]
+
+    def latency(self, endpoint):
+        self.breaker(endpoint)
+        return self._latencies[endpoint]
+
+    def call(self, endpoint, func, *args, idempotent=False, hedge=False, **kwargs):
+        """
+        :param endpoint: name the breaker, latencies and deadline are kept under
+        :param idempotent: the call may be retried, and abandoned at the deadline
+        :param hedge: the call may be duplicated, for idempotent reads
+        :return: what func returns
+        """
+        deadline = time_.monotonic() + self.deadlines.get(endpoint, self.deadline)
+        breaker = self.breaker(endpoint)
+        attempts = self.attempts if idempotent else 1
+        for attempt in range(attempts):
+            if not breaker.allow():
+                metrics.inc('exchange_circuit_rejected_total', exchange=self.name, method=endpoint)
+                raise CircuitOpen('{} {}: circuit open'.format(self.name, endpoint))
+            try:
+                if idempotent:
+                    result, seconds = self._attempt(endpoint, func, args, kwargs, deadline, hedge)
+                else:
+                    result, seconds = _timed(func, args, kwargs)
+            except ccxt.NetworkError as e:
+                breaker.record_failure()
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt) * random.uniform(0.5, 1)
+                if attempt + 1 == attempts or time_.monotonic() + delay >= deadline:
+                    raise
+                logger.warning("{} {} failed ({}), retrying in {:.2f}s".format(self.name, endpoint, e, delay))
+                time_.sleep(delay)
+                continue
+            except Exception:
+                # the exchange answered, i.e. with InsufficientFunds or OrderNotFound
+                breaker.record_success()
+                raise
+            breaker.record_success()
+            self._latencies[endpoint].add(seconds)
+            return result
+
+    def _attempt(self, endpoint, func, args, kwargs, deadline, hedge):
+        pending = {self._pool.submit(_timed, func, args, kwargs)}
+        hedge_after = self._latencies[endpoint].quantile(self.hedge_quantile, self.hedge_min_samples) \
+            if hedge else None
+        if hedge_after is not None and time_.monotonic() + hedge_after < deadline:
+            done, _ = wait(pending, timeout=hedge_after)
+            if not done:
+                metrics.inc('exchange_hedged_calls_total', exchange=self.name, method=endpoint)
+                pending.add(self._pool.submit(_timed, func, args, kwargs))
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=max(0, deadline - time_.monotonic()),
+                                 return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        if error is not None and not pending:
+            raise error
+        metrics.inc('exchange_deadline_exceeded_total', exchange=self.name, method=endpoint)
+        raise DeadlineExceeded('{} {}: no answer within the deadline'.format(self.name, endpoint))
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
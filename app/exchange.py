@@ -7,23 +7,60 @@ import time as tm
 import datetime as dt
 from pytz import timezone
 import itertools
+import functools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from threading import Semaphore
 
-from pandas.tseries.offsets import CustomBusinessDay
-from trading_calendars import register_calendar, TradingCalendar
-from trading_calendars.errors import  CalendarNameCollision
-from zipline.utils.memoize import lazyval
 from ccxt.base.errors import OrderNotFound
 
 
 import ccxt
 import structlog
-from tenacity import retry, retry_if_exception_type, stop_after_attempt
 import pandas as pd
 
 from market import database
-
-engine = database.engine
-conn = engine.connect()
+from market.candles import Candles
+from trade_index import TradeIndex
+from rate_limiter import RateLimiter
+from balance_cache import BalanceCache
+from call_policy import CallPolicy
+import metrics
+import tracing
+
+
+def _instrumented(method):
+    """Count and time an ExchangeInterface call per exchange and method, retries included; a span when traced"""
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, exchange, *args, **kwargs):
+        with tracing.span(name, exchange=exchange):
+            if not metrics.enabled():
+                return method(self, exchange, *args, **kwargs)
+            status = 'error'
+            start = tm.perf_counter()
+            try:
+                result = method(self, exchange, *args, **kwargs)
+                status = 'ok'
+                return result
+            finally:
+                metrics.observe('exchange_call_seconds', tm.perf_counter() - start, exchange=exchange, method=name)
+                metrics.inc('exchange_calls_total', exchange=exchange, method=name, status=status)
+    return wrapper
+
+
+def _with_policy(idempotent=False, hedge=False):
+    """Make an ExchangeInterface call through the exchange's CallPolicy, under the method's name"""
+    def decorator(method):
+        name = method.__name__
+
+        @functools.wraps(method)
+        def wrapper(self, exchange, *args, **kwargs):
+            return self.call_policies[exchange].call(name, method, self, exchange, *args,
+                                                     idempotent=idempotent, hedge=hedge, **kwargs)
+        return wrapper
+    return decorator
 
 class ExchangeInterface:
     """Interface for performing queries against exchange APIs
@@ -38,6 +75,14 @@ class ExchangeInterface:
 
         self.logger = structlog.get_logger()
         self.exchanges = dict()
+        self.trade_index = TradeIndex()
+        self.rate_limiters = dict()
+        # set by market.orderbook_recorder.start_recorder to keep the books fetched here
+        self.order_book_recorder = None
+        # set by exchange_cache.start_exchange_cache, which keeps the clients' markets on disk
+        self.exchange_cache = None
+        self.call_policies = dict()
+        self.balance_max_age = dict()
 
         # Loads the exchanges using ccxt.
         for exchange in exchange_config:
@@ -53,11 +98,45 @@ class ExchangeInterface:
 
             # sets up api permissions for user if given
             if new_exchange:
-                self.exchanges[new_exchange.id] = new_exchange
+                self.add_exchange(new_exchange, exchange_config[exchange])
             else:
                 self.logger.error("Unable to load exchange %s", new_exchange)
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+        # full balance snapshots, updated by our own orders and fills in between fetches
+        self.balances = BalanceCache(self.exchanges, max_age=self.balance_max_age)
+
+    def add_exchange(self, client, config=None):
+        """
+        Register a ccxt client, or anything with its interface such as fake_exchange.FakeExchange
+
+        :param config: the exchange's section of config.yml; balance.max_age and call_policy are used
+        """
+        config = config or {}
+        self.exchanges[client.id] = client
+        self.rate_limiters[client.id] = RateLimiter(client.rateLimit / 1000)
+        if client.enableRateLimit:
+            self.use_rate_limiter(client.id, self.rate_limiters[client.id])
+        self.balance_max_age[client.id] = config.get('balance', {}).get('max_age', 300)
+        policy = CallPolicy(client.id, **config.get('call_policy', {}))
+        self.call_policies[client.id] = policy
+        # a single request never outlives a call's deadline; orders, waited for to the end, are bounded by it
+        client.timeout = min(client.timeout, int(policy.deadline * 1000))
+
+    def use_rate_limiter(self, exchange, limiter):
+        """
+        Pace every request of an exchange's client with limiter, i.e. one shared between processes
+
+        ccxt calls throttle before each request when enableRateLimit is set; the limiter takes
+        its place, so concurrent threads and processes queue up for slots instead of each
+        keeping its own timer.
+        """
+        client = self.exchanges[exchange]
+        self.rate_limiters[exchange] = limiter
+        client.enableRateLimit = True
+        client.throttle = lambda *args, **kwargs: limiter.wait()
+
+    @_instrumented
+    @_with_policy(idempotent=True, hedge=True)
     def get_live_data(self, exchange,market_pair,  time_unit):
         try:
             if time_unit not in self.exchanges[exchange].timeframes:
@@ -94,13 +173,14 @@ class ExchangeInterface:
 
         return ohlcv, ticker_data
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
-    def get_historical_data(self, exchange, market_pair, time_unit, start_date=None, max_periods=1000):
+    @_instrumented
+    def get_historical_data(self, exchange, market_pair, time_unit, start_date=None, max_periods=1000, raw=False):
         """
         Get historical OHLCV for a symbol pair
 
-        Decorators:
-            retry
+        Each page is fetched through the exchange's CallPolicy, hedged and retried on its own, so
+        a slow page is duplicated rather than the whole backfill, and deadlines and latencies are
+        those of one request however many pages are asked for.
 
         Args:
             exchange (str): Contains the exchange to fetch the historical data from.
@@ -109,9 +189,12 @@ class ExchangeInterface:
             market_pair (str): Contains the symbol pair to operate on i.e. BURST/BTC
             max_periods (int, optional): Defaults to 100. Maximum number of time periods
               back to fetch data for.
+            raw (bool, optional): return the exchange's rows, at full precision for storage,
+              instead of Candles.
 
         Returns:
-            list: Contains a list of lists which contain timestamp, open, high, low, close, volume.
+            Candles: timestamp, open, high, low, close, volume of the market, ascending;
+              or with raw, list of [timestamp, open, high, low, close, volume].
         """
 
         try:
@@ -152,11 +235,10 @@ class ExchangeInterface:
             max_days_date = now_ - (max_periods * start_date_delta)
             start_date = int(max_days_date.astimezone(timezone('UTC')).timestamp() * 1000)
 
-        historical_data = self.exchanges[exchange].fetch_ohlcv(
-            market_pair,
-            timeframe=time_unit,
-            since=start_date
-        )
+        policy = self.call_policies[exchange]
+        historical_data = policy.call('fetch_ohlcv', self.exchanges[exchange].fetch_ohlcv,
+                                      market_pair, timeframe=time_unit, since=start_date,
+                                      idempotent=True, hedge=True)
 
         historical_data.sort()
         historical_data_  = list(k for k,_ in itertools.groupby(historical_data))
@@ -177,11 +259,9 @@ class ExchangeInterface:
             start_date_ = int((dt.datetime.fromtimestamp(historical_data_[-1][0]/1000)+start_date_delta).timestamp()*1000)
             print(len(historical_data_))
             print(max_days_date_)
-            historical_data = self.exchanges[exchange].fetchOHLCV(
-                                              market_pair,
-                                              timeframe=time_unit,
-                                              since=start_date_
-                                          )
+            historical_data = policy.call('fetch_ohlcv', self.exchanges[exchange].fetch_ohlcv,
+                                          market_pair, timeframe=time_unit, since=start_date_,
+                                          idempotent=True, hedge=True)
             historical_data.sort()
             historical_data  = list(k for k,_ in itertools.groupby(historical_data))
             historical_data_.extend(historical_data)
@@ -197,7 +277,9 @@ class ExchangeInterface:
 
         tm.sleep(self.exchanges[exchange].rateLimit / 1000)
 
-        return historical_data_
+        if raw:
+            return historical_data_
+        return Candles.from_ohlcv(historical_data_, exchange=exchange, symbol=market_pair, interval=time_unit)
 
     # @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
     # def get_exchange_markets(self, exchanges=[], markets=[]):
@@ -238,13 +320,13 @@ class ExchangeInterface:
     #
     #     return exchange_markets
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+    @_instrumented
     def get_order_book(self, exchange,market_pair):
         """
         Get order book for a symbol pair
 
-        Decorators:
-            retry
+        Only the fetch goes through the exchange's CallPolicy, hedged, so that a hedged duplicate
+        never records the snapshot twice.
 
         Args:
             exchange (str): Contains the exchange to fetch the historical data from.
@@ -253,7 +335,10 @@ class ExchangeInterface:
             list: Contains a dict of DataFrame which contain 'bids' and 'spreads', and each data frame contains 'price' and 'volume'
         """
 
-        order_book_raw = self.exchanges[exchange].fetch_order_book(market_pair)
+        order_book_raw = self.call_policies[exchange].call('fetch_order_book', self.exchanges[exchange].fetch_order_book,
+                                                           market_pair, idempotent=True, hedge=True)
+        if self.order_book_recorder is not None:
+            self.order_book_recorder.record(exchange, market_pair, order_book_raw)
         order_book = {'bids': pd.DataFrame({'price': [i[0] for i in order_book_raw['bids']],
                                             'volume': [i[1] for i in order_book_raw['bids']]}),
                       'asks': pd.DataFrame({'price': [i[0] for i in order_book_raw['asks']],
@@ -265,10 +350,11 @@ class ExchangeInterface:
 
         return order_book
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+    @_instrumented
+    @_with_policy(idempotent=True)
     def get_free_balance(self, exchange,symbol='USD'):
         """
-        Get free balance for the account within the exchange
+        Get free balance for the account within the exchange, from the balance cache
 
         :param exchange: string or list of string, exchange to query the balance
         :param symbol: string, symbol to query
@@ -276,7 +362,7 @@ class ExchangeInterface:
         """
         free = None
         if self.exchanges[exchange].has['fetchBalance']:
-            free = self.exchanges[exchange].fetchBalance()[symbol]['free']
+            free = self.balances.free(exchange, symbol)
 
         if free is None:
             raise ValueError("No " + symbol +" balance data returned by the exchange")
@@ -284,7 +370,8 @@ class ExchangeInterface:
         return free
 
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+    @_instrumented
+    @_with_policy(idempotent=True)
     def cancel_order(self, exchange, orderID, **kwargs):
         """
         :param exchange:
@@ -293,10 +380,10 @@ class ExchangeInterface:
         :return:
         """
         try:
-            self.exchanges[exchange].cancelOrder(orderID,kwargs)
+            self.exchanges[exchange].cancelOrder(orderID, kwargs.get('symbol'))
             with database.lock:
-                delete = database.OrderBook.delete().where(orderID=orderID)
-                conn.execute(delete)
+                delete = database.OrderBook.delete().where(database.OrderBook.c.orderID == orderID)
+                database.connection().execute(delete)
 
         except OrderNotFound:
             print("Order already executed")
@@ -305,7 +392,9 @@ class ExchangeInterface:
         tm.sleep(self.exchanges[exchange].rateLimit / 1000)
         return
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+    @_instrumented
+    # never retried: a request that timed out may still have placed the order
+    @_with_policy()
     def create_order(self, exchange, market_pair, type, side, amount, price=None, **kwargs):
         """
         :param exchange:
@@ -355,15 +444,117 @@ class ExchangeInterface:
                                                      position=position,
                                                      amount=order['amount'],
                                                      price=price)
-            conn.execute(ins)
-        self.logger.info(
-            '%s order placed. Price: %.2f, Amount: %.2f' %(side,order['amount']))
+            database.connection().execute(ins)
+        self.balances.on_order(exchange, market_pair, side, order['amount'], price, order['id'])
+        # no price for market orders
+        self.logger.info('%s order placed. Price: %s, Amount: %.2f', side, price, order['amount'])
 
         tm.sleep(self.exchanges[exchange].rateLimit / 1000)
 
         return order
 
-    @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
+    @tracing.traced('create_orders')
+    def create_orders(self, intents, max_concurrency=4, native_batch_size=5):
+        """
+        Place many orders at once, concurrently per exchange within its rate limit
+
+        Exchanges whose ccxt client has createOrders get the intents in native batches; the
+        others get one create_order request per intent, at most max_concurrency in flight and
+        paced by the exchange's RateLimiter (see use_rate_limiter) and bounded by its CallPolicy. Orders are never retried, since a timed out
+        request may still have been placed. All acknowledged orders are recorded in OrderBook
+        in one transaction.
+
+        :param intents: list of dicts with exchange, symbol, type, side ('buy' or 'sell'), amount,
+            and optionally price and params (https://github.com/ccxt/ccxt/wiki/Manual#overriding-unified-api-params)
+        :param max_concurrency: requests in flight per exchange
+        :param native_batch_size: orders per createOrders request
+        :return: list of dicts in the order of the intents, [intent, order, error, latency]; order is None
+            and error the exception if the order failed, latency is the submit-to-ack time in seconds
+        """
+        results = [None] * len(intents)
+        by_exchange = OrderedDict()
+        for i, intent in enumerate(intents):
+            by_exchange.setdefault(intent['exchange'], []).append(i)
+
+        def submit(exchange, idx):
+            batch = [intents[i] for i in idx]
+            start = tm.perf_counter()
+            try:
+                client = self.exchanges[exchange]
+                policy = self.call_policies[exchange]
+                # through the policy for its circuit breaker, never retried nor abandoned at a deadline
+                if len(batch) > 1:
+                    orders = policy.call('create_orders', client.create_orders,
+                                         [dict((k, intent.get(k)) for k in
+                                               ['symbol', 'type', 'side', 'amount', 'price', 'params'])
+                                          for intent in batch])
+                else:
+                    intent = batch[0]
+                    orders = [policy.call('create_order', client.create_order, intent['symbol'], intent['type'],
+                                          intent['side'], intent['amount'], intent.get('price'),
+                                          intent.get('params') or {})]
+                latency = tm.perf_counter() - start
+                for i, order in zip(idx, orders):
+                    results[i] = {'intent': intents[i], 'order': order, 'error': None, 'latency': latency}
+                for i in idx[len(orders):]:
+                    results[i] = {'intent': intents[i], 'order': None, 'latency': latency,
+                                  'error': ccxt.ExchangeError('no order returned for the intent')}
+            except Exception as e:
+                # i.e. a malformed intent or an unknown exchange; every intent gets a result so that
+                # the orders other threads placed are still recorded and returned
+                latency = tm.perf_counter() - start
+                for i in idx:
+                    results[i] = {'intent': intents[i], 'order': None, 'error': e, 'latency': latency}
+
+        tasks = []
+        for exchange, idx in by_exchange.items():
+            if exchange in self.exchanges and self.exchanges[exchange].has.get('createOrders'):
+                tasks += [(exchange, idx[i:i + native_batch_size]) for i in range(0, len(idx), native_batch_size)]
+            else:
+                tasks += [(exchange, [i]) for i in idx]
+        workers = sum(min(len(idx), max_concurrency) for idx in by_exchange.values())
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            semaphores = dict((exchange, Semaphore(max_concurrency)) for exchange in by_exchange)
+
+            def bounded(exchange, idx):
+                with semaphores[exchange]:
+                    submit(exchange, idx)
+
+            for future in [pool.submit(bounded, exchange, idx) for exchange, idx in tasks]:
+                future.result()
+
+        rows = []
+        for result in results:
+            intent, order = result['intent'], result['order']
+            metrics.observe('order_ack_seconds', result['latency'], exchange=intent['exchange'])
+            metrics.inc('exchange_calls_total', exchange=intent['exchange'], method='create_orders',
+                        status='ok' if order is not None else 'error')
+            if order is None:
+                self.logger.error('%s %s order on %s failed: %s', intent.get('side'), intent.get('symbol'),
+                                  intent['exchange'], result['error'])
+                continue
+            self.logger.info('%s %s order on %s acknowledged in %.3fs', intent['side'], intent['symbol'],
+                             intent['exchange'], result['latency'])
+            self.balances.on_order(intent['exchange'], intent['symbol'], intent['side'],
+                                   order.get('amount') or intent['amount'], intent.get('price'), order['id'])
+            rows.append(dict(timestamp=order.get('timestamp'),
+                             datetime=order.get('datetime'),
+                             orderID=order['id'],
+                             orderType=order.get('type') or intent['type'],
+                             exchange=intent['exchange'],
+                             symbol=order.get('symbol') or intent['symbol'],
+                             position='long' if intent['side'] == 'buy' else 'short',
+                             amount=order.get('amount') or intent['amount'],
+                             price=intent.get('price')))
+        if rows:
+            with database.lock:
+                conn = database.connection()
+                with conn.begin():
+                    conn.execute(database.OrderBook.insert(), rows)
+        return results
+
+    @_instrumented
+    @_with_policy(idempotent=True)
     def get_order_info(self, exchange,orderID):
         """
         Get order info using order ID and exchange as reference
@@ -372,7 +563,6 @@ class ExchangeInterface:
         :param orderID: string, order ID
         :return: order status and trade information related to the order if the order is closed.
         """
-        my_trade_keys = ["timestamp","datetime","id","order","amount","price","cost",'fee']
         trade_book_columns =  ['timestamp','datetime','tradeID','orderID','amount','price','cost','fee']
         trade_info = None
         status=None
@@ -383,68 +573,9 @@ class ExchangeInterface:
 
         elif status !='closed': return {'status':status, 'info':trade_info}
         else:
-            my_trades =  self.exchanges[exchange].fetch_my_trades(order_info['symbol'])
-            right_trades = list(filter(lambda a: a['order']==orderID,my_trades))
-            trade_info = [{info[0]:trade[info[1]] for info in zip(trade_book_columns,my_trade_keys)} for trade in right_trades]
+            # only the trades since the last lookup are fetched; the order's fills are then a dict lookup
+            right_trades = self.trade_index.lookup(self.exchanges[exchange], exchange, order_info['symbol'], orderID)
+            trade_info = [{col: trade[col] for col in trade_book_columns} for trade in right_trades]
             return {'status': status,'info':trade_info}
         tm.sleep(self.exchanges[exchange].rateLimit / 1000)
 
-
-class TFSExchangeCalendar(TradingCalendar):
-    """
-    An exchange calendar for trading assets 24/7.
-
-    Open Time: 12AM, UTC
-    Close Time: 11:59PM, UTC
-    """
-
-    @property
-    def name(self):
-        """
-        The name of the exchange, which Zipline will look for
-        when we run our algorithm and pass TFS to
-        the --trading-calendar CLI flag.
-        """
-        return "TFS"
-
-    @property
-    def tz(self):
-        """
-        The timezone in which we'll be running our algorithm.
-        """
-        return timezone("UTC")
-
-    @property
-    def open_time(self):
-        """
-        The time in which our exchange will open each day.
-        """
-        return dt.time(0,0)
-
-    @property
-    def close_time(self):
-        """
-        The time in which our exchange will close each day.
-        """
-        return dt.time(23, 59)
-
-    @lazyval
-    def day(self):
-        """
-        The days on which our exchange will be open.
-        """
-        weekmask = "Mon Tue Wed Thu Fri Sat Sun"
-        return CustomBusinessDay(
-            weekmask=weekmask
-        )
-
-
-start_session = pd.Timestamp('2000-01-07', tz='utc')
-end_session = pd.Timestamp('2099-12-31', tz='utc')
-try:
-    register_calendar(
-        'TFS',
-        TFSExchangeCalendar(start=start_session, end=end_session)
-    )
-except CalendarNameCollision:
-    pass
\ No newline at end of file
@@ -0,0 +1,159 @@
+# Exchange metadata (markets, currencies, timeframes, capabilities) cached on disk and shared between processes
+
+import json
+import logging
+import os
+import time as time_
+from threading import Thread, Event
+
+logger = logging.getLogger(__name__)
+
+
+class ExchangeCache(Thread):
+    """
+    Keeps each client's load_markets result in root/<exchange>.json for ttl seconds
+
+    load hands a client the cached markets, symbols, precision, limits, timeframes and has
+    flags straight from disk, so processes that start while the cache is fresh make no
+    metadata requests. The thread refreshes stale entries in the background. A refresh is
+    claimed with a lock file, so only one of the processes sharing root refreshes an exchange
+    and the others pick up the rewritten file.
+    """
+
+    def __init__(self, clients, root='exchange_cache', ttl=86400, lock_timeout=300):
+        """
+        :param clients: dict of exchange: ccxt client, i.e. ExchangeInterface.exchanges
+        :param ttl: seconds an entry is used before it is refreshed
+        :param lock_timeout: seconds after which a refresh claim of a process that died is ignored
+        """
+        super().__init__(name='exchange-cache', daemon=True)
+        self.clients = clients
+        self.root = root
+        self.ttl = ttl
+        self.lock_timeout = lock_timeout
+        self._loaded = {}  # exchange -> 'fetched' of the entry the client has
+        self._halt = Event()
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, exchange):
+        return os.path.join(self.root, '{}.json'.format(exchange))
+
+    def read(self, exchange):
+        """:return: the cached entry of an exchange, or None"""
+        try:
+            with open(self.path(exchange)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def write(self, exchange, entry):
+        # readers in other processes see the old file or the new one, never half of it
+        tmp = '{}.{}.tmp'.format(self.path(exchange), os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(entry, f, separators=(',', ':'), default=str)
+        os.replace(tmp, self.path(exchange))
+
+    def age(self, entry):
+        return time_.time() - entry['fetched'] if entry else float('inf')
+
+    def apply(self, exchange, entry):
+        """Hand a cached entry to the exchange's client"""
+        client = self.clients[exchange]
+        client.set_markets(entry['markets'], entry.get('currencies'))
+        if entry.get('timeframes'):
+            client.timeframes = entry['timeframes']
+        client.has.update(entry.get('has', {}))
+        self._loaded[exchange] = entry['fetched']
+
+    def fetch(self, exchange):
+        """:return: a fresh entry from the exchange"""
+        client = self.clients[exchange]
+        client.load_markets(reload=True)
+        return {'fetched': time_.time(),
+                'markets': client.markets,
+                'currencies': client.currencies,
+                'timeframes': getattr(client, 'timeframes', None),
+                'has': client.has}
+
+    def load(self, exchange):
+        """
+        Give the client the cached metadata, whatever its age; the thread refreshes it when stale
+
+        :return: True if there was an entry to load
+        """
+        entry = self.read(exchange)
+        if entry is None:
+            return False
+        self.apply(exchange, entry)
+        return True
+
+    def refresh(self, exchange):
+        """Refetch an exchange's metadata if this process claims it, or load what another process wrote"""
+        entry = self.read(exchange)
+        if self.age(entry) < self.ttl:
+            if entry['fetched'] != self._loaded.get(exchange):
+                self.apply(exchange, entry)
+            return
+        if not self._claim(exchange):
+            return
+        try:
+            entry = self.fetch(exchange)
+            self.write(exchange, entry)
+            self._loaded[exchange] = entry['fetched']
+            logger.info("Cached {} markets of {}".format(len(entry['markets']), exchange))
+        finally:
+            self._release(exchange)
+
+    def _claim(self, exchange):
+        lock = self.path(exchange) + '.lock'
+        try:
+            os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time_.time() - os.path.getmtime(lock) < self.lock_timeout:
+                    return False
+                os.remove(lock)
+            except OSError:
+                return False
+            return self._claim(exchange)
+
+    def _release(self, exchange):
+        try:
+            os.remove(self.path(exchange) + '.lock')
+        except OSError:
+            pass
+
+    def run(self):
+        while not self._halt.is_set():
+            for exchange in list(self.clients):
+                try:
+                    self.refresh(exchange)
+                except Exception:
+                    logger.exception("Refreshing the {} metadata cache failed".format(exchange))
+            # often enough to notice another process's refresh well within a ttl
+            self._halt.wait(min(self.ttl / 4, 600))
+
+    def stop(self):
+        self._halt.set()
+
+
+def start_exchange_cache(exchangeInterface, config=None):
+    """
+    Load every client's metadata from the cache and keep it fresh in the background
+
+    :param config: the exchange_cache section of config.yml
+    :return: the started ExchangeCache, or None if the cache is disabled
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return None
+    cache = ExchangeCache(exchangeInterface.exchanges,
+                          root=config.get('root', 'exchange_cache'),
+                          ttl=config.get('ttl', 86400))
+    for exchange in exchangeInterface.exchanges:
+        if not cache.load(exchange):
+            logger.info("No cached metadata for {}, fetching it in the background".format(exchange))
+    exchangeInterface.exchange_cache = cache
+    cache.start()
+    return cache
@@ -0,0 +1,282 @@
+# In-process stand-in for a ccxt client: deterministic market data, simulated orders, injected latency and errors
+
+import itertools
+import math
+import random
+import threading
+import time as time_
+import zlib
+from datetime import datetime
+
+import ccxt
+
+TIMEFRAMES = {'1m': 60, '5m': 300, '15m': 900, '1h': 3600, '6h': 21600, '1d': 86400}
+
+
+def synthetic_bar(timestamp, seconds=60, seed=0, base=10000.0):
+    """
+    One OHLCV candle that depends only on its timestamp and the seed
+
+    Prices follow a few slow cycles plus per-bar noise, so any range of candles can be
+    generated in any order and pages of a paginated fetch always agree.
+
+    :return: [timestamp, open, high, low, close, volume]
+    """
+    k = timestamp // 1000 // seconds
+    rng = random.Random(hash((seed, seconds, k)))
+    trend = base * (1 + 0.2 * math.sin(k / 5000) + 0.05 * math.sin(k / 400) + 0.01 * math.sin(k / 30))
+    open_ = trend * (1 + rng.gauss(0, 0.002))
+    close = trend * (1 + rng.gauss(0, 0.002))
+    high = max(open_, close) * (1 + abs(rng.gauss(0, 0.001)))
+    low = min(open_, close) * (1 - abs(rng.gauss(0, 0.001)))
+    return [timestamp, open_, high, low, close, rng.uniform(1, 100)]
+
+
+def symbol_seed(symbol, seed=0):
+    """:return: an int seed for a symbol, the same in every process unlike hash() of a str"""
+    return seed * 1000003 + zlib.crc32(symbol.encode())
+
+
+def synthetic_ohlcv(start, periods, timeframe='1m', seed=0, base=10000.0):
+    """:return: list of periods ccxt OHLCV rows from the candle containing start (ms), ascending"""
+    seconds = TIMEFRAMES[timeframe]
+    first = start // (seconds * 1000) * seconds * 1000
+    return [synthetic_bar(first + i * seconds * 1000, seconds, seed, base) for i in range(periods)]
+
+
+class FakeExchange:
+    """
+    Enough of a ccxt client for ExchangeInterface, the datafeed and the order tracker, without a network
+
+    Every request sleeps for the injected latency and may raise an injected error; both are
+    drawn from a seeded generator, so a run can be repeated. Market orders fill at once at
+    the synthetic close, limit orders fill when they cross it on a later fetch_order.
+
+        client = FakeExchange(latency={'fetch_order_book': 0.2}, error_rate=0.1, seed=1)
+        exchangeInterface.add_exchange(client)
+    """
+
+    def __init__(self, config=None, id='fake', seed=0, latency=0.0, error_rate=0.0, error=ccxt.NetworkError,
+                 ohlcv_limit=500, symbols=('BTC/USD', 'ETH/USD'), balance=None, rateLimit=0):
+        """
+        :param config: ccxt client settings, only enableRateLimit and timeout are used
+        :param latency: seconds per request; a dict of method: seconds; or a callable of the method name
+        :param error_rate: share of requests that fail, or a dict of method: share
+        :param error: the exception type injected errors raise
+        :param ohlcv_limit: candles per fetch_ohlcv page
+        :param balance: dict of currency: free amount
+        """
+        config = config or {}
+        self.id = id
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error = error
+        self.ohlcv_limit = ohlcv_limit
+        self.rateLimit = rateLimit
+        self.enableRateLimit = config.get('enableRateLimit', False)
+        self.timeout = config.get('timeout', 10000)
+        self.timeframes = dict((timeframe, timeframe) for timeframe in TIMEFRAMES)
+        self.has = {'fetchBalance': True, 'fetchOrder': True, 'fetchOrders': True, 'fetchOpenOrders': True,
+                    'fetchClosedOrders': True, 'fetchMyTrades': True, 'createOrders': False,
+                    'create_market_buy_order': True, 'create_market_sell_order': True,
+                    'create_limit_buy_order': True, 'create_limit_sell_order': True}
+        self._symbols = list(symbols)
+        self.markets = None
+        self.currencies = None
+        self.symbols = []
+        self.balance = dict(balance or {'USD': 100000.0, 'BTC': 10.0, 'ETH': 100.0})
+        self.orders = {}
+        self.trades = []
+        self.requests = dict()
+        self._ids = itertools.count(1)
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    # ccxt calls throttle before each request when enableRateLimit is set
+    def throttle(self, *args, **kwargs):
+        pass
+
+    def _request(self, method):
+        with self._lock:
+            self.requests[method] = self.requests.get(method, 0) + 1
+            latency = self.latency(method) if callable(self.latency) else \
+                self.latency.get(method, 0) if isinstance(self.latency, dict) else self.latency
+            error_rate = self.error_rate.get(method, 0) if isinstance(self.error_rate, dict) else self.error_rate
+            failed = error_rate and self._rng.random() < error_rate
+        if self.enableRateLimit:
+            self.throttle()
+        if latency:
+            time_.sleep(latency)
+        if failed:
+            raise self.error('{} {}: injected failure'.format(self.id, method))
+
+    def milliseconds(self):
+        return int(time_.time() * 1000)
+
+    def iso8601(self, timestamp):
+        return datetime.utcfromtimestamp(timestamp / 1000).isoformat() + 'Z'
+
+    # markets
+
+    def load_markets(self, reload=False):
+        if self.markets and not reload:
+            return self.markets
+        self._request('load_markets')
+        markets = {}
+        for symbol in self._symbols:
+            base, quote = symbol.split('/')
+            markets[symbol] = {'id': base + quote, 'symbol': symbol, 'base': base, 'quote': quote, 'active': True,
+                               'precision': {'amount': 8, 'price': 2},
+                               'limits': {'amount': {'min': 1e-6, 'max': None}, 'price': {'min': 0.01, 'max': None}}}
+        currencies = dict((code, {'id': code, 'code': code, 'precision': 8})
+                          for code in sorted(set(c for s in self._symbols for c in s.split('/'))))
+        self.set_markets(markets, currencies)
+        return self.markets
+
+    def set_markets(self, markets, currencies=None):
+        self.markets = markets
+        self.symbols = sorted(markets)
+        self.currencies = currencies or self.currencies
+
+    # market data
+
+    def _close(self, symbol, timestamp=None):
+        timestamp = timestamp or self.milliseconds()
+        return synthetic_bar(timestamp, 60, symbol_seed(symbol, self.seed))[4]
+
+    def fetch_ohlcv(self, symbol, timeframe='1m', since=None, limit=None, params={}):
+        self._request('fetch_ohlcv')
+        seconds = TIMEFRAMES[timeframe]
+        limit = min(limit or self.ohlcv_limit, self.ohlcv_limit)
+        now = self.milliseconds()
+        if since is None:
+            since = now - limit * seconds * 1000
+        # only closed candles and the one in progress, like an exchange
+        periods = max(0, min(limit, (now - since) // (seconds * 1000) + 1))
+        return synthetic_ohlcv(since, periods, timeframe, symbol_seed(symbol, self.seed))
+
+    fetchOHLCV = fetch_ohlcv
+
+    def fetch_ticker(self, symbol, params={}):
+        self._request('fetch_ticker')
+        timestamp = self.milliseconds()
+        close = self._close(symbol, timestamp)
+        return {'symbol': symbol, 'timestamp': timestamp, 'datetime': self.iso8601(timestamp),
+                'bid': close * 0.9999, 'ask': close * 1.0001, 'last': close, 'close': close}
+
+    def fetch_order_book(self, symbol, limit=None, params={}):
+        self._request('fetch_order_book')
+        timestamp = self.milliseconds()
+        mid = self._close(symbol, timestamp)
+        depth = limit or 20
+        rng = random.Random(hash((symbol_seed(symbol, self.seed), timestamp // 1000)))
+        bids = [[mid * (1 - 0.0001 * (i + 1)), rng.uniform(0.01, 2)] for i in range(depth)]
+        asks = [[mid * (1 + 0.0001 * (i + 1)), rng.uniform(0.01, 2)] for i in range(depth)]
+        return {'symbol': symbol, 'bids': bids, 'asks': asks, 'timestamp': timestamp,
+                'datetime': self.iso8601(timestamp), 'nonce': None}
+
+    # account
+
+    def fetch_balance(self, params={}):
+        self._request('fetch_balance')
+        with self._lock:
+            free = dict(self.balance)
+        return dict({'free': free, 'used': dict((c, 0.0) for c in free), 'total': dict(free)},
+                    **dict((c, {'free': v, 'used': 0.0, 'total': v}) for c, v in free.items()))
+
+    def _fill(self, order, price):
+        base, quote = order['symbol'].split('/')
+        sign = 1 if order['side'] == 'buy' else -1
+        cost = order['amount'] * price
+        self.balance[base] = self.balance.get(base, 0) + sign * order['amount']
+        self.balance[quote] = self.balance.get(quote, 0) - sign * cost
+        timestamp = self.milliseconds()
+        trade = {'id': str(next(self._ids)), 'order': order['id'], 'symbol': order['symbol'],
+                 'side': order['side'], 'amount': order['amount'], 'price': price, 'cost': cost,
+                 'fee': {'cost': cost * 0.001, 'currency': quote},
+                 'timestamp': timestamp, 'datetime': self.iso8601(timestamp)}
+        self.trades.append(trade)
+        order.update(status='closed', filled=order['amount'], remaining=0.0, average=price, cost=cost,
+                     trades=[trade])
+
+    def create_order(self, symbol, type, side, amount, price=None, params={}):
+        self._request('create_order')
+        timestamp = self.milliseconds()
+        with self._lock:
+            order = {'id': str(next(self._ids)), 'symbol': symbol, 'type': type, 'side': side, 'amount': amount,
+                     'price': price, 'status': 'open', 'filled': 0.0, 'remaining': amount, 'cost': 0.0,
+                     'timestamp': timestamp, 'datetime': self.iso8601(timestamp), 'trades': []}
+            self.orders[order['id']] = order
+            if type == 'market':
+                self._fill(order, self._close(symbol, timestamp))
+            return dict(order)
+
+    createOrder = create_order
+
+    def create_market_buy_order(self, symbol, amount, params={}):
+        return self.create_order(symbol, 'market', 'buy', amount, None, params)
+
+    def create_market_sell_order(self, symbol, amount, params={}):
+        return self.create_order(symbol, 'market', 'sell', amount, None, params)
+
+    def create_limit_buy_order(self, symbol, amount, price, params={}):
+        return self.create_order(symbol, 'limit', 'buy', amount, price, params)
+
+    def create_limit_sell_order(self, symbol, amount, price, params={}):
+        return self.create_order(symbol, 'limit', 'sell', amount, price, params)
+
+    def cancel_order(self, id, symbol=None, params={}):
+        self._request('cancel_order')
+        with self._lock:
+            order = self.orders.get(id)
+            if order is None or order['status'] != 'open':
+                raise ccxt.OrderNotFound('{} order {} not found'.format(self.id, id))
+            order['status'] = 'canceled'
+            return dict(order)
+
+    cancelOrder = cancel_order
+
+    def _update(self, order):
+        if order['status'] != 'open':
+            return
+        close = self._close(order['symbol'])
+        if (order['side'] == 'buy' and close <= order['price']) or (order['side'] == 'sell' and close >= order['price']):
+            self._fill(order, order['price'])
+
+    def fetch_order(self, id, symbol=None, params={}):
+        self._request('fetch_order')
+        with self._lock:
+            if id not in self.orders:
+                raise ccxt.OrderNotFound('{} order {} not found'.format(self.id, id))
+            self._update(self.orders[id])
+            return dict(self.orders[id])
+
+    def _orders(self, symbol, since, limit, status=None):
+        with self._lock:
+            orders = []
+            for order in self.orders.values():
+                self._update(order)
+                if (symbol is None or order['symbol'] == symbol) and (since is None or order['timestamp'] >= since) \
+                        and (status is None or order['status'] in status):
+                    orders.append(dict(order))
+        return orders[-limit:] if limit else orders
+
+    def fetch_orders(self, symbol=None, since=None, limit=None, params={}):
+        self._request('fetch_orders')
+        return self._orders(symbol, since, limit)
+
+    def fetch_open_orders(self, symbol=None, since=None, limit=None, params={}):
+        self._request('fetch_open_orders')
+        return self._orders(symbol, since, limit, ('open',))
+
+    def fetch_closed_orders(self, symbol=None, since=None, limit=None, params={}):
+        self._request('fetch_closed_orders')
+        return self._orders(symbol, since, limit, ('closed', 'canceled'))
+
+    def fetch_my_trades(self, symbol=None, since=None, limit=None, params={}):
+        self._request('fetch_my_trades')
+        with self._lock:
+            trades = [dict(t) for t in self.trades if (symbol is None or t['symbol'] == symbol)
+                      and (since is None or t['timestamp'] >= since)]
+        return trades[:limit] if limit else trades
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""Check what importing the live entry points costs against a budget
+
+    python app/import_budget.py [budget seconds]
+
+Each module is imported in a fresh interpreter, the way a restarted process imports it. The
+check fails when an import takes longer than the budget, pulls in a backtest-only package or
+opens a database connection; the slowest top level imports are listed either way.
+"""
+import json
+import os
+import subprocess
+import sys
+
+# entry points of the live processes: the runner shards and app.main
+LIVE_MODULES = ('runner', 'app')
+# packages only backtests need, a live import must not load them
+BACKTEST_ONLY = ('zipline', 'trading_calendars', 'pyfolio', 'empyrical', 'sklearn')
+BUDGET = 2.0
+
+_probe = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+from market import database
+print(json.dumps({{'seconds': seconds, 'connected': database._conn is not None,
+                  'loaded': [name for name in {backtest_only!r} if name in sys.modules]}}))
+"""
+
+
+def measure(module, cwd=None):
+    """
+    :return: dict of seconds, loaded (backtest-only packages imported), connected (database
+        connection opened) and slowest, a list of (cumulative seconds, package) of top level imports
+    """
+    cwd = cwd or os.path.dirname(os.path.realpath(__file__))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                              _probe.format(module=module, backtest_only=BACKTEST_ONLY)],
+                             cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode:
+        raise RuntimeError("Importing {} failed:\n{}".format(module, process.stderr[-2000:]))
+    result = json.loads(process.stdout.strip().splitlines()[-1])
+
+    # 'import time: self [us] | cumulative | imported package', nesting shown by indentation
+    slowest = []
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, package = line[len('import time:'):].split('|')
+        if not package.startswith('  '):
+            slowest.append((int(cumulative) / 1e6, package.strip()))
+    result['slowest'] = sorted(slowest, reverse=True)
+    return result
+
+
+def main():
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    failed = False
+    for module in LIVE_MODULES:
+        result = measure(module)
+        problems = []
+        if result['seconds'] > budget:
+            problems.append('over the {:.2f}s budget'.format(budget))
+        if result['loaded']:
+            problems.append('loads {}'.format(', '.join(result['loaded'])))
+        if result['connected']:
+            problems.append('connects to the database')
+        failed = failed or bool(problems)
+        print('{}: {:.3f}s {}'.format(module, result['seconds'], '; '.join(problems) or 'ok'))
+        for seconds, package in result['slowest'][:10]:
+            print('    {:7.3f}s {}'.format(seconds, package))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
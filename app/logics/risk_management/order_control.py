@@ -2,6 +2,9 @@
 
 import pandas as pd
 import logging
+
+import metrics
+import tracing
 logger = logging.getLogger(__name__)
 
 class Order_Control:
@@ -50,6 +53,8 @@ class Order_Control:
             return self.size
 
 
+    @metrics.timed('risk_control_seconds', method='order_control')
+    @tracing.traced('order_control')
     def simple_control(self):
         self._simple_price_control()
         self._simple_size_control()
@@ -1,5 +1,9 @@
 import pandas as pd
 import logging
+
+from market.candles import Candles
+import metrics
+import tracing
 logger = logging.getLogger(__name__)
 
 
@@ -9,11 +13,16 @@ class Position_Control:
         """
 
         :param position_data: DataFrame object, [timestamp, datetime, exchange, symbol, position, amount, price, cost]
-        :param ohlcv: DataFrame, latest candlestick for each pair of asset, [timestamp, exchange,symbol, datetime, open, high, low, close, volume,interval, bid, ask]
+        :param ohlcv: Candles or list of Candles, one per pair of asset, whose latest candlestick is used;
+            or a DataFrame of the latest candlestick for each pair, [timestamp, exchange,symbol, datetime, open, high, low, close, volume,interval, bid, ask]
         :param target: profit target
         :param loss: stop-loss limit
         """
 
+        if isinstance(ohlcv, Candles):
+            ohlcv = [ohlcv]
+        if isinstance(ohlcv, list):
+            ohlcv = pd.DataFrame([candles.last() for candles in ohlcv if len(candles)])
         self.position = position_data[['exchange','symbol','position','amount','price']]
         self.ohlcv = ohlcv[['exchange','symbol','open','high','low','close','volume','bid','ask']]
         self.combined = pd.merge(self.position,self.ohlcv,how='left',on=['exchange','symbol'])
@@ -38,6 +47,8 @@ class Position_Control:
 
         return sell
 
+    @metrics.timed('risk_control_seconds', method='position_control')
+    @tracing.traced('position_control')
     def control(self,control_method=None,position_ohlcv=None,*args,**kwargs):
         """
 
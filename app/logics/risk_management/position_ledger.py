@@ -0,0 +1,146 @@
+# keep positions up to date from fills, in memory and in the Position table
+
+import logging
+import time as time_
+from datetime import datetime
+from threading import Lock
+
+import pandas as pd
+from sqlalchemy import select
+
+from market import database
+
+logger = logging.getLogger(__name__)
+
+SNAPSHOT_COLUMNS = ['timestamp', 'datetime', 'exchange', 'symbol', 'position', 'amount', 'price', 'cost']
+
+
+def _fill(position, qty, price, timestamp):
+    """
+    Apply a fill to a [signed amount, average price, timestamp] position in place
+
+    Adding to a position moves the average price, reducing it keeps the average, and crossing
+    zero opens the remainder at the fill price.
+    """
+    held, avg = position[0], position[1]
+    new = held + qty
+    if held == 0 or (held > 0) == (qty > 0):
+        avg = (abs(held) * avg + abs(qty) * price) / abs(new)
+    elif new != 0 and (new > 0) != (held > 0):
+        avg = price
+    position[0] = new
+    position[1] = avg if new != 0 else 0.0
+    position[2] = timestamp
+
+
+class Position_Ledger:
+    """
+    Net position per (exchange, symbol), maintained fill by fill
+
+    Each fill updates the signed amount and average entry price of its market in O(1).
+    Changed markets are written to the Position table together, at most every flush_every
+    seconds, so a burst of fills costs one transaction; flush() writes what is left, i.e. on shutdown.
+    """
+
+    def __init__(self, flush_every=1.0):
+        """
+        :param flush_every: seconds between writes of changed positions to the Position table
+        """
+        self.flush_every = flush_every
+        self.conn = database.engine.connect()
+        self._positions = {}  # (exchange, symbol) -> [signed amount, average price, timestamp]
+        self._dirty = set()
+        self._last_flush = 0
+        self._lock = Lock()
+
+    def apply(self, exchange, symbol, side, amount, price, timestamp=None):
+        """
+        :param side: 'buy' or 'sell'
+        :param amount: filled amount of base currency
+        :param price: fill price in quote currency
+        """
+        qty = amount if side == 'buy' else -amount
+        key = (exchange, symbol)
+        with self._lock:
+            position = self._positions.get(key)
+            if position is None:
+                position = self._positions[key] = [0.0, 0.0, None]
+            _fill(position, qty, price, timestamp if timestamp is not None else int(time_.time() * 1000))
+            self._dirty.add(key)
+        if time_.time() - self._last_flush >= self.flush_every:
+            self.flush()
+
+    def on_event(self, event):
+        """OrderTracker callback, applies fill events"""
+        if event.get('type') != 'fill':
+            return
+        if event.get('side') not in ('buy', 'sell'):
+            logger.warning("Fill {} has no side, position not updated".format(event.get('tradeID')))
+            return
+        self.apply(event['exchange'], event['symbol'], event['side'], event['amount'], event['price'],
+                   event.get('timestamp'))
+
+    def flush(self):
+        """Write changed positions to the Position table in one transaction"""
+        with self._lock:
+            rows = [self._row(key, self._positions[key]) for key in self._dirty]
+            self._dirty = set()
+            self._last_flush = time_.time()
+        if not rows:
+            return
+        with database.lock:
+            with self.conn.begin():
+                self.conn.execute(database.Position.insert().prefix_with('OR REPLACE'), rows)
+
+    def rebuild(self):
+        """
+        Replay every fill in TradeBook, i.e. on startup, and rewrite the Position table
+
+        :return: number of fills replayed
+        """
+        tb = database.TradeBook.c
+        s = select([tb.exchange, tb.symbol, tb.side, tb.amount, tb.price, tb.timestamp]) \
+            .order_by(tb.timestamp)
+        with database.lock:
+            rows = self.conn.execute(s).fetchall()
+
+        positions = {}
+        for exchange, symbol, side, amount, price, timestamp in rows:
+            if side not in ('buy', 'sell'):
+                continue
+            qty = amount if side == 'buy' else -amount
+            position = positions.get((exchange, symbol))
+            if position is None:
+                position = positions[(exchange, symbol)] = [0.0, 0.0, None]
+            _fill(position, qty, price, timestamp)
+
+        with self._lock:
+            self._positions = positions
+            self._dirty = set(positions)
+        with database.lock:
+            self.conn.execute(database.Position.delete())
+        self.flush()
+        logger.info("Rebuilt {} positions from {} fills".format(len(positions), len(rows)))
+        return len(rows)
+
+    def snapshot(self, exchange=None, symbol=None):
+        """
+        :return: DataFrame of the open positions, [timestamp, datetime, exchange, symbol, position, amount, price, cost],
+            as Position_Control and Order_Control take them; amount is positive, position is 'long' or 'short'
+        """
+        with self._lock:
+            rows = [self._row(key, position) for key, position in self._positions.items()
+                    if position[0] != 0 and exchange in (None, key[0]) and symbol in (None, key[1])]
+        return pd.DataFrame(rows, columns=SNAPSHOT_COLUMNS)
+
+    @staticmethod
+    def _row(key, position):
+        amount, price, timestamp = position
+        return {'timestamp': timestamp,
+                'datetime': datetime.utcfromtimestamp(timestamp / 1000).isoformat() + 'Z' if timestamp else None,
+                'exchange': key[0],
+                'symbol': key[1],
+                'position': 'long' if amount >= 0 else 'short',
+                'amount': abs(amount),
+                'price': price,
+                'cost': abs(amount) * price}
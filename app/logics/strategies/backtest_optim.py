@@ -1,15 +1,61 @@
-from zipline.api import order, record, symbol
-from zipline.finance import commission, slippage
+# zipline is imported where a backtest needs it, live refits only use talib and numpy
 # Import exponential moving average from talib wrapper
 from talib import EMA
 from talib import BBANDS
 from collections import OrderedDict
-from datetime import datetime
+import numpy as np
 import pandas as pd
 
-from exchange import TFSExchangeCalendar
-import zipline
-import pandas as pd
+from market.candles import Candles, interval_to_seconds
+from logics.strategies.indicator_cache import cached_indicator, series_key
+
+# how each field is combined when 1m bars are rolled up to the strategy interval
+_field_aggregation = {'open': lambda x: x[:, 0], 'high': lambda x: x.max(axis=1), 'low': lambda x: x.min(axis=1),
+                      'close': lambda x: x[:, -1], 'price': lambda x: x[:, -1], 'volume': lambda x: x.sum(axis=1)}
+
+
+def aggregate_window(window, bars_per_candle, field=None):
+    """
+    Roll a data.history window of base bars up into candles of bars_per_candle bars, aligned on the latest bar
+
+    :param window: Series or DataFrame returned by data.history
+    :param bars_per_candle: number of base bars in one candle
+    :param field: the field of window when data.history was asked for a single field
+        (columns are then assets); None when the columns are the fields
+    :return: window of the same type with len(window) // bars_per_candle rows
+    """
+    n = len(window) // bars_per_candle
+    tail = window.iloc[len(window) - n * bars_per_candle:]
+    index = tail.index[bars_per_candle - 1::bars_per_candle]
+    values = tail.values.reshape(n, bars_per_candle, -1)
+    if isinstance(window, pd.Series):
+        return pd.Series(_field_aggregation[field](values)[:, 0], index=index, name=window.name)
+    if field is not None:
+        return pd.DataFrame(_field_aggregation[field](values), index=index, columns=window.columns)
+    return pd.DataFrame({col: _field_aggregation[col](values[:, :, i]) for i, col in enumerate(window.columns)},
+                        index=index, columns=window.columns)
+
+
+def place_signal_order(context, asset, enter):
+    """
+    Enter or exit a position in one asset according to the allocation set up in initialize
+
+    :param context: zipline algorithm context
+    :param asset: zipline Asset
+    :param enter: True to build the position, False to close it
+    :return: True if an order was placed
+    """
+    from zipline.api import order, order_target_percent
+
+    if enter == context.invested[asset]:
+        return False
+    if context.weights is None:
+        order(asset, 100 if enter else -100)
+    else:
+        order_target_percent(asset, context.weights[asset.symbol] if enter else 0)
+    context.invested[asset] = enter
+    return True
+
 
 class Backtest_Optim:
 
@@ -19,53 +65,158 @@ class Backtest_Optim:
     """
 
 
-    def __init__(self,ohlcv=None,asset_symbol='BTC',frequency='daily'):
+    def __init__(self,ohlcv=None,asset_symbol='BTC',frequency='daily',allocation=None,interval=None):
         """
         Args:
-        ohlcv: returns from ccxt.exchange.fetch_ohlcv()
+        ohlcv: returns from ccxt.exchange.fetch_ohlcv() or a market.candles.Candles, or a dict
+            {asset_symbol: ohlcv} to backtest several assets in a single simulation
+        asset_symbol: symbol of a single ohlcv; ignored when ohlcv is a dict
         frequency: {'daily', 'minute'}, optional) – The data frequency to run the algorithm at.
+        allocation: None to trade fixed 100-unit orders, 'equal' to split the capital evenly across
+            assets, or a dict {asset_symbol: weight} of target portfolio weights
+        interval: the candle interval the strategy trades on, i.e. '5m'; trailing windows are built
+            from 1m (minute) or 1d (daily) bars rolled up to it. Defaults to the data frequency.
 
         """
 
         def convert_to_dataframe(historical_data):
-            """Converts historical data matrix to a pandas dataframe.
+            """Converts historical data to a float32 pandas dataframe indexed by UTC bar time.
 
             Args:
-                historical_data (list): A matrix of historical OHCLV data.
+                historical_data (list or Candles): A matrix of historical OHCLV data.
 
             Returns:
                 pandas.DataFrame: Contains the historical data in a pandas dataframe.
             """
+            if not isinstance(historical_data, Candles):
+                historical_data = Candles.from_ohlcv(historical_data)
+            return historical_data.to_frame()
 
-            dataframe = pd.DataFrame(historical_data)
-            dataframe.transpose()
-
-            dataframe.columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
-            dataframe['datetime'] = dataframe.timestamp.apply(
-                lambda x: pd.to_datetime(datetime.fromtimestamp(x / 1000).strftime('%c'))
-            )
-
-            dataframe.set_index('datetime', inplace=True, drop=True)
-            dataframe.drop('timestamp', axis=1, inplace=True)
-
-            return dataframe
-
-        self.asset_symbol = asset_symbol
+        if isinstance(ohlcv, dict):
+            self.asset_symbols = list(ohlcv.keys())
+        else:
+            self.asset_symbols = [asset_symbol]
+            if ohlcv is not None: ohlcv = {asset_symbol: ohlcv}
+        self.asset_symbol = self.asset_symbols[0]
         self.frequency = frequency
+        self.allocation = allocation
+
+        base_seconds = 60 if frequency == 'minute' else 60 * 60 * 24
+        self.history_frequency = '1m' if frequency == 'minute' else '1d'
+        self.interval = interval or self.history_frequency
+        if interval_to_seconds(self.interval) % base_seconds:
+            raise ValueError("interval {} is not a multiple of the {} data frequency".format(self.interval, frequency))
+        self.bars_per_candle = interval_to_seconds(self.interval) // base_seconds
+        # zipline slippage model used by initialize_, i.e. fill_simulator.OrderBookSlippage;
+        # None falls back to VolumeShareSlippage
+        self.slippage_model = None
 
         if ohlcv is not None:
-            ohlcv_df = convert_to_dataframe(ohlcv)
             data = OrderedDict()
-            temp = ohlcv_df
-            if frequency =='daily':
-                temp.index = list(map(lambda x: x.replace(hour=0, minute=0, second=0, microsecond=0), ohlcv_df.close.index))
-            data[self.asset_symbol] = temp
+            for asset_symbol_ in self.asset_symbols:
+                temp = convert_to_dataframe(ohlcv[asset_symbol_])
+                if frequency =='daily':
+                    temp.index = temp.index.normalize()
+                data[asset_symbol_] = temp
+            if len(data) > 1:
+                data = self._align(data)
             #TODO: Panel is deprecated, Panel data might be discarded in later version of zipline
             self.panel = pd.Panel(data)
             self.panel.minor_axis = ['open', 'high', 'low', 'close', 'volume']
 
 
 
+    @classmethod
+    def from_db(cls,exchange,market_pairs,interval='1m',start=None,end=None,frequency='minute',chunksize=100000,**kwargs):
+        """
+        Build a backtest from candles stored in the OHLCV table
+
+        Rows are streamed chunk by chunk into float32/int64 arrays, so the only full copy of the
+        history is the compact one handed to zipline.
+
+        :param market_pairs: a market pair or a list of market pairs, i.e. BTC/USD
+        :param interval: stored interval to load
+        :param start: optional, timestamp in milliseconds
+        :param end: optional, timestamp in milliseconds
+        :param kwargs: passed on to the constructor, i.e. interval the strategy trades on
+        """
+        if isinstance(market_pairs, str):
+            market_pairs = [market_pairs]
+        ohlcv = OrderedDict((market_pair.split('/')[0],
+                             Candles.from_db(exchange, market_pair, interval, start, end, chunksize))
+                            for market_pair in market_pairs)
+        return cls(ohlcv, frequency=frequency, **kwargs)
+
+    @classmethod
+    def from_export(cls,root,exchange,market_pairs,interval='1m',start=None,end=None,frequency='minute',**kwargs):
+        """
+        Build a backtest from OHLCV files written by market.export.export_table
+
+        :param root: export directory
+        :param market_pairs: a market pair or a list of market pairs, i.e. BTC/USD
+        :param kwargs: passed on to the constructor
+        """
+        from market.export import load_ohlcv
+        if isinstance(market_pairs, str):
+            market_pairs = [market_pairs]
+        ohlcv = OrderedDict((market_pair.split('/')[0], load_ohlcv(root, exchange, market_pair, interval, start, end))
+                            for market_pair in market_pairs)
+        return cls(ohlcv, frequency=frequency, **kwargs)
+
+    def history(self,data,assets,fields,bar_count):
+        """
+        data.history at the strategy interval
+
+        :param data: zipline BarData
+        :param assets: asset or list of assets
+        :param fields: field or list of fields
+        :param bar_count: number of candles of the strategy interval
+        :return: same shape data.history would return for bar_count candles
+        """
+        window = data.history(assets, fields, bar_count * self.bars_per_candle, self.history_frequency)
+        if self.bars_per_candle == 1:
+            return window
+        return aggregate_window(window, self.bars_per_candle, fields if isinstance(fields, str) else None)
+
+    @staticmethod
+    def _align(data):
+        """
+        Align several OHLCV frames on the union of their bars
+
+        Missing bars carry the last close forward with zero volume; bars before an asset's
+        first candle stay NaN so the strategy skips the asset until it starts trading.
+
+        :param data: OrderedDict {asset_symbol: DataFrame}
+        :return: OrderedDict {asset_symbol: DataFrame} sharing one index
+        """
+        index = None
+        for frame in data.values():
+            index = frame.index if index is None else index.union(frame.index)
+        aligned = OrderedDict()
+        for asset_symbol, frame in data.items():
+            frame = frame[~frame.index.duplicated(keep='last')].reindex(index)
+            frame['close'] = frame['close'].ffill()
+            for col in ['open', 'high', 'low']:
+                frame[col] = frame[col].fillna(frame['close'])
+            frame['volume'] = frame['volume'].fillna(0)
+            aligned[asset_symbol] = frame
+        return aligned
+
+    def _weights(self):
+        """
+        :return: dict {asset_symbol: target weight}, or None for fixed-size orders
+        """
+        if self.allocation is None:
+            return None
+        if self.allocation == 'equal':
+            return {asset_symbol: 1.0 / len(self.asset_symbols) for asset_symbol in self.asset_symbols}
+        missing = set(self.asset_symbols) - set(self.allocation)
+        if missing:
+            raise KeyError("no allocation for {}".format(sorted(missing)))
+        if sum(self.allocation.values()) > 1:
+            raise ValueError("allocation weights add up to more than 1")
+        return dict(self.allocation)
+
     def initialize_(self,params_list,commission_cost,*args,**kwargs):
         """
 
@@ -75,18 +226,24 @@ class Backtest_Optim:
 
         :return: a complete run_algorithm function to be run
         """
-        asset_symbol = self.asset_symbol
+        from zipline.api import symbol
+        from zipline.finance import commission, slippage
 
+        asset_symbols = self.asset_symbols
+        weights = self._weights()
+        slippage_model = self.slippage_model if self.slippage_model is not None else slippage.VolumeShareSlippage()
 
         def initialize(context):
-            context.asset = symbol(asset_symbol)
+            context.assets = [symbol(asset_symbol) for asset_symbol in asset_symbols]
+            context.asset = context.assets[0]
+            context.weights = weights
 
-            # To keep track of whether we invested in the stock or not
-            context.invested = False
+            # To keep track of whether we invested in each asset or not
+            context.invested = {asset: False for asset in context.assets}
 
             # Explicitly set the commission/slippage to the "old" value until we can
             context.set_commission(commission.PerShare(**commission_cost))
-            context.set_slippage(slippage.VolumeShareSlippage())
+            context.set_slippage(slippage_model)
             context.params = params_list
         self.initialize = initialize
         return initialize
@@ -103,66 +260,74 @@ class Backtest_Optim:
             self.handle_data = handle_data_func
             return handle_data_func
         else:
+            from zipline.api import record
 
             def handle_data(context, data):
                 required_params = ['trailing_window','ema_s','ema_l','bb']
                 if not all(param in context.params for param in required_params):
                     raise KeyError("incorrect parameter list")
-                trailing_window = data.history(context.asset, 'close', context.params['trailing_window'], '1d')
-                if trailing_window.isnull().values.any():
-                    return
-                ema_s = EMA(trailing_window.values, timeperiod=context.params['ema_s'])
-                ema_l = EMA(trailing_window.values, timeperiod=context.params['ema_l'])
-                bb = BBANDS(trailing_window.values,timeperiod = context.params['bb'])
-
-
-                buy = False
-                sell = False
-                buy_signal = (ema_s[-1] > ema_l[-1]) and (trailing_window.values[-1]>(bb[1][-1])) and  (trailing_window.values[-1]>ema_s[-1])
-
-                if buy_signal and not context.invested:
-                    order(context.asset, 100)
-                    context.invested = True
-                    buy = True
-
-                elif not buy_signal and context.invested:
-                    order(context.asset, -100)
-                    context.invested = False
-                    sell = True
-
-                record(BTC=data.current(context.asset, "price"),
-                       ema_s=ema_s[-1],
-                       ema_l=ema_l[-1],
-                       bb = bb[1][-1],
-                       buy=buy,
-                       sell=sell)
+                # one history call for every asset keeps multi-asset runs to a single simulation loop
+                trailing_window = self.history(data, context.assets, 'close', context.params['trailing_window'])
+                prices = data.current(context.assets, 'price')
+
+                buy = 0
+                sell = 0
+                indicators = None
+                for asset in context.assets:
+                    closes = trailing_window[asset].values
+                    if pd.isnull(closes).any():
+                        continue
+                    ema_s = EMA(closes, timeperiod=context.params['ema_s'])
+                    ema_l = EMA(closes, timeperiod=context.params['ema_l'])
+                    bb = BBANDS(closes,timeperiod = context.params['bb'])
+                    indicators = {'ema_s': ema_s[-1], 'ema_l': ema_l[-1], 'bb': bb[1][-1]}
+
+                    buy_signal = (ema_s[-1] > ema_l[-1]) and (closes[-1]>(bb[1][-1])) and  (closes[-1]>ema_s[-1])
+
+                    if place_signal_order(context, asset, buy_signal):
+                        if buy_signal: buy += 1
+                        else: sell += 1
+
+                recorded = {asset.symbol: prices[asset] for asset in context.assets}
+                if len(context.assets) == 1:
+                    if indicators is None:
+                        return
+                    recorded.update(indicators)
+                    record(buy=buy > 0, sell=sell > 0, **recorded)
+                else:
+                    record(buy=buy, sell=sell, **recorded)
 
             self.handle_data= handle_data
 
             return handle_data
 
 
-    def run_algorithm(self,params_list,capital_base=800000,exchange_calendar=TFSExchangeCalendar(),**kwargs):
+    def run_algorithm(self,params_list,capital_base=800000,exchange_calendar=None,**kwargs):
         #TODO: sortino ratio warning, suppress?
         """
 
         :param params_list: list of parameter to be used for the strategy
         :param capital_base: optional. Money to start with
-        :param exchange_calendar: TradingCalendar
+        :param exchange_calendar: optional TradingCalendar, the 24/7 TFS calendar over the data by default
         :return: return from zipline.run_algorithm()
         """
-
-
+        import zipline
+        from logics.strategies.trading_calendar import get_calendar
 
         if 'trailing_window' not in params_list:
             raise KeyError('data history parameter missing')
 
-        if self.panel[self.asset_symbol].index[params_list['trailing_window']].tzinfo:
-            self.start_session = self.panel[self.asset_symbol].index[params_list['trailing_window']].tz_convert('UTC').to_pydatetime()
+        # the first bar with a full trailing window behind it
+        warmup = params_list['trailing_window'] * self.bars_per_candle
+        if self.panel[self.asset_symbol].index[warmup].tzinfo:
+            self.start_session = self.panel[self.asset_symbol].index[warmup].tz_convert('UTC').to_pydatetime()
             self.end_session = self.panel[self.asset_symbol].index[-1].tz_convert('utc').to_pydatetime()
         else:
-            self.start_session= self.panel[self.asset_symbol].index[params_list['trailing_window']].tz_localize('utc').to_pydatetime()
+            self.start_session= self.panel[self.asset_symbol].index[warmup].tz_localize('utc').to_pydatetime()
             self.end_session = self.panel[self.asset_symbol].index[-1].tz_localize('utc').to_pydatetime()
+        if exchange_calendar is None:
+            # sessions only for the data at hand, history before the first bar included
+            exchange_calendar = get_calendar(self.panel[self.asset_symbol].index[0], self.end_session)
 
         result = zipline.run_algorithm(start = self.start_session,\
                       end = self.end_session,\
@@ -172,10 +337,53 @@ class Backtest_Optim:
                       capital_base=capital_base,\
                       data_frequency = self.frequency,\
                       trading_calendar=exchange_calendar,**kwargs,)
-
+        self.capital_base = capital_base
 
         return result
 
+    def asset_performance(self,perf):
+        """
+        Break the portfolio result of run_algorithm down by asset
+
+        :param perf: DataFrame returned by run_algorithm
+        :return: (DataFrame of daily pnl per asset, DataFrame summary per asset with
+            [pnl, return, trades, final_amount, final_value, sharpe])
+        """
+        import numpy as np
+
+        cash_flow = pd.DataFrame(0.0, index=perf.index, columns=self.asset_symbols)
+        market_value = pd.DataFrame(0.0, index=perf.index, columns=self.asset_symbols)
+        final_amount = {}
+        trades = dict.fromkeys(self.asset_symbols, 0)
+
+        for dt, transactions, positions in zip(perf.index, perf.transactions, perf.positions):
+            for txn in transactions:
+                asset_symbol = txn['sid'].symbol
+                cash_flow.at[dt, asset_symbol] -= txn['amount'] * txn['price'] + (txn.get('commission') or 0)
+                trades[asset_symbol] += 1
+            final_amount = dict.fromkeys(self.asset_symbols, 0)
+            for pos in positions:
+                asset_symbol = pos['sid'].symbol
+                market_value.at[dt, asset_symbol] = pos['amount'] * pos['last_sale_price']
+                final_amount[asset_symbol] = pos['amount']
+
+        pnl = cash_flow.cumsum() + market_value
+        daily_pnl = pnl.diff().fillna(pnl.iloc[0])
+
+        weights = self._weights() or dict.fromkeys(self.asset_symbols, 1.0 / len(self.asset_symbols))
+        summary = pd.DataFrame(index=self.asset_symbols)
+        summary['pnl'] = pnl.iloc[-1]
+        summary['return'] = [pnl[a].iloc[-1] / (self.capital_base * weights[a]) if weights[a] else np.nan
+                             for a in self.asset_symbols]
+        summary['trades'] = pd.Series(trades)
+        summary['final_amount'] = pd.Series(final_amount)
+        summary['final_value'] = market_value.iloc[-1]
+        # annualized on the daily pnl of the capital allocated to the asset
+        summary['sharpe'] = [daily_pnl[a].mean() / daily_pnl[a].std() * np.sqrt(252) if daily_pnl[a].std() else np.nan
+                             for a in self.asset_symbols]
+
+        return daily_pnl, summary.sort_values('pnl', ascending=False)
+
     def optim_algo(self,params_grid):
         """
         Optimize strategy performance measured sharpe ratio
@@ -219,9 +427,10 @@ class Backtest_Optim:
         """
         refit the strategy using given parameters and return signals
 
-        :param ohlcv: a DataFrame object with OHLCV columns ordered by date, ascending
+        :param ohlcv: Candles ordered by date, ascending
         :param params: optimal parameters
         :ba: bid ask spread
+        :param indicator_cache: optional IndicatorCache shared with the other strategies of the cycle
         :return: signal
         """
 
@@ -229,18 +438,20 @@ class Backtest_Optim:
         if not all(param in params for param in required_params):
             raise KeyError("incorrect parameters")
         lookback = params['trailing_window']
-        close = ohlcv['close']
-        ema_s = EMA(close[-lookback:], timeperiod=params['ema_s'])
-        ema_l = EMA(close[-lookback:], timeperiod=params['ema_l'])
-        bb = BBANDS(close[-lookback:], timeperiod=params['bb'])
-        if ba in None:
-            buy_signal = (ema_s > ema_l) and (close[-1] > (bb[1])) and (
+        key = series_key(ohlcv, lookback)
+        cache = kwargs.get('indicator_cache')
+        close, = ohlcv[-lookback:].as_double('close')
+        ema_s = cached_indicator(cache, key, EMA, close, timeperiod=params['ema_s'])[-1]
+        ema_l = cached_indicator(cache, key, EMA, close, timeperiod=params['ema_l'])[-1]
+        bb = cached_indicator(cache, key, BBANDS, close, timeperiod=params['bb'])[1][-1]
+        if ba is None:
+            buy_signal = (ema_s > ema_l) and (close[-1] > bb) and (
                     close[-1] > ema_s)
         else:
             bid = ba['bid']
             ask = ba['ask']
             mid = (bid[-1]+ask[-1])/2
-            buy_signal = (ema_s > ema_l) and (mid > (bb[1])) and (
+            buy_signal = (ema_s > ema_l) and (mid > bb) and (
                     mid > ema_s)
 
 
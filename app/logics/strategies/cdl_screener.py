@@ -0,0 +1,110 @@
+# Screen many markets for every talib candlestick pattern in one pass
+
+import logging
+import os
+from multiprocessing.pool import Pool
+import numpy as np
+import pandas as pd
+import talib
+
+from market.candles import Candles
+
+logger = logging.getLogger(__name__)
+
+CDL_PATTERNS = [name for name in dir(talib) if name.startswith('CDL')]
+
+SCREEN_COLUMNS = ['exchange', 'symbol', 'interval', 'pattern', 'latest', 'latest_timestamp', 'bars_since',
+                  'hits', 'hit_rate', 'mean_return']
+
+
+def _load(dataset, start, end, export_root):
+    if isinstance(dataset, Candles):
+        return dataset
+    exchange, symbol, interval = dataset
+    if export_root is not None:
+        from market.export import load_ohlcv
+        return load_ohlcv(export_root, exchange, symbol, interval, start, end)
+    return Candles.from_db(exchange, symbol, interval, start, end)
+
+
+def screen_candles(candles, patterns=None, horizon=5, recent=3):
+    """
+    Evaluate candlestick patterns on one market
+
+    A hit is a bar where the pattern fires; it counts as right when the close horizon bars
+    later moved in the direction of the signal (up for bullish, down for bearish).
+
+    :param candles: Candles, ascending
+    :param patterns: talib function names, all CDL* functions by default
+    :param horizon: bars after a hit over which its forward return is measured
+    :param recent: a pattern that fired within the last recent bars is reported as latest
+    :return: list of dicts with SCREEN_COLUMNS
+    """
+    patterns = patterns or CDL_PATTERNS
+    # talib wants contiguous float64; convert once for all patterns
+    open_, high, low, close = candles.as_double('open', 'high', 'low', 'close')
+    n = len(close)
+    forward = np.full(n, np.nan)
+    if n > horizon:
+        forward[:-horizon] = close[horizon:] / close[:-horizon] - 1
+
+    rows = []
+    for name in patterns:
+        signal = getattr(talib, name)(open_, high, low, close)
+        fired = np.flatnonzero(signal)
+        direction = np.sign(signal[fired])
+        scored = ~np.isnan(forward[fired])
+        signed = direction[scored] * forward[fired][scored]
+        last = fired[-1] if len(fired) else None
+        rows.append({'exchange': candles.exchange,
+                     'symbol': candles.symbol,
+                     'interval': candles.interval,
+                     'pattern': name,
+                     'latest': int(signal[last]) if last is not None and n - 1 - last < recent else 0,
+                     'latest_timestamp': int(candles.timestamp[last]) if last is not None else None,
+                     'bars_since': n - 1 - last if last is not None else None,
+                     'hits': len(fired),
+                     'hit_rate': float((signed > 0).mean()) if len(signed) else np.nan,
+                     'mean_return': float(signed.mean()) if len(signed) else np.nan})
+    return rows
+
+
+def _screen_one(args):
+    dataset, start, end, export_root, patterns, horizon, recent = args
+    try:
+        candles = _load(dataset, start, end, export_root)
+    except Exception as e:
+        logger.warning("Skipping {}: {}".format(dataset, e))
+        return []
+    if len(candles) == 0:
+        return []
+    return screen_candles(candles, patterns, horizon, recent)
+
+
+def screen(datasets, patterns=None, start=None, end=None, horizon=5, recent=3, min_hits=5,
+           export_root=None, processes=None, chunksize=None):
+    """
+    Screen many datasets for all candlestick patterns on a process pool
+
+    Each worker loads its dataset once (from the database, or memory mapped from exported files
+    when export_root is given) and runs every pattern over the same arrays; only the summary
+    rows travel back.
+
+    :param datasets: list of (exchange, symbol, interval) tuples or Candles
+    :param start: optional, timestamp in milliseconds (inclusive)
+    :param end: optional, timestamp in milliseconds (exclusive)
+    :param min_hits: patterns with fewer historical hits are ranked after the others
+    :return: DataFrame with SCREEN_COLUMNS, latest hits first, then by hit rate
+    """
+    tasks = [(dataset, start, end, export_root, patterns, horizon, recent) for dataset in datasets]
+    processes = processes or os.cpu_count()
+    chunksize = chunksize or max(1, len(tasks) // (4 * processes))
+    with Pool(processes) as pool:
+        rows = [row for result in pool.imap_unordered(_screen_one, tasks, chunksize) for row in result]
+
+    table = pd.DataFrame(rows, columns=SCREEN_COLUMNS)
+    table['reliable'] = table['hits'] >= min_hits
+    table['fired'] = table['latest'] != 0
+    table = table.sort_values(['fired', 'reliable', 'hit_rate', 'hits'], ascending=False) \
+        .drop(columns=['fired', 'reliable']).reset_index(drop=True)
+    return table
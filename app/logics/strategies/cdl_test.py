@@ -1,10 +1,11 @@
-from zipline.api import order, record
-from logics.strategies.backtest_optim import Backtest_Optim
+import numpy as np
+from logics.strategies.backtest_optim import Backtest_Optim, place_signal_order
+from logics.strategies.indicator_cache import cached_indicator, series_key
 
 class CDL_Test(Backtest_Optim):
 
-    def __init__(self, ohlcv=None, symbol='BTC', frequency='daily'):
-        super().__init__(ohlcv,symbol,frequency)
+    def __init__(self, ohlcv=None, symbol='BTC', frequency='daily', allocation=None, interval=None):
+        super().__init__(ohlcv,symbol,frequency,allocation,interval)
 
     # override the _handle_data method for different strategie
     def handle_data_(self,handle_data_func = None):
@@ -18,38 +19,39 @@ class CDL_Test(Backtest_Optim):
             self.handle_data = handle_data_func
             return handle_data_func
         else:
+            from zipline.api import record
 
             def handle_data(context, data) :
                 required_params = ['trailing_window','indicator']
                 if not all(param in context.params for param in required_params):
                     raise KeyError("incorrect parameter list")
-                trailing_window = data.history(context.asset, ['open','high','low','close'], context.params['trailing_window'], '1d')
-                if trailing_window.isnull().values.any():
-                    return
                 cdl_indicator = context.params['indicator']
-                candle_pattern = cdl_indicator(**trailing_window.to_dict(orient='series'))
-
-
-                buy = False
-                sell = False
-                buy_signal = candle_pattern[-1]>0
-                sell_sigal = candle_pattern[-1]<=0
-
-
-                if buy_signal and not context.invested:
-                    order(context.asset, 100)
-                    context.invested = True
-                    buy = True
-
-                elif sell_sigal and context.invested:
-                    order(context.asset, -100)
-                    context.invested = False
-                    sell = True
-
-                record(BTC=data.current(context.asset, "price"),
-                       ema_s=candle_pattern[-1],
-                       buy=buy,
-                       sell=sell)
+                prices = data.current(context.assets, 'price')
+
+                buy = 0
+                sell = 0
+                candle = None
+                for asset in context.assets:
+                    trailing_window = self.history(data, asset, ['open','high','low','close'], context.params['trailing_window'])
+                    if trailing_window.isnull().values.any():
+                        continue
+                    candle_pattern = cdl_indicator(*[trailing_window[col].values.astype(np.float64)
+                                                     for col in ['open', 'high', 'low', 'close']])
+                    candle = candle_pattern[-1]
+
+                    buy_signal = candle_pattern[-1]>0
+
+                    if place_signal_order(context, asset, buy_signal):
+                        if buy_signal: buy += 1
+                        else: sell += 1
+
+                recorded = {asset.symbol: prices[asset] for asset in context.assets}
+                if len(context.assets) == 1:
+                    if candle is None:
+                        return
+                    record(ema_s=candle, buy=buy > 0, sell=sell > 0, **recorded)
+                else:
+                    record(buy=buy, sell=sell, **recorded)
             self.handle_data= handle_data
             return handle_data
 
@@ -96,12 +98,13 @@ class CDL_Test(Backtest_Optim):
         if not all(param in params for param in required_params):
             raise KeyError("incorrect parameter list")
         lookback = params['trailing_window']
-        ohlcv= ohlcv[['open', 'high', 'low', 'close']].iloc[-lookback:,]
-        if ohlcv.isnull().values.any():
+        key = series_key(ohlcv, lookback)
+        prices = ohlcv[-lookback:].as_double('open', 'high', 'low', 'close')
+        if len(prices[0]) < lookback or np.isnan(prices).any():
             print("not enough data")
             return
         cdl_indicator = params['indicator']
-        candle_pattern = cdl_indicator(**ohlcv.to_dict(orient='series'))
+        candle_pattern = cached_indicator(kwargs.get('indicator_cache'), key, cdl_indicator, *prices)
 
         buy_signal = candle_pattern.tolist()[-1] > 0
         sell_sigal = candle_pattern.tolist()[-1] <= 0
@@ -0,0 +1,126 @@
+# Fill simulated orders against recorded or synthetic order books instead of a volume share
+
+import logging
+import numpy as np
+from zipline.finance.slippage import SlippageModel
+
+logger = logging.getLogger(__name__)
+
+
+def synthetic_books(candles, depth=10, spread=0.0005, level_step=0.0005, depth_share=0.05):
+    """
+    Order books around each candle's close, for markets without recorded books
+
+    :param candles: market.candles.Candles
+    :param spread: relative distance between best bid and best ask
+    :param level_step: relative distance between consecutive levels
+    :param depth_share: share of the candle's volume resting on each side, spread evenly over the levels
+    :return: dict shaped like market.orderbook_recorder.load_books
+    """
+    mid = candles.close.astype(np.float64)[:, None]
+    steps = spread / 2 + level_step * np.arange(depth)[None, :]
+    size = np.repeat((candles.volume.astype(np.float64) * depth_share / depth)[:, None], depth, axis=1)
+    return {'timestamp': candles.timestamp,
+            'bid_price': (mid * (1 - steps)).astype(np.float32),
+            'bid_size': size.astype(np.float32),
+            'ask_price': (mid * (1 + steps)).astype(np.float32),
+            'ask_size': size.astype(np.float32)}
+
+
+def fill_orders(books, timestamps, amounts, limit_prices=None, latency=0, queue_share=1.0):
+    """
+    Fill many orders at once, each walking the book level by level
+
+    An order sees the first snapshot at or after its timestamp plus latency. It takes
+    queue_share of the size displayed at each level, the rest being assumed to go to orders
+    ahead of it in the queue or other takers, and stops at its limit price. Whatever is left
+    is not filled.
+
+    :param books: dict from market.orderbook_recorder.load_books or synthetic_books
+    :param timestamps: array of order times in milliseconds
+    :param amounts: array of signed amounts, positive to buy
+    :param limit_prices: optional array of limit prices, NaN for market orders
+    :param latency: milliseconds between sending an order and it reaching the book
+    :param queue_share: share of each level's displayed size available to the orders
+    :return: (filled signed amounts, average fill prices, NaN where nothing filled)
+    """
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    amounts = np.asarray(amounts, dtype=np.float64)
+    filled = np.zeros(len(amounts))
+    avg_price = np.full(len(amounts), np.nan)
+
+    idx = np.searchsorted(books['timestamp'], timestamps + latency, side='left')
+    live = idx < len(books['timestamp'])
+    if not live.any():
+        return filled, avg_price
+    idx = idx[live]
+    buy = amounts[live] > 0
+    price = np.where(buy[:, None], books['ask_price'][idx], books['bid_price'][idx]).astype(np.float64)
+    size = np.where(buy[:, None], books['ask_size'][idx], books['bid_size'][idx]).astype(np.float64)
+    size = np.nan_to_num(size) * queue_share
+    if limit_prices is not None:
+        limit = np.asarray(limit_prices, dtype=np.float64)[live][:, None]
+        marketable = np.isnan(limit) | np.where(buy[:, None], price <= limit, price >= limit)
+        size = np.where(marketable, size, 0)
+
+    # size taken from each level: what is left of the order once the better levels are used up
+    ahead = np.cumsum(size, axis=1) - size
+    taken = np.clip(np.abs(amounts[live])[:, None] - ahead, 0, size)
+    total = taken.sum(axis=1)
+    notional = np.where(taken > 0, taken * np.nan_to_num(price), 0).sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        avg_price[live] = np.where(total > 0, notional / total, np.nan)
+    filled[live] = np.where(buy, total, -total)
+    return filled, avg_price
+
+
+class OrderBookSlippage(SlippageModel):
+    """
+    zipline slippage model filling orders against order books, see fill_orders
+
+    Set it as Backtest_Optim.slippage_model. Orders are filled against the book of their
+    asset at the bar's time plus latency; what the book can't absorb stays open for the next
+    bar, like zipline does with volume limited fills.
+    """
+
+    def __init__(self, books, latency=0, queue_share=1.0):
+        """
+        :param books: dict of asset symbol: books, or the books of a single asset
+        :param latency: milliseconds between an order and it reaching the book
+        :param queue_share: share of each level's displayed size available to the strategy
+        """
+        super(OrderBookSlippage, self).__init__()
+        self.books = books if 'timestamp' not in books else {None: books}
+        self.latency = latency
+        self.queue_share = queue_share
+
+    def process_order(self, data, order):
+        books = self.books.get(order.asset.symbol, self.books.get(None))
+        if books is None:
+            return None, None
+        timestamp = data.current_dt.value // 10 ** 6
+        filled, price = fill_orders(books, [timestamp], [order.open_amount],
+                                    [order.limit if order.limit is not None else np.nan],
+                                    self.latency, self.queue_share)
+        if filled[0] == 0:
+            return None, None
+        # zipline takes whole units of the asset
+        amount = int(filled[0])
+        if amount == 0:
+            return None, None
+        return float(price[0]), amount
+
+
+def backtest_signals(books, timestamps, amounts, limit_prices=None, latency=0, queue_share=1.0, fee=0.0):
+    """
+    Vectorized backtest of a sequence of orders, i.e. a strategy's signals sized by Order_Control
+
+    Orders are filled independently with fill_orders; the book is not depleted by earlier orders.
+
+    :param fee: proportional fee on the filled notional
+    :return: dict of filled amounts, average prices, position and cash after each order
+    """
+    filled, price = fill_orders(books, timestamps, amounts, limit_prices, latency, queue_share)
+    notional = np.where(filled != 0, filled * np.nan_to_num(price), 0)
+    cash = -np.cumsum(notional + np.abs(notional) * fee)
+    return {'filled': filled, 'price': price, 'position': np.cumsum(filled), 'cash': cash}
@@ -0,0 +1,101 @@
+# memoize indicator outputs so strategies voting on the same candles compute each indicator once
+
+import logging
+from collections import OrderedDict
+from multiprocessing.managers import BaseManager
+from threading import Lock
+
+from market.candles import Candles
+
+logger = logging.getLogger(__name__)
+
+
+class IndicatorCache:
+    """
+    LRU cache of indicator results keyed by (series key, indicator, parameters)
+
+    The series key identifies the input window, i.e. (exchange, symbol, interval, last candle
+    timestamp, window length), so a new candle naturally produces new keys and stale
+    entries age out through LRU eviction.
+    """
+
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self._store = OrderedDict()
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._store:
+                self.misses += 1
+                return None
+            self._store.move_to_end(key)
+            self.hits += 1
+            return self._store[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._store[key] = value
+            self._store.move_to_end(key)
+            while len(self._store) > self.maxsize:
+                self._store.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'size': len(self._store), 'hits': self.hits, 'misses': self.misses}
+
+
+class IndicatorCacheManager(BaseManager):
+    """Serves one IndicatorCache to every strategy worker process"""
+    pass
+
+
+IndicatorCacheManager.register('IndicatorCache', IndicatorCache)
+
+
+def start_shared_cache(maxsize=512):
+    """
+    :return: (started manager, proxy to an IndicatorCache that can be passed to pool workers)
+    """
+    manager = IndicatorCacheManager()
+    manager.start()
+    return manager, manager.IndicatorCache(maxsize)
+
+
+def series_key(ohlcv, lookback):
+    """
+    Identity and version of the trailing window a strategy computes on
+
+    :param ohlcv: Candles from datafeed.get_latest_data_from_db, or a DataFrame with the OHLCV table columns, ascending
+    :param lookback: length of the trailing window
+    :return: tuple, or None if the candles do not say which market they belong to
+    """
+    if isinstance(ohlcv, Candles):
+        if ohlcv.exchange is None or not len(ohlcv):
+            return None
+        return (ohlcv.exchange, ohlcv.symbol, ohlcv.interval, int(ohlcv.timestamp[-1]), min(lookback, len(ohlcv)))
+    if not all(col in ohlcv.columns for col in ['exchange', 'symbol', 'interval', 'timestamp']) or ohlcv.empty:
+        return None
+    last = ohlcv.iloc[-1]
+    return (last['exchange'], last['symbol'], last['interval'], int(last['timestamp']), min(lookback, len(ohlcv)))
+
+
+def cached_indicator(cache, key, indicator, *inputs, **params):
+    """
+    Compute indicator(*inputs, **params), or reuse the result another strategy already computed
+
+    :param cache: IndicatorCache, a proxy to one, or None to always compute
+    :param key: series_key of the inputs; None disables caching
+    :param indicator: a talib function
+    :return: the indicator output
+    """
+    if cache is None or key is None:
+        return indicator(*inputs, **params)
+    cache_key = (key, indicator.__name__, tuple(sorted(params.items())))
+    result = cache.get(cache_key)
+    if result is None:
+        result = indicator(*inputs, **params)
+        cache.put(cache_key, result)
+    return result
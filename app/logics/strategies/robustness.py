@@ -0,0 +1,163 @@
+# Monte Carlo robustness testing of optimized strategy parameters
+
+import logging
+import os
+from multiprocessing.pool import Pool
+import numpy as np
+import pandas as pd
+
+from market.candles import Candles
+logger = logging.getLogger(__name__)
+
+METHODS = ('block_bootstrap', 'fill_perturbation', 'both')
+
+# state shared by every task of a pool worker, set once by _init_worker so that
+# the OHLCV series and the strategy are pickled once per process instead of once per resample
+_worker = {}
+
+
+def block_bootstrap(ohlcv, block_size=20, random_state=None):
+    """
+    Moving block bootstrap of an OHLCV series
+
+    Bars are resampled in blocks of consecutive log returns so that short-range
+    autocorrelation survives. Open/high/low are kept relative to the close of the
+    bar they came from, so every resampled candle stays internally consistent.
+    Timestamps are left untouched.
+
+    :param ohlcv: Candles, or list of [timestamp, open, high, low, close, volume], ascending, as returned by ccxt
+    :param block_size: number of consecutive bars in each block
+    :param random_state: int or numpy.random.RandomState
+    :return: resampled ohlcv of the same type as the input
+    """
+    rng = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(random_state)
+    if isinstance(ohlcv, Candles):
+        bars = np.column_stack([ohlcv.timestamp] + ohlcv.as_double('open', 'high', 'low', 'close', 'volume'))
+    else:
+        bars = np.asarray(ohlcv, dtype=np.float64)
+    n = len(bars)
+    if n < 3:
+        raise ValueError("At least 3 bars are required to bootstrap a series")
+    block_size = max(1, min(block_size, n - 1))
+
+    close = bars[:, 4]
+    log_ret = np.diff(np.log(close))
+    # shape of each candle relative to its own close
+    ratios = bars[1:, 1:4] / close[1:, None]
+    volume = bars[1:, 5]
+
+    n_blocks = int(np.ceil((n - 1) / block_size))
+    starts = rng.randint(0, n - block_size, size=n_blocks)
+    idx = (starts[:, None] + np.arange(block_size)).ravel()[:n - 1]
+
+    new_close = close[0] * np.exp(np.cumsum(log_ret[idx]))
+    resampled = np.empty_like(bars)
+    resampled[0] = bars[0]
+    resampled[1:, 0] = bars[1:, 0]
+    resampled[1:, 1:4] = ratios[idx] * new_close[:, None]
+    resampled[1:, 4] = new_close
+    resampled[1:, 5] = volume[idx]
+    if isinstance(ohlcv, Candles):
+        return Candles(*resampled.T, **ohlcv.meta)
+    return resampled.tolist()
+
+
+def perturbed_slippage(random_state=None, price_impact=(0.05, 0.2), volume_limit=(0.01, 0.05)):
+    """
+    Draw a zipline VolumeShareSlippage model with randomized impact and volume limit
+
+    :param random_state: int or numpy.random.RandomState
+    :param price_impact: (low, high) range of the price impact coefficient
+    :param volume_limit: (low, high) range of the share of bar volume an order may take
+    :return: zipline.finance.slippage.VolumeShareSlippage
+    """
+    from zipline.finance import slippage
+    rng = random_state if isinstance(random_state, np.random.RandomState) else np.random.RandomState(random_state)
+    return slippage.VolumeShareSlippage(volume_limit=rng.uniform(*volume_limit),
+                                        price_impact=rng.uniform(*price_impact))
+
+
+def _init_worker(strategy_cls, ohlcv, params, asset_symbol, frequency, options):
+    _worker.update(strategy_cls=strategy_cls, ohlcv=ohlcv, params=params,
+                   asset_symbol=asset_symbol, frequency=frequency, options=options)
+
+
+def _run_resample(task):
+    """Run one resample inside a pool worker and return its summary statistics"""
+    seed, method = task
+    options = _worker['options']
+    rng = np.random.RandomState(seed)
+
+    ohlcv = _worker['ohlcv']
+    if method in ('block_bootstrap', 'both'):
+        ohlcv = block_bootstrap(ohlcv, options['block_size'], rng)
+
+    strategy = _worker['strategy_cls'](ohlcv, _worker['asset_symbol'], _worker['frequency'])
+    if method in ('fill_perturbation', 'both'):
+        strategy.slippage_model = perturbed_slippage(rng, options['price_impact'], options['volume_limit'])
+
+    try:
+        perf = strategy.run_algorithm(params_list=_worker['params'])
+    except Exception as e:
+        logger.warning("Resample %d failed: %s" % (seed, e))
+        return {'seed': seed, 'sharpe': np.nan, 'max_drawdown': np.nan, 'total_return': np.nan}
+
+    return {'seed': seed,
+            'sharpe': perf.sharpe.iloc[-1],
+            'max_drawdown': perf.max_drawdown.iloc[-1],
+            'total_return': perf.algorithm_period_return.iloc[-1]}
+
+
+def robustness_test(strategy_cls, ohlcv, params, n_resamples=1000, method='both', block_size=20,
+                    price_impact=(0.05, 0.2), volume_limit=(0.01, 0.05), asset_symbol='BTC',
+                    frequency='daily', processes=None, seed=0, chunksize=None):
+    """
+    Re-run a strategy with fixed parameters over many resampled variants of the OHLCV series
+
+    :param strategy_cls: Backtest_Optim subclass, i.e. CDL_Test
+    :param ohlcv: Candles or list of [timestamp, open, high, low, close, volume] the parameters were optimized on
+    :param params: the best parameters returned by optim_algo
+    :param n_resamples: number of resampled paths
+    :param method: 'block_bootstrap', 'fill_perturbation' or 'both'
+    :param block_size: block length for the bootstrap
+    :param price_impact: (low, high) range for the perturbed slippage price impact
+    :param volume_limit: (low, high) range for the perturbed slippage volume limit
+    :param processes: number of worker processes, defaults to the number of cores
+    :param seed: base seed; resample i uses seed + i so runs are reproducible
+    :param chunksize: tasks handed to a worker at once, defaults to an even split across workers
+    :return: (DataFrame with one row per resample, DataFrame summarizing the distribution)
+    """
+    if method not in METHODS:
+        raise ValueError("method must be one of {}".format(METHODS))
+
+    options = {'block_size': block_size, 'price_impact': price_impact, 'volume_limit': volume_limit}
+    tasks = [(seed + i, method) for i in range(n_resamples)]
+
+    processes = processes or os.cpu_count() or 1
+    if chunksize is None:
+        chunksize = max(1, n_resamples // (4 * processes))
+
+    pool = Pool(processes=processes, initializer=_init_worker,
+                initargs=(strategy_cls, ohlcv, params, asset_symbol, frequency, options))
+    try:
+        results = list(pool.imap_unordered(_run_resample, tasks, chunksize=chunksize))
+    finally:
+        pool.close()
+        pool.join()
+
+    distribution = pd.DataFrame(results).sort_values('seed').reset_index(drop=True)
+    summary = summarize(distribution)
+    logger.info("Robustness test over %d resamples: median sharpe %.2f, 5%% sharpe %.2f, median max drawdown %.2f"
+                % (n_resamples, summary.loc['50%', 'sharpe'], summary.loc['5%', 'sharpe'],
+                   summary.loc['50%', 'max_drawdown']))
+    return distribution, summary
+
+
+def summarize(distribution, percentiles=(0.05, 0.25, 0.5, 0.75, 0.95)):
+    """
+    :param distribution: DataFrame returned by robustness_test
+    :return: DataFrame of distribution statistics of sharpe, max drawdown and total return
+    """
+    stats = distribution[['sharpe', 'max_drawdown', 'total_return']].describe(percentiles=list(percentiles))
+    stats.loc['failed'] = distribution[['sharpe', 'max_drawdown', 'total_return']].isnull().sum()
+    return stats
@@ -0,0 +1,114 @@
+# The 24/7 trading calendar backtests run on, built for the range a backtest covers
+# rather than registered for a century at import time
+
+import datetime as dt
+from pytz import timezone
+import numpy as np
+import pandas as pd
+from pandas.tseries.offsets import CustomBusinessDay
+from trading_calendars import register_calendar, TradingCalendar
+from zipline.utils.memoize import lazyval
+
+
+class TFSExchangeCalendar(TradingCalendar):
+    """
+    An exchange calendar for trading assets 24/7.
+
+    Open Time: 12AM, UTC
+    Close Time: 11:59PM, UTC
+
+    Every day is a session and sessions run back to back, so the minutes of the calendar are
+    one contiguous range generated arithmetically instead of session by session. Build it over
+    the dates a backtest needs, see get_calendar.
+    """
+
+    @property
+    def name(self):
+        """
+        The name of the exchange, which Zipline will look for
+        when we run our algorithm and pass TFS to
+        the --trading-calendar CLI flag.
+        """
+        return "TFS"
+
+    @property
+    def tz(self):
+        """
+        The timezone in which we'll be running our algorithm.
+        """
+        return timezone("UTC")
+
+    @property
+    def open_time(self):
+        """
+        The time in which our exchange will open each day.
+        """
+        return dt.time(0,0)
+
+    @property
+    def close_time(self):
+        """
+        The time in which our exchange will close each day.
+        """
+        return dt.time(23, 59)
+
+    @lazyval
+    def day(self):
+        """
+        The days on which our exchange will be open.
+        """
+        weekmask = "Mon Tue Wed Thu Fri Sat Sun"
+        return CustomBusinessDay(
+            weekmask=weekmask
+        )
+
+    @lazyval
+    def all_minutes_nanos(self):
+        """
+        Every minute from the first open to the last close in epoch nanoseconds, 1440 per session
+        """
+        return np.arange(self.schedule['market_open'].iloc[0].value,
+                         self.schedule['market_close'].iloc[-1].value + 1,
+                         60 * 10 ** 9, dtype=np.int64)
+
+    @lazyval
+    def all_minutes(self):
+        """
+        all_minutes_nanos as a DatetimeIndex
+        """
+        return pd.to_datetime(self.all_minutes_nanos, utc=True)
+
+
+# the range get_calendar covers when it isn't given one
+start_session = pd.Timestamp('2000-01-07', tz='utc')
+end_session = pd.Timestamp('2099-12-31', tz='utc')
+
+_calendar = None
+
+
+def _session(timestamp):
+    timestamp = pd.Timestamp(timestamp)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.tz_convert('UTC').normalize()
+
+
+def get_calendar(start=None, end=None):
+    """
+    The TFS calendar covering start to end, registered under 'TFS'
+
+    The calendar of the last call is reused while it covers the range asked for, a new one is
+    built over the days from start to end otherwise, with a day to spare on either side for
+    zipline's previous and next session lookups.
+
+    :param start: optional, first datetime the backtest needs, including history before its first bar
+    :param end: optional, last datetime of the backtest
+    :return: TFSExchangeCalendar
+    """
+    global _calendar
+    start = _session(start) - pd.Timedelta(days=1) if start is not None else start_session
+    end = _session(end) + pd.Timedelta(days=1) if end is not None else end_session
+    if _calendar is None or start < _calendar.first_session or end > _calendar.last_session:
+        _calendar = TFSExchangeCalendar(start=start, end=end)
+        register_calendar('TFS', _calendar, force=True)
+    return _calendar
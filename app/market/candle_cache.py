@@ -0,0 +1,60 @@
+# Process-local cache of the latest candles per market, fed by the ticker as it writes
+
+from threading import Lock
+import logging
+
+from market.candles import Candles
+
+logger = logging.getLogger(__name__)
+
+
+class CandleCache:
+    """
+    Fixed-size ring of the last candles per (exchange, symbol, interval)
+
+    Only the ticker feeds the cache, starting with its backfill, so a market is warm exactly
+    when this process is the one writing its candles and the ring holds everything stored
+    since. Other processes see the market as cold and read the database.
+
+    Each ring is a Candles appended in place and cut back to the last capacity candles once it
+    holds twice as many, so appends stay amortized O(1) and reads are zero-copy slices.
+    """
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._rings = {}
+        self._lock = Lock()
+
+    def extend(self, exchange, market_pair, interval, records):
+        """
+        :param records: Candles, or OHLCV table records (dicts), ascending
+        """
+        key = (exchange, market_pair, interval)
+        with self._lock:
+            ring = self._rings.get(key)
+            if ring is None:
+                ring = self._rings[key] = Candles.empty(exchange=exchange, symbol=market_pair, interval=interval)
+            ring.append(records)
+            if len(ring) > 2 * self.capacity:
+                self._rings[key] = ring[-self.capacity:]
+
+    def append(self, exchange, market_pair, interval, record):
+        self.extend(exchange, market_pair, interval, [record])
+
+    def is_warm(self, exchange, market_pair, interval):
+        return (exchange, market_pair, interval) in self._rings
+
+    def latest(self, exchange, market_pair, interval, periods):
+        """
+        :return: Candles of the latest periods candles in ascending order, or None if the
+            market is cold or more candles are asked for than the ring keeps
+        """
+        with self._lock:
+            ring = self._rings.get((exchange, market_pair, interval))
+            if ring is None or (periods > len(ring) and len(ring) >= self.capacity):
+                return None
+            return ring[-periods:]
+
+    def clear(self):
+        with self._lock:
+            self._rings.clear()
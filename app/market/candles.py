@@ -0,0 +1,286 @@
+import logging
+import re
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, and_, func
+
+from market import database
+
+logger = logging.getLogger(__name__)
+
+PRICE_DTYPE = np.float32
+TIMESTAMP_DTYPE = np.int64
+OHLCV_COLUMNS = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+COLUMNS = OHLCV_COLUMNS + ['bid', 'ask']
+
+_interval_seconds = {'m': 60, 'h': 60 * 60, 'd': 60 * 60 * 24, 'w': 60 * 60 * 24 * 7}
+
+
+def interval_to_seconds(interval):
+    """
+    :param interval: ccxt time unit i.e. 5m, 1h or 1d
+    :return: int, length of one candle in seconds
+    """
+    matches = re.match('^([0-9]+)([mhdw])$', interval)
+    if not matches:
+        raise ValueError("Unsupported interval {}".format(interval))
+    return int(matches.group(1)) * _interval_seconds[matches.group(2)]
+
+
+def ohlcv_records(ohlcv, exchange=None, symbol=None, interval=None):
+    """
+    :param ohlcv: list of [timestamp, open, high, low, close, volume(, bid, ask)] as returned by ccxt
+    :return: list of dicts ready to insert into the OHLCV table, at the rows' full precision
+    """
+    records = []
+    for row in ohlcv:
+        record = dict(zip(COLUMNS, row))
+        record['timestamp'] = int(record['timestamp'])
+        record['datetime'] = datetime.utcfromtimestamp(record['timestamp'] / 1000).isoformat() + 'Z'
+        for col in ['bid', 'ask']:
+            record.setdefault(col, None)
+        record.update(exchange=exchange, symbol=symbol, interval=interval)
+        records.append(record)
+    return records
+
+
+def _dtype(col):
+    return TIMESTAMP_DTYPE if col == 'timestamp' else PRICE_DTYPE
+
+
+class Candles:
+    """
+    OHLCV bars of one market held as compact typed column arrays
+
+    Prices, volume and bid/ask are float32 and timestamps are int64 epoch milliseconds, so a
+    year of 1m candles (~525k bars) takes ~16MB instead of a float64 DataFrame with a parsed
+    index. This is the one candle container used from the exchange interface through storage,
+    the datafeed and shared memory to the strategies and risk modules.
+
+    Slicing returns views without copying. append grows the arrays geometrically, so feeding
+    candles one by one is amortized O(1); arrays that are views of someone else's memory
+    (a slice, shared memory, a mapped file) are copied out on the first append instead of
+    being written to.
+    """
+
+    __slots__ = ('exchange', 'symbol', 'interval', '_data', '_n')
+
+    def __init__(self, timestamp, open, high, low, close, volume, bid=None, ask=None,
+                 exchange=None, symbol=None, interval=None):
+        self.exchange = exchange
+        self.symbol = symbol
+        self.interval = interval
+        self._data = {'timestamp': np.asarray(timestamp, dtype=TIMESTAMP_DTYPE)}
+        self._n = len(self._data['timestamp'])
+        for col, values in zip(COLUMNS[1:], [open, high, low, close, volume, bid, ask]):
+            if values is None:
+                values = np.full(self._n, np.nan, dtype=PRICE_DTYPE)
+            self._data[col] = np.asarray(values, dtype=PRICE_DTYPE)
+
+    def __len__(self):
+        return self._n
+
+    def __repr__(self):
+        return "Candles({} {} {}, {} bars)".format(self.exchange, self.symbol, self.interval, len(self))
+
+    @property
+    def meta(self):
+        return {'exchange': self.exchange, 'symbol': self.symbol, 'interval': self.interval}
+
+    @classmethod
+    def empty(cls, length=0, **meta):
+        return cls(*[np.empty(length, dtype=_dtype(col)) for col in OHLCV_COLUMNS], **meta)
+
+    @classmethod
+    def from_ohlcv(cls, ohlcv, **meta):
+        """
+        :param ohlcv: list of [timestamp, open, high, low, close, volume(, bid, ask)] as returned by ccxt
+        :param meta: exchange, symbol, interval
+        """
+        if not len(ohlcv):
+            return cls.empty(**meta)
+        bars = np.asarray(ohlcv, dtype=np.float64)
+        return cls(*[bars[:, i] for i in range(bars.shape[1])], **meta)
+
+    @classmethod
+    def from_rows(cls, rows, columns, **meta):
+        """
+        :param rows: database rows
+        :param columns: names of the row fields; the OHLCV table's columns, or a subset with timestamp and ohlcv
+        """
+        idx = [columns.index(col) if col in columns else None for col in COLUMNS]
+        if not len(rows):
+            return cls.empty(**meta)
+        bars = np.array([[row[i] if i is not None else None for i in idx] for row in rows], dtype=np.float64)
+        return cls(*[bars[:, i] for i in range(len(COLUMNS))], **meta)
+
+    @classmethod
+    def from_frame(cls, frame, **meta):
+        """
+        :param frame: DataFrame with timestamp (or a DatetimeIndex) and ohlcv columns
+        """
+        timestamp = frame['timestamp'].values if 'timestamp' in frame else frame.index.asi8 // 10 ** 6
+        return cls(timestamp, *[frame[col].values if col in frame else None for col in COLUMNS[1:]], **meta)
+
+    @classmethod
+    def from_db(cls, exchange, market_pair, interval, start=None, end=None, chunksize=100000, base_interval='1m'):
+        """
+        Load stored candles into preallocated arrays, one chunk of rows at a time
+
+        :param start: optional, timestamp in milliseconds (inclusive)
+        :param end: optional, timestamp in milliseconds (exclusive)
+        :param chunksize: number of rows fetched from the database at once
+        :param base_interval: finer interval to resample from when nothing is stored for interval
+        """
+        where = _where(exchange, market_pair, interval, start, end)
+        conn = database.engine.connect()
+        try:
+            total = conn.execute(select([func.count()]).select_from(database.OHLCV).where(where)).scalar()
+        finally:
+            conn.close()
+
+        if not total and interval != base_interval:
+            from market.resample import resample_candles
+            base = cls.from_db(exchange, market_pair, base_interval, start, end, chunksize, base_interval)
+            return resample_candles(base, interval)
+
+        candles = cls.empty(total, exchange=exchange, symbol=market_pair, interval=interval)
+        filled = 0
+        for chunk in iter_db_chunks(exchange, market_pair, interval, start, end, chunksize):
+            # rows inserted after the count are left for the next load
+            n = min(len(chunk), total - filled)
+            for col in COLUMNS:
+                candles._data[col][filled:filled + n] = chunk._data[col][:n]
+            filled += n
+            if filled == total:
+                break
+        return candles[:filled] if filled < total else candles
+
+    def __getitem__(self, item):
+        """Slice the bars; basic slices are numpy views and do not copy"""
+        if not isinstance(item, slice):
+            raise TypeError("Candles only support slicing, use the column arrays for single bars")
+        return Candles(*[self._data[col][:self._n][item] for col in COLUMNS], **self.meta)
+
+    def append(self, bars):
+        """
+        Append bars in place
+
+        :param bars: Candles, a dict record (i.e. an OHLCV table row), or a list of records or of
+            [timestamp, open, high, low, close, volume(, bid, ask)] rows
+        :return: self
+        """
+        if isinstance(bars, dict):
+            bars = [bars]
+        if not isinstance(bars, Candles):
+            if not len(bars):
+                return self
+            if isinstance(bars[0], dict):
+                bars = Candles(*[[bar.get(col) for bar in bars] for col in COLUMNS])
+            else:
+                bars = Candles.from_ohlcv(bars)
+
+        n = self._n + len(bars)
+        capacity = len(self._data['timestamp'])
+        owned = all(a.flags.owndata and a.flags.writeable for a in self._data.values())
+        if n > capacity or not owned:
+            capacity = max(n, 2 * capacity, 16)
+            for col in COLUMNS:
+                grown = np.empty(capacity, dtype=_dtype(col))
+                grown[:self._n] = self._data[col][:self._n]
+                self._data[col] = grown
+        for col in COLUMNS:
+            self._data[col][self._n:n] = bars._data[col][:len(bars)]
+        self._n = n
+        return self
+
+    def as_double(self, *columns):
+        """
+        :return: float64 copies of the columns, as talib functions require
+        """
+        return [self._data[col][:self._n].astype(np.float64) for col in columns]
+
+    def last(self):
+        """
+        :return: dict of the latest bar with the market it belongs to
+        """
+        bar = dict((col, self._data[col][self._n - 1].item()) for col in COLUMNS)
+        bar.update(self.meta)
+        return bar
+
+    def to_ohlcv(self):
+        """:return: list of [timestamp, open, high, low, close, volume] like ccxt"""
+        return np.column_stack([self._data[col][:self._n].astype(np.float64) for col in OHLCV_COLUMNS]).tolist()
+
+    def to_records(self):
+        """
+        :return: list of dicts ready to insert into the OHLCV table, with prices rounded to float32;
+            store the exchange's rows with ohlcv_records to keep their full precision
+        """
+        records = []
+        columns = [self._data[col][:self._n].tolist() for col in COLUMNS]
+        for values in zip(*columns):
+            record = dict(zip(COLUMNS, values))
+            record['datetime'] = datetime.utcfromtimestamp(record['timestamp'] / 1000).isoformat() + 'Z'
+            for col in ['bid', 'ask']:
+                if record[col] != record[col]:
+                    record[col] = None
+            record.update(self.meta)
+            records.append(record)
+        return records
+
+    def to_frame(self, tz=None):
+        """
+        :param tz: optional timezone of the DatetimeIndex, naive UTC by default
+        :return: DataFrame of [open, high, low, close, volume] indexed by bar open time
+        """
+        index = pd.to_datetime(self.timestamp, unit='ms')
+        if tz is not None:
+            index = index.tz_localize('UTC').tz_convert(tz)
+        return pd.DataFrame({col: getattr(self, col) for col in OHLCV_COLUMNS[1:]}, index=index,
+                            columns=OHLCV_COLUMNS[1:])
+
+
+def _column(name):
+    return property(lambda self: self._data[name][:self._n], doc="{} column array".format(name))
+
+
+for _col in COLUMNS:
+    setattr(Candles, _col, _column(_col))
+
+
+def _where(exchange, market_pair, interval, start=None, end=None):
+    clauses = [database.OHLCV.c.exchange == exchange,
+               database.OHLCV.c.symbol == market_pair,
+               database.OHLCV.c.interval == interval]
+    if start is not None:
+        clauses.append(database.OHLCV.c.timestamp >= start)
+    if end is not None:
+        clauses.append(database.OHLCV.c.timestamp < end)
+    return and_(*clauses)
+
+
+def iter_db_chunks(exchange, market_pair, interval, start=None, end=None, chunksize=100000):
+    """
+    Stream stored candles in ascending time order without materializing the whole range
+
+    Uses its own connection so a long scan does not hold database.lock against the live ticker.
+
+    :return: generator of Candles, each with at most chunksize bars
+    """
+    cols = [getattr(database.OHLCV.c, col) for col in COLUMNS]
+    s = select(cols).where(_where(exchange, market_pair, interval, start, end)).order_by(database.OHLCV.c.timestamp)
+    conn = database.engine.connect()
+    try:
+        result = conn.execution_options(stream_results=True).execute(s)
+        while True:
+            rows = result.fetchmany(chunksize)
+            if not rows:
+                break
+            bars = np.array(rows, dtype=np.float64)
+            yield Candles(*[bars[:, i] for i in range(len(COLUMNS))],
+                          exchange=exchange, symbol=market_pair, interval=interval)
+        result.close()
+    finally:
+        conn.close()
@@ -0,0 +1,184 @@
+# Background retention and roll-up compaction of the OHLCV table
+
+import logging
+import os
+import time as time_
+from threading import Thread, Event
+import pandas as pd
+import sqlalchemy as db
+from sqlalchemy import select, and_, func
+
+from market import database
+from market.candles import interval_to_seconds
+from market.resample import bucket_start, resample_frame
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RETENTION = {
+    '1m': {'keep': '2d', 'rollup': '1h'},
+    '5m': {'keep': '14d', 'rollup': '1d'},
+}
+
+
+def table_size():
+    """
+    :return: dict with the OHLCV row count per interval and the database file size in bytes
+    """
+    conn = database.engine.connect()
+    try:
+        s = select([database.OHLCV.c.interval, func.count()]).group_by(database.OHLCV.c.interval)
+        rows = dict((interval, count) for interval, count in conn.execute(s))
+    finally:
+        conn.close()
+    size = os.path.getsize(database.db_fullpath) if os.path.exists(database.db_fullpath) else 0
+    return {'rows': rows, 'total_rows': sum(rows.values()), 'file_bytes': size}
+
+
+class Compactor(Thread):
+    """
+    Rolls old fine-grained candles up into coarser ones and prunes them, batch by batch
+
+    Each policy keeps `keep` worth of candles of an interval; older ones are aggregated into
+    `rollup` candles (skipped when a candle for that bucket already exists, i.e. from the live
+    resampler), optionally copied to an archive database, then deleted. database.lock is only
+    held for the write of one batch, so live inserts wait at most one batch.
+    """
+
+    def __init__(self, retention=None, every=3600, batch_size=5000, pause=0.05, archive_path=None):
+        """
+        :param retention: dict {interval: {'keep': duration, 'rollup': interval or None}}
+        :param every: seconds between compaction runs
+        :param batch_size: rows read, written and deleted at once
+        :param pause: seconds to yield to the live ticker between batches
+        :param archive_path: optional sqlite file that pruned rows are copied to
+        """
+        super().__init__(name='compactor', daemon=True)
+        self.retention = retention or DEFAULT_RETENTION
+        self.every = every
+        self.batch_size = batch_size
+        self.pause = pause
+        self.archive_engine = None
+        if archive_path:
+            self.archive_engine = db.create_engine('sqlite:///{}'.format(archive_path))
+            database.metadata.create_all(self.archive_engine, tables=[database.OHLCV])
+        self.conn = database.engine.connect()
+        self._halt = Event()
+        self.last_stats = None
+
+    def run(self):
+        logger.info("Compactor running every {}s".format(self.every))
+        while not self._halt.is_set():
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Compaction run failed")
+            self._halt.wait(self.every)
+
+    def stop(self):
+        self._halt.set()
+
+    def compact(self, now=None):
+        """
+        Run every retention policy once
+
+        :param now: optional, timestamp in milliseconds to compute the cutoffs from
+        :return: dict of compaction statistics
+        """
+        now = now if now is not None else int(time_.time() * 1000)
+        started = time_.time()
+        stats = {'pruned': 0, 'rolled_up': 0, 'archived': 0, 'batches': 0}
+
+        for interval, policy in self.retention.items():
+            cutoff = now - interval_to_seconds(policy['keep']) * 1000
+            rollup = policy.get('rollup')
+            if rollup:
+                # only compact whole rollup buckets
+                cutoff = bucket_start(cutoff, rollup)
+            # a batch holds at least one whole bucket of candles
+            batch_size = max(self.batch_size, interval_to_seconds(rollup) // interval_to_seconds(interval)) \
+                if rollup else self.batch_size
+            for exchange, symbol in self._markets(interval, cutoff):
+                self._compact_market(exchange, symbol, interval, rollup, cutoff, batch_size, stats)
+
+        stats['seconds'] = time_.time() - started
+        stats['rows_per_second'] = stats['pruned'] / stats['seconds'] if stats['seconds'] else 0.0
+        stats.update(table_size())
+        self.last_stats = stats
+        logger.info("Compacted {pruned} rows into {rolled_up} in {batches} batches, {rows_per_second:.0f} rows/s; "
+                    "{total_rows} rows, {file_bytes} bytes left".format(**stats))
+        return stats
+
+    def _markets(self, interval, cutoff):
+        s = select([database.OHLCV.c.exchange, database.OHLCV.c.symbol]).where(
+            and_(database.OHLCV.c.interval == interval, database.OHLCV.c.timestamp < cutoff)).distinct()
+        return self.conn.execute(s).fetchall()
+
+    def _select(self, where, limit=None):
+        s = select([database.OHLCV]).where(where).order_by(database.OHLCV.c.timestamp)
+        result = self.conn.execute(s.limit(limit) if limit else s)
+        batch = pd.DataFrame(result.fetchall(), columns=result.keys())
+        result.close()
+        return batch
+
+    def _compact_market(self, exchange, symbol, interval, rollup, cutoff, batch_size, stats):
+        where = and_(database.OHLCV.c.exchange == exchange,
+                     database.OHLCV.c.symbol == symbol,
+                     database.OHLCV.c.interval == interval)
+        while not self._halt.is_set():
+            batch = self._select(and_(where, database.OHLCV.c.timestamp < cutoff), batch_size)
+            if batch.empty:
+                return
+
+            last = int(batch['timestamp'].iloc[-1])
+            if rollup and len(batch) == batch_size:
+                # a bucket is rolled up whole or not at all: an OR IGNORE insert of its rest
+                # in the next batch would be dropped
+                end = bucket_start(last, rollup)
+                if end > int(batch['timestamp'].iloc[0]):
+                    # leave the bucket the batch ends in for the next batch
+                    batch = batch[batch['timestamp'] < end]
+                else:
+                    # more rows than the batch in one bucket, i.e. ticks stored by ticker time
+                    bucket_end = min(cutoff, end + interval_to_seconds(rollup) * 1000)
+                    batch = self._select(and_(where, database.OHLCV.c.timestamp < bucket_end))
+                last = int(batch['timestamp'].iloc[-1])
+            first = int(batch['timestamp'].iloc[0])
+
+            records = _records(resample_frame(batch, rollup)) if rollup else []
+            if self.archive_engine is not None:
+                with self.archive_engine.begin() as archive:
+                    archive.execute(database.OHLCV.insert().prefix_with('OR IGNORE'), _records(batch))
+                stats['archived'] += len(batch)
+
+            with database.lock:
+                with self.conn.begin():
+                    if records:
+                        self.conn.execute(database.OHLCV.insert().prefix_with('OR IGNORE'), records)
+                    self.conn.execute(database.OHLCV.delete().where(
+                        and_(where, database.OHLCV.c.timestamp.between(first, last))))
+
+            stats['pruned'] += len(batch)
+            stats['rolled_up'] += len(records)
+            stats['batches'] += 1
+            time_.sleep(self.pause)
+
+
+def _records(frame):
+    """DataFrame rows as dicts of plain python values the sqlite driver can bind"""
+    return frame.astype(object).where(pd.notnull(frame), None).to_dict(orient='records')
+
+
+def start_compactor(config=None):
+    """
+    :param config: the compaction section of config.yml
+    :return: the started Compactor, or None if compaction is disabled
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return None
+    compactor = Compactor(retention=config.get('retention'),
+                          every=config.get('every', 3600),
+                          batch_size=config.get('batch_size', 5000),
+                          archive_path=config.get('archive_path'))
+    compactor.start()
+    return compactor
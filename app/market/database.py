@@ -1,7 +1,9 @@
 import os
 import sqlalchemy as db
-from threading import Lock
 import logging
+from threading import Lock
+
+import metrics
 
 logger = logging.getLogger(__name__)
 
@@ -13,7 +15,8 @@ db_fullpath = os.path.join(
         os.path.realpath(__file__)),
     db_name)
 
-lock = Lock()
+# every writer takes this lock; its wait and hold times are reported when metrics are enabled
+lock = metrics.TimedLock('database')
 engine = db.create_engine(
     'sqlite:///{}'.format(db_fullpath),
     connect_args={
@@ -21,18 +24,36 @@ engine = db.create_engine(
     echo=False)
 metadata = db.MetaData()
 
-#
+_conn = None
+_conn_lock = Lock()
+
+
+def connection():
+    """
+    The connection shared by the writers of this process, opened on first use
+
+    Nothing is opened at import time, so importing a module that writes is cheap and a
+    process forked before its first write doesn't inherit its parent's connection.
+    """
+    global _conn
+    if _conn is None:
+        with _conn_lock:
+            if _conn is None:
+                _conn = engine.connect()
+    return _conn
+
+# one row per (exchange, symbol, interval, timestamp) so 1m and derived candles can share a timestamp
 OHLCV = db.Table('OHLCV', metadata,
               db.Column('timestamp', db.Integer,primary_key=True),
-              db.Column('exchange', db.String),
-              db.Column('symbol', db.String),
+              db.Column('exchange', db.String,primary_key=True),
+              db.Column('symbol', db.String,primary_key=True),
               db.Column('datetime', db.String),
               db.Column('open', db.Float),
               db.Column('high', db.Float),
               db.Column('low', db.Float),
               db.Column('close', db.Float),
               db.Column('volume', db.Float),
-              db.Column('interval', db.String),
+              db.Column('interval', db.String,primary_key=True),
               db.Column('bid',db.Float),
               db.Column('ask',db.Float)
               )
@@ -49,15 +70,20 @@ OrderBook = db.Table('OrderBook', metadata,
                     db.Column('amount', db.Float), # ordered amount of base currency
                     db.Column('price', db.Float),extend_existing=True) # float price in quote currency
 
+# exchange and symbol are stored with each trade so a market's trades can be loaded without the OrderBook
 TradeBook = db.Table('TradeBook',metadata,
                      db.Column('tradeID',db.String,primary_key=True),
                      db.Column('timestamp',db.Integer),
                      db.Column('datetime',db.String),
                      db.Column('orderID',db.String,db.ForeignKey('OrderBook.orderID')),
+                     db.Column('exchange', db.String),
+                     db.Column('symbol', db.String),
+                     db.Column('side', db.String),
                      db.Column('amount', db.Float),
                      db.Column('price', db.Float),
                      db.Column('cost',db.Float),
-                     db.Column('fee', db.Float),extend_existing=True)
+                     db.Column('fee', db.Float),
+                     db.Index('ix_TradeBook_market', 'exchange', 'symbol', 'timestamp'),extend_existing=True)
 
 Position = db.Table('Position',metadata,
                     db.Column('timestamp',db.Integer),
@@ -71,17 +97,20 @@ Position = db.Table('Position',metadata,
 
 
 
-def drop_tables():
+def drop_tables(keep=()):
     print('Dropping tables...')
-    metadata.drop_all(engine)
+    metadata.drop_all(engine, tables=[table for table in metadata.sorted_tables if table not in keep])
 
 
 def create_tables():
     metadata.create_all(engine)
 
 
-def reset_db():
+def reset_db(keep=()):
+    """
+    :param keep: optional tables left as they are, i.e. the account's fills
+    """
     print('Resetting database...')
-    drop_tables()
+    drop_tables(keep)
     create_tables()
 
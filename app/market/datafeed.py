@@ -8,55 +8,108 @@ logger = logging.getLogger(__name__)
 # Pull data from the exchange at a given interval and write to the database
 
 from market import database
+from market import shared_candles
+from market.candle_cache import CandleCache
+from market.resample import Resampler, resample_candles
+from market.candles import Candles, interval_to_seconds, ohlcv_records
 from threading import Thread
 import time as time_
-import pandas as pd
 
-engine = database.engine
-conn = engine.connect()
+import metrics
+import tracing
 
 
 tickers={}
-def start_ticker(exchangeInterface,exchange, market_pair='BTC/USD',  interval='1h'):
-    """Start a ticker/timer that notifies market watchers when to pull a new candle"""
+# latest candles of the markets this process is ticking, answers get_latest_data_from_db from memory
+candle_cache = CandleCache()
+# shared memory ring buffers the tickers publish to, by (exchange, market_pair, interval)
+shared_writers = {}
+
+
+def _publish_shared(exchange, market_pair, interval, rows):
+    """Hand the latest candles (Candles or ohlcv rows) to strategy workers through shared memory, when the platform supports it"""
+    if shared_candles.shared_memory is None:
+        return
+    key = (exchange, market_pair, interval)
+    if key not in shared_writers:
+        shared_writers[key] = shared_candles.SharedCandleWriter(exchange, market_pair, interval)
+    shared_writers[key].publish(rows)
+
+def _store_derived(exchange, market_pair, records):
+    """Write candles derived by a Resampler next to the ones fetched from the exchange"""
+    if not records:
+        return
+    with database.lock:
+        database.connection().execute(database.OHLCV.insert().prefix_with('OR IGNORE'), records)
+    for interval in set(record['interval'] for record in records):
+        derived = [record for record in records if record['interval'] == interval]
+        candle_cache.extend(exchange, market_pair, interval, derived)
+        _publish_shared(exchange, market_pair, interval,
+                        [[r['timestamp'], r['open'], r['high'], r['low'], r['close'], r['volume']] for r in derived])
+
+
+def start_ticker(exchangeInterface,exchange, market_pair='BTC/USD',  interval='1h', derived_intervals=()):
+    """Start a ticker/timer that notifies market watchers when to pull a new candle
+
+    derived_intervals: coarser intervals, i.e. ('5m', '1h'), built locally from this ticker's
+        candles instead of being fetched from the exchange
+    """
     try:
         tickers[interval] = Thread( \
-            target=__start_ticker, args=(exchangeInterface, exchange, market_pair, interval,),
+            target=__start_ticker, args=(exchangeInterface, exchange, market_pair, interval, 300, derived_intervals),
             name='start_ticker').start()
     except KeyboardInterrupt:
         sys.exit(0)
 
-def get_latest_data_from_db(exchange,market_pair, interval,periods = 1):
+@tracing.traced('get_latest_data_from_db')
+def get_latest_data_from_db(exchange,market_pair, interval,periods = 1, base_interval='1m'):
     """
 
     :param exchange: name of the exchange
     :param market_pair: name of the market pair
     :param interval:
     :param periods: # of latest periods to fetch
-    :return: DataFrame object
+    :param base_interval: finer interval to derive interval candles from when none are stored
+    :return: Candles, ordered by timestamp ascending
     """
+    latest = candle_cache.latest(exchange, market_pair, interval, periods)
+    if latest is not None:
+        return latest
+
+    latest = _query_latest(exchange, market_pair, interval, periods)
+    if not len(latest) and interval != base_interval:
+        # nothing stored for the interval itself, roll it up from the base candles
+        ratio = interval_to_seconds(interval) // interval_to_seconds(base_interval)
+        base = _query_latest(exchange, market_pair, base_interval, (periods + 1) * ratio)
+        latest = resample_candles(base, interval, drop_partial=False)[-periods:]
+    return latest
+
+
+def _query_latest(exchange, market_pair, interval, periods):
     with database.lock:
         logger.info("Query latest candle for "+exchange+' '+market_pair+'per '+interval)
         s = select([database.OHLCV]).where(and_(database.OHLCV.c.exchange == exchange,
                                                 database.OHLCV.c.symbol == market_pair,
                                                 database.OHLCV.c.interval == interval)).order_by(
             database.OHLCV.c.timestamp.desc()).limit(periods)
-        result = conn.execute(s)
-        latest = pd.DataFrame(result.fetchall())
-        latest.columns = result.keys()
+        result = database.connection().execute(s)
+        rows = result.fetchall()
+        columns = list(result.keys())
         result.close()
-        return latest
+    # the query takes the newest rows; callers expect them oldest first
+    return Candles.from_rows(rows[::-1], columns, exchange=exchange, symbol=market_pair, interval=interval)
 
 
 
 @retry(retry=retry_if_exception_type(ccxt.NetworkError), stop=stop_after_attempt(3))
-def __start_ticker(exchangeInterface,exchange, market_pair, interval,backfill=300):
+def __start_ticker(exchangeInterface,exchange, market_pair, interval,backfill=300,derived_intervals=()):
     """Start a ticker on its own thread
 
     exchangeInterface: ExchangeInterface
     exchange: exchange name
     interval: ('1m', '5m', '1h', '6h')
     backfill: number of tickers to backfiil
+    derived_intervals: coarser intervals resampled from this ticker's candles
     """
 
     try:
@@ -77,18 +130,24 @@ def __start_ticker(exchangeInterface,exchange, market_pair, interval,backfill=30
 
     print("Get the latest {} tickers".format(str(backfill)))
     logger.info("Get the latest {} tickers".format(str(backfill)))
-    hist_ohlcv = exchangeInterface.get_historical_data(exchange,market_pair, interval, max_periods=backfill)
-    ohlcv_columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
-    ohlcv_info = []
-    for record in hist_ohlcv:
-        db_record = dict()
-        db_record.update({ohlcv_columns[i]: record[i] for i in range(len(ohlcv_columns))})
-        db_record.update({'exchange': exchange, 'symbol': market_pair, 'interval': interval})
-        ohlcv_info.append(db_record)
+    # stored from the exchange's float64 rows, Candles keep float32 prices
+    rows = exchangeInterface.get_historical_data(exchange,market_pair, interval, max_periods=backfill, raw=True)
+    ohlcv_info = ohlcv_records(rows, exchange=exchange, symbol=market_pair, interval=interval)
+    hist_ohlcv = Candles.from_ohlcv(rows, exchange=exchange, symbol=market_pair, interval=interval)
 
     with database.lock:
-        ins = database.OHLCV.insert()
-        conn.execute(ins, ohlcv_info)
+        # a restarted ticker backfills over candles it stored before
+        ins = database.OHLCV.insert().prefix_with('OR IGNORE')
+        database.connection().execute(ins, ohlcv_info)
+    candle_cache.extend(exchange, market_pair, interval, hist_ohlcv)
+    _publish_shared(exchange, market_pair, interval, hist_ohlcv)
+
+    resampler = Resampler(exchange, market_pair, derived_intervals, base_interval=interval) if derived_intervals else None
+    if resampler is not None:
+        derived = []
+        for db_record in ohlcv_info:
+            derived.extend(resampler.update(db_record))
+        _store_derived(exchange, market_pair, derived)
 
     logger.info(interval + " ticker running...")
     live_tick_count = 0
@@ -96,18 +155,30 @@ def __start_ticker(exchangeInterface,exchange, market_pair, interval,backfill=30
 
         print("Live Tick: {}".format(str(live_tick_count)))
         logger.info("Live Tick: {}".format(str(live_tick_count)))
-        print(interval + " tick")
-        ohlcv,ticker = exchangeInterface.get_live_data(exchange,market_pair,interval)
-        with database.lock:
-            ins = database.OHLCV.insert().values (timestamp = ticker['timestamp'],
-                                                 exchange=exchange,
-                                                 symbol=market_pair,
-                                                 datetime=ticker['datetime'],
-                                                 open=ohlcv[1], high=ohlcv[2], low=ohlcv[3], close=ohlcv[4], volume=ohlcv[5],
-                                                 interval=interval,
-                                                 ask = ticker['ask'],
-                                                 bid = ticker['bid'])
-            conn.execute(ins)
+        with tracing.cycle('feed_tick', exchange=exchange, symbol=market_pair, interval=interval) as trace:
+            print(interval + " tick")
+            ohlcv,ticker = exchangeInterface.get_live_data(exchange,market_pair,interval)
+            trace.mark(candle=ohlcv[0])
+            # how far behind the exchange's clock the tick is stored
+            metrics.observe('datafeed_tick_lag_seconds', max(0, time_.time() - ticker['timestamp'] / 1000),
+                            exchange=exchange, symbol=market_pair, interval=interval)
+            metrics.inc('datafeed_ticks_total', exchange=exchange, symbol=market_pair, interval=interval)
+            record = dict(timestamp = ticker['timestamp'],
+                          exchange=exchange,
+                          symbol=market_pair,
+                          datetime=ticker['datetime'],
+                          open=ohlcv[1], high=ohlcv[2], low=ohlcv[3], close=ohlcv[4], volume=ohlcv[5],
+                          interval=interval,
+                          ask = ticker['ask'],
+                          bid = ticker['bid'])
+            with tracing.span('store_tick'), database.lock:
+                ins = database.OHLCV.insert().values(**record)
+                database.connection().execute(ins)
+            candle_cache.append(exchange, market_pair, interval, record)
+            _publish_shared(exchange, market_pair, interval, [[ticker['timestamp']] + list(ohlcv[1:6])])
+            if resampler is not None:
+                # resample on candle time, the stored row is keyed by ticker time
+                _store_derived(exchange, market_pair, resampler.update(dict(record, timestamp=ohlcv[0])))
 
         live_tick_count += 1
         print(ticker['datetime'])
@@ -0,0 +1,221 @@
+# Bulk export of the database tables to partitioned Arrow/Parquet files, and memory-mapped loading back
+
+import glob
+import logging
+import os
+import numpy as np
+from sqlalchemy import select, and_, Integer, Float
+
+from market import database
+from market.candles import Candles
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
+FORMATS = {'parquet': '.parquet', 'arrow': '.arrow'}
+
+# columns files are partitioned by, per table; they live in the directory names, not the files
+PARTITIONS = {
+    'OHLCV': ['exchange', 'symbol', 'interval'],
+    'OrderBook': ['exchange', 'symbol'],
+    'TradeBook': ['exchange', 'symbol'],
+}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("pyarrow is required to export or load Arrow/Parquet files")
+
+
+def _schema(table):
+    """Arrow schema of a table's non-partition columns; OHLCV prices are float32 like Candles"""
+    compact = table.name == 'OHLCV'
+    fields = []
+    for column in _columns(table):
+        if column.name in PARTITIONS[table.name]:
+            continue
+        if column.name == 'timestamp' or isinstance(column.type, Integer):
+            fields.append(pa.field(column.name, pa.int64()))
+        elif isinstance(column.type, Float):
+            fields.append(pa.field(column.name, pa.float32() if compact else pa.float64()))
+        else:
+            fields.append(pa.field(column.name, pa.string()))
+    return pa.schema(fields)
+
+
+def _columns(table):
+    columns = list(table.columns)
+    if table.name == 'TradeBook' and 'exchange' not in table.c:
+        # trades only know their market through the order they filled
+        columns += [database.OrderBook.c.exchange, database.OrderBook.c.symbol]
+    return columns
+
+
+def _partition_dir(root, table_name, keys, values):
+    parts = ['{}={}'.format(k, str(v).replace('/', '-')) for k, v in zip(keys, values)]
+    return os.path.join(root, table_name, *parts)
+
+
+def export_table(table_name, root, exchange=None, symbol=None, interval=None, start=None, end=None,
+                 format='parquet', batch_size=500000, compression='snappy'):
+    """
+    Stream a table to partitioned files, batch_size rows at a time
+
+    Files land in root/<table>/exchange=<exchange>/symbol=<BASE-QUOTE>[/interval=<interval>]/part-<n>,
+    sorted by timestamp inside each partition.
+
+    :param table_name: 'OHLCV', 'OrderBook' or 'TradeBook'
+    :param start: optional, timestamp in milliseconds (inclusive)
+    :param end: optional, timestamp in milliseconds (exclusive)
+    :param format: 'parquet', or 'arrow' for uncompressed Arrow IPC files that load by memory mapping
+    :return: dict with the number of rows and the files written
+    """
+    _require_pyarrow()
+    if format not in FORMATS:
+        raise ValueError("format must be one of {}".format(list(FORMATS)))
+    table = database.metadata.tables[table_name]
+    columns = _columns(table)
+    by_name = dict((c.name, c) for c in columns)
+    partition_keys = PARTITIONS[table_name]
+
+    clauses = []
+    for name, value in [('exchange', exchange), ('symbol', symbol), ('interval', interval)]:
+        if value is not None and name in by_name:
+            clauses.append(by_name[name] == value)
+    if start is not None:
+        clauses.append(table.c.timestamp >= start)
+    if end is not None:
+        clauses.append(table.c.timestamp < end)
+
+    s = select(columns)
+    if table_name == 'TradeBook' and 'exchange' not in table.c:
+        s = s.select_from(table.outerjoin(database.OrderBook, table.c.orderID == database.OrderBook.c.orderID))
+    if clauses:
+        s = s.where(and_(*clauses))
+    s = s.order_by(*[by_name[k] for k in partition_keys] + [table.c.timestamp])
+
+    schema = _schema(table)
+    names = [c.name for c in columns]
+    key_idx = [names.index(k) for k in partition_keys]
+    value_idx = [names.index(f.name) for f in schema]
+
+    written = []
+    n_rows = 0
+    part = {}
+    # raw DBAPI cursor: skips the per-row SQLAlchemy result proxy, which dominates at this volume
+    raw = database.engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        compiled = s.compile(dialect=database.engine.dialect, compile_kwargs={'literal_binds': True})
+        cursor.execute(str(compiled))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            n_rows += len(rows)
+            # rows are sorted by partition, so each partition is one contiguous run
+            run_start = 0
+            for i in range(1, len(rows) + 1):
+                if i < len(rows) and all(rows[i][k] == rows[run_start][k] for k in key_idx):
+                    continue
+                values = [rows[run_start][k] for k in key_idx]
+                directory = _partition_dir(root, table_name, partition_keys, values)
+                part[directory] = part.get(directory, len(glob.glob(os.path.join(directory, 'part-*'))))
+                path = os.path.join(directory, 'part-{:05d}{}'.format(part[directory], FORMATS[format]))
+                part[directory] += 1
+                _write(rows[run_start:i], value_idx, schema, path, format, compression)
+                written.append(path)
+                run_start = i
+        cursor.close()
+    finally:
+        raw.close()
+
+    logger.info("Exported {} {} rows to {} files".format(n_rows, table_name, len(written)))
+    return {'rows': n_rows, 'files': written}
+
+
+def _write(rows, value_idx, schema, path, format, compression):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    arrays = [pa.array([row[i] for row in rows], type=field.type) for i, field in zip(value_idx, schema)]
+    batch = pa.Table.from_arrays(arrays, schema=schema)
+    if format == 'parquet':
+        pq.write_table(batch, path, compression=compression)
+    else:
+        with pa.OSFile(path, 'wb') as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                writer.write_table(batch)
+
+
+def _read(path, columns=None):
+    if path.endswith(FORMATS['arrow']):
+        # the table's buffers point straight into the mapped file
+        return pa.ipc.open_file(pa.memory_map(path, 'r')).read_all()
+    return pq.read_table(path, columns=columns, memory_map=True)
+
+
+def load_table(root, table_name, exchange='*', symbol='*', interval='*', columns=None):
+    """
+    Load exported files of a table, partition columns included
+
+    :param symbol: market pair i.e. BTC/USD, or '*' for all
+    :return: pyarrow.Table
+    """
+    _require_pyarrow()
+    values = {'exchange': exchange, 'symbol': symbol.replace('/', '-'), 'interval': interval}
+    keys = PARTITIONS[table_name]
+    pattern = os.path.join(_partition_dir(root, table_name, keys, [values[k] for k in keys]), 'part-*')
+    tables = []
+    for path in sorted(glob.glob(pattern)):
+        t = _read(path, columns)
+        directory = os.path.relpath(os.path.dirname(path), os.path.join(root, table_name))
+        for part in directory.split(os.sep):
+            key, value = part.split('=', 1)
+            t = t.append_column(key, pa.array([value.replace('-', '/') if key == 'symbol' else value] * t.num_rows))
+        tables.append(t)
+    if not tables:
+        raise FileNotFoundError("No exported {} files match {}".format(table_name, pattern))
+    return pa.concat_tables(tables)
+
+
+def load_ohlcv(root, exchange, symbol, interval, start=None, end=None):
+    """
+    Map exported OHLCV files of one market into a Candles, ready for Backtest_Optim
+
+    Arrow files of a single part are used in place without copying; several parts or
+    Parquet files are decoded once into the compact Candles arrays.
+
+    :param symbol: market pair i.e. BTC/USD
+    :param start: optional, timestamp in milliseconds (inclusive)
+    :param end: optional, timestamp in milliseconds (exclusive)
+    :return: Candles
+    """
+    _require_pyarrow()
+    directory = _partition_dir(root, 'OHLCV', PARTITIONS['OHLCV'], [exchange, symbol, interval])
+    paths = sorted(glob.glob(os.path.join(directory, 'part-*')))
+    if not paths:
+        raise FileNotFoundError("No exported OHLCV files in {}".format(directory))
+
+    cols = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+    tables = [_read(path, cols) for path in paths]
+    arrays = []
+    for col in cols:
+        chunks = [c for t in tables for c in t.column(col).chunks]
+        if len(chunks) == 1 and chunks[0].null_count == 0:
+            arrays.append(chunks[0].to_numpy(zero_copy_only=True))
+        else:
+            arrays.append(np.concatenate([c.to_numpy(zero_copy_only=False) for c in chunks]))
+
+    candles = Candles(*arrays, exchange=exchange, symbol=symbol, interval=interval)
+    if len(paths) > 1:
+        order = np.argsort(candles.timestamp, kind='mergesort')
+        if (np.diff(order) != 1).any():
+            candles = Candles(*[getattr(candles, c)[order] for c in cols],
+                              exchange=exchange, symbol=symbol, interval=interval)
+    lo = np.searchsorted(candles.timestamp, start) if start is not None else 0
+    hi = np.searchsorted(candles.timestamp, end) if end is not None else len(candles)
+    return candles[lo:hi]
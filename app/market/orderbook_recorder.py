@@ -0,0 +1,292 @@
+# Record L2 order book snapshots compactly to disk and map time ranges of them back into arrays
+
+import glob
+import logging
+import os
+import struct
+import time as time_
+from threading import Thread, Event, Lock
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'YGOB'
+FORMAT_VERSION = 2
+_FILE_HEADER = struct.Struct('<4sHH')  # magic, version, depth
+# bids are stored with negated prices; a NaN price marks a record header, whose size is the record's entry count
+_ENTRY = np.dtype([('timestamp', '<i8'), ('price', '<f4'), ('size', '<f4')])
+SEGMENT_SUFFIX = '.obs'
+BOOK_FIELDS = ['bid_price', 'bid_size', 'ask_price', 'ask_size']
+
+
+def _market_dir(root, exchange, symbol):
+    return os.path.join(root, exchange, symbol.replace('/', '-'))
+
+
+def book_vector(book, depth):
+    """
+    :param book: ccxt order book, {'bids': [[price, amount], ...], 'asks': [...]}
+    :return: float32 array of [bid prices, bid sizes, ask prices, ask sizes], depth each, NaN past the book's end
+    """
+    vector = np.full(4 * depth, np.nan, dtype=np.float32)
+    for side, offset in [('bids', 0), ('asks', 2 * depth)]:
+        levels = np.asarray([level[:2] for level in book[side][:depth]], dtype=np.float32).reshape(-1, 2)
+        vector[offset:offset + len(levels)] = levels[:, 0]
+        vector[offset + depth:offset + depth + len(levels)] = levels[:, 1]
+    return vector
+
+
+def _levels(prices, sizes):
+    """:return: dict of price: size of the levels of one side of a snapshot vector"""
+    present = ~np.isnan(prices)
+    return dict(zip(prices[present].tolist(), sizes[present].tolist()))
+
+
+class SegmentWriter:
+    """
+    Append-only file of delta encoded snapshots of one market
+
+    Deltas are keyed by price, not by level: a record is a header entry holding the timestamp
+    and the number of changes, then one 16 byte entry per price level whose size changed, that
+    appeared (its size) or that left the top depth levels (size 0). When the book shifts by a
+    level, only the levels that came and went are written, not every level below them. The
+    first record of a segment holds every level, so each segment decodes on its own.
+    """
+
+    def __init__(self, path, depth):
+        self.path = path
+        self.depth = depth
+        self.count = 0
+        self._previous = ({}, {})
+        self._file = open(path, 'ab')
+        if self._file.tell() == 0:
+            self._file.write(_FILE_HEADER.pack(MAGIC, FORMAT_VERSION, depth))
+
+    def write(self, timestamp, vector):
+        depth = self.depth
+        current = (_levels(vector[:depth], vector[depth:2 * depth]),
+                   _levels(vector[2 * depth:3 * depth], vector[3 * depth:]))
+        changes = []
+        for sign, levels, previous in zip((-1, 1), current, self._previous):
+            changes.extend((sign * price, size) for price, size in levels.items() if previous.get(price) != size)
+            changes.extend((sign * price, 0.0) for price in previous if price not in levels)
+        record = np.empty(len(changes) + 1, dtype=_ENTRY)
+        record['timestamp'] = int(timestamp)
+        record[0] = (int(timestamp), np.nan, len(changes))
+        if changes:
+            record['price'][1:], record['size'][1:] = zip(*changes)
+        self._file.write(record.tobytes())
+        self._previous = current
+        self.count += 1
+
+    def flush(self):
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def _side(snapshot, prices, sizes, n, depth, descending, live):
+    """
+    Rebuild the top depth levels of one side at n snapshots from its price keyed changes
+
+    :param live: (prices, sizes) of the levels present before the first of the snapshots
+    :return: (rows, ranks, prices, sizes) of the levels present, ranked best first, and the
+        (prices, sizes) live after the last snapshot
+    """
+    keys, key = np.unique(np.concatenate([live[0], prices]), return_inverse=True)
+    if descending:
+        keys, key = keys[::-1], len(keys) - 1 - key
+    # row 0 holds the levels carried in, row i + 1 the changes of snapshot i
+    book = np.full((n + 1, len(keys)), np.nan, dtype=np.float32)
+    book[0, key[:len(live[0])]] = live[1]
+    book[snapshot + 1, key[len(live[0]):]] = sizes
+    # carry each level's size forward over the snapshots that did not change it
+    last = np.where(np.isnan(book), 0, np.arange(n + 1, dtype=np.int32)[:, None])
+    np.maximum.accumulate(last, axis=0, out=last)
+    book = book[last, np.arange(len(keys))]
+    present = book > 0
+    live = (keys[present[-1]], book[-1, present[-1]])
+    book, present = book[1:], present[1:]
+    rank = np.cumsum(present, axis=1, dtype=np.int32) - 1
+    rows, cols = np.nonzero(present & (rank < depth))
+    return rows, rank[rows, cols], keys[cols], book[rows, cols], live
+
+
+def read_segment(path, chunk_snapshots=256):
+    """
+    Decode a segment file, memory mapped, with array operations over chunks of its records; a
+    record cut short by a crash ends the segment
+
+    A chunk is decoded over the prices its records change plus the at most depth levels per
+    side still live from the previous chunk, so memory stays bounded however far the book
+    drifts over a segment.
+
+    :param chunk_snapshots: snapshots decoded at once
+    :return: (int64 timestamps, float32 array of shape (n, 4 * depth)), depth
+    """
+    buf = np.memmap(path, dtype=np.uint8, mode='r')
+    magic, version, depth = _FILE_HEADER.unpack(bytes(buf[:_FILE_HEADER.size]))
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("{} is not an order book segment of version {}".format(path, FORMAT_VERSION))
+    width = 4 * depth
+    entries = np.frombuffer(buf, dtype=_ENTRY, count=(len(buf) - _FILE_HEADER.size) // _ENTRY.itemsize,
+                            offset=_FILE_HEADER.size)
+    header = np.isnan(entries['price'])
+    starts = np.flatnonzero(header)
+    if len(starts) and len(entries) - starts[-1] - 1 < entries['size'][starts[-1]]:
+        entries, header, starts = entries[:starts[-1]], header[:starts[-1]], starts[:-1]
+    n = len(starts)
+    if not n:
+        return (np.empty(0, dtype=np.int64), np.empty((0, width), dtype=np.float32)), depth
+
+    snapshot = (np.cumsum(header) - 1)[~header]
+    changes = entries[~header]
+    books = np.full((n, width), np.nan, dtype=np.float32)
+    empty = (np.empty(0, dtype=np.float32), np.empty(0, dtype=np.float32))
+    live = {True: empty, False: empty}
+    for first in range(0, n, chunk_snapshots):
+        count = min(chunk_snapshots, n - first)
+        lo, hi = np.searchsorted(snapshot, [first, first + count])
+        chunk, chunk_snapshot = changes[lo:hi], snapshot[lo:hi] - first
+        for bids, offset in [(True, 0), (False, 2 * depth)]:
+            side = chunk['price'] < 0 if bids else chunk['price'] > 0
+            prices = -chunk['price'][side] if bids else chunk['price'][side]
+            rows, ranks, level_prices, level_sizes, live[bids] = _side(
+                chunk_snapshot[side], prices, chunk['size'][side], count, depth, bids, live[bids])
+            books[first + rows, offset + ranks] = level_prices
+            books[first + rows, offset + depth + ranks] = level_sizes
+    return (entries['timestamp'][starts].astype(np.int64), books), depth
+
+
+def load_books(root, exchange, symbol, start=None, end=None):
+    """
+    Recorded snapshots of a market within a time range
+
+    :param start: optional, timestamp in milliseconds (inclusive)
+    :param end: optional, timestamp in milliseconds (exclusive)
+    :return: dict with 'timestamp' (n,) and bid_price, bid_size, ask_price, ask_size arrays of shape (n, depth)
+    """
+    paths = sorted(glob.glob(os.path.join(_market_dir(root, exchange, symbol), '*' + SEGMENT_SUFFIX)),
+                   key=lambda p: int(os.path.basename(p)[:-len(SEGMENT_SUFFIX)]))
+    firsts = [int(os.path.basename(p)[:-len(SEGMENT_SUFFIX)]) for p in paths]
+    timestamps, vectors, depth = [], [], None
+    for i, path in enumerate(paths):
+        # segments are named by their first timestamp, skip the ones wholly outside the range
+        if end is not None and firsts[i] >= end:
+            break
+        if start is not None and i + 1 < len(paths) and firsts[i + 1] <= start:
+            continue
+        (ts, rows), depth_ = read_segment(path)
+        if depth is not None and depth_ != depth:
+            raise ValueError("Segments of {} {} were recorded at different depths".format(exchange, symbol))
+        depth = depth_
+        timestamps.append(ts)
+        vectors.append(rows)
+    if not timestamps:
+        raise FileNotFoundError("No order book segments for {} {} in {}".format(exchange, symbol, root))
+
+    timestamp = np.concatenate(timestamps)
+    vector = np.concatenate(vectors)
+    lo = np.searchsorted(timestamp, start) if start is not None else 0
+    hi = np.searchsorted(timestamp, end) if end is not None else len(timestamp)
+    books = {'timestamp': timestamp[lo:hi]}
+    for i, field in enumerate(BOOK_FIELDS):
+        books[field] = vector[lo:hi, i * depth:(i + 1) * depth]
+    return books
+
+
+class OrderBookRecorder(Thread):
+    """
+    Samples the L2 books of subscribed markets at a fixed rate into segment files
+
+    Files land in root/<exchange>/<BASE-QUOTE>/<first timestamp>.obs; a new segment is started
+    every segment_snapshots snapshots so ranges can be read without decoding everything.
+    Books fetched elsewhere, i.e. by ExchangeInterface.get_order_book, can be added with record.
+    """
+
+    def __init__(self, exchangeInterface, root, depth=20, rate=1.0, segment_snapshots=10000, flush_every=60):
+        """
+        :param depth: levels kept per side
+        :param rate: snapshots per second per market
+        :param segment_snapshots: snapshots per segment file
+        :param flush_every: snapshots between flushes of a segment file to disk
+        """
+        super().__init__(name='orderbook-recorder', daemon=True)
+        self.exchangeInterface = exchangeInterface
+        self.root = root
+        self.depth = depth
+        self.rate = rate
+        self.segment_snapshots = segment_snapshots
+        self.flush_every = flush_every
+        self.markets = []
+        self._writers = {}
+        self._lock = Lock()
+        self._halt = Event()
+
+    def subscribe(self, exchange, symbol):
+        if (exchange, symbol) not in self.markets:
+            self.markets.append((exchange, symbol))
+
+    def record(self, exchange, symbol, book, timestamp=None):
+        """
+        :param book: ccxt order book
+        :param timestamp: optional, defaults to the book's timestamp or now, in milliseconds
+        """
+        timestamp = timestamp or book.get('timestamp') or int(time_.time() * 1000)
+        vector = book_vector(book, self.depth)
+        key = (exchange, symbol)
+        with self._lock:
+            writer = self._writers.get(key)
+            if writer is None or writer.count >= self.segment_snapshots:
+                if writer is not None:
+                    writer.close()
+                directory = _market_dir(self.root, exchange, symbol)
+                os.makedirs(directory, exist_ok=True)
+                writer = self._writers[key] = SegmentWriter(
+                    os.path.join(directory, '{}{}'.format(timestamp, SEGMENT_SUFFIX)), self.depth)
+            writer.write(timestamp, vector)
+            if writer.count % self.flush_every == 0:
+                writer.flush()
+
+    def run(self):
+        logger.info("Recording order books of {} markets at {}/s".format(len(self.markets), self.rate))
+        while not self._halt.is_set():
+            started = time_.monotonic()
+            for exchange, symbol in list(self.markets):
+                try:
+                    book = self.exchangeInterface.exchanges[exchange].fetch_order_book(symbol, limit=self.depth)
+                    self.record(exchange, symbol, book)
+                except Exception:
+                    logger.exception("Recording the {} {} order book failed".format(exchange, symbol))
+            self._halt.wait(max(0, 1 / self.rate - (time_.monotonic() - started)))
+
+    def stop(self):
+        self._halt.set()
+        self.close()
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers.clear()
+
+
+def start_recorder(exchangeInterface, config=None):
+    """
+    :param config: the order_book_recorder section of config.yml
+    :return: the started OrderBookRecorder, or None if recording is disabled
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return None
+    recorder = OrderBookRecorder(exchangeInterface,
+                                 root=config.get('root', 'order_books'),
+                                 depth=config.get('depth', 20),
+                                 rate=config.get('rate', 1.0),
+                                 segment_snapshots=config.get('segment_snapshots', 10000))
+    for market in config.get('markets', []):
+        recorder.subscribe(market['exchange'], market['symbol'])
+    exchangeInterface.order_book_recorder = recorder
+    recorder.start()
+    return recorder
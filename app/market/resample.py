@@ -0,0 +1,157 @@
+# Derive coarser candles from stored 1m candles instead of fetching every interval from the exchange
+
+import logging
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+from market.candles import Candles, interval_to_seconds
+
+logger = logging.getLogger(__name__)
+
+BASE_INTERVAL = '1m'
+# epoch (1970-01-01) is a Thursday; weekly candles open on Monday like the exchanges'
+_WEEK_OFFSET = 4 * 24 * 60 * 60 * 1000
+
+
+def bucket_start(timestamp, interval):
+    """
+    Open time of the interval candle a timestamp falls in, aligned to UTC midnight
+
+    :param timestamp: int or numpy array of timestamps in milliseconds
+    :param interval: ccxt time unit i.e. 5m or 1h
+    :return: same type as timestamp
+    """
+    step = interval_to_seconds(interval) * 1000
+    offset = _WEEK_OFFSET if interval.endswith('w') else 0
+    return (timestamp - offset) // step * step + offset
+
+
+def resample_candles(candles, interval, drop_partial=True):
+    """
+    Aggregate ascending candles into a coarser interval
+
+    :param candles: Candles of a finer interval, i.e. 1m
+    :param interval: target interval
+    :param drop_partial: drop the last candle if its bucket is not complete yet
+    :return: Candles of the target interval
+    """
+    meta = dict(exchange=candles.exchange, symbol=candles.symbol, interval=interval)
+    if not len(candles):
+        return Candles.empty(**meta)
+
+    buckets = bucket_start(candles.timestamp, interval)
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    ends = np.r_[starts[1:], len(candles)] - 1
+    resampled = Candles(buckets[starts],
+                        candles.open[starts],
+                        np.maximum.reduceat(candles.high, starts),
+                        np.minimum.reduceat(candles.low, starts),
+                        candles.close[ends],
+                        np.add.reduceat(candles.volume, starts),
+                        candles.bid[ends],
+                        candles.ask[ends],
+                        **meta)
+
+    if drop_partial and candles.interval:
+        step = interval_to_seconds(interval) * 1000
+        if candles.timestamp[-1] + interval_to_seconds(candles.interval) * 1000 < buckets[-1] + step:
+            resampled = resampled[:-1]
+    return resampled
+
+
+def resample_frame(frame, interval):
+    """
+    Aggregate rows shaped like the OHLCV table into a coarser interval
+
+    :param frame: DataFrame with the OHLCV table columns, ascending
+    :return: DataFrame with the same columns, one row per interval candle
+    """
+    if frame.empty:
+        return frame
+    frame = frame.assign(bucket=bucket_start(frame['timestamp'].values.astype(np.int64), interval))
+    resampled = frame.groupby('bucket', sort=True).agg({
+        'exchange': 'first', 'symbol': 'first', 'open': 'first', 'high': 'max', 'low': 'min',
+        'close': 'last', 'volume': 'sum', 'bid': 'last', 'ask': 'last'})
+    resampled.index.name = 'timestamp'
+    resampled = resampled.reset_index()
+    resampled['datetime'] = resampled['timestamp'].apply(_to_datetime)
+    resampled['interval'] = interval
+    return resampled[list(frame.columns.drop('bucket'))]
+
+
+def _to_datetime(timestamp):
+    return datetime.utcfromtimestamp(timestamp / 1000).isoformat() + 'Z'
+
+
+class Resampler:
+    """
+    Incrementally roll 1m candles of one market up into coarser intervals
+
+    Feed every 1m candle as it is seen. A candle with the timestamp of the previous one
+    replaces it (the live ticker keeps re-reading the open candle); it is folded into the
+    coarser candles once a newer 1m candle shows it has closed. A coarser candle is emitted
+    as soon as its last minute has been folded, or when a later bucket starts after a gap.
+    """
+
+    def __init__(self, exchange, market_pair, intervals, base_interval=BASE_INTERVAL):
+        self.exchange = exchange
+        self.market_pair = market_pair
+        self.intervals = [i for i in intervals if i != base_interval]
+        self.base_step = interval_to_seconds(base_interval) * 1000
+        for interval in self.intervals:
+            if interval_to_seconds(interval) * 1000 % self.base_step:
+                raise ValueError("{} is not a multiple of {}".format(interval, base_interval))
+        self._pending = None
+        self._current = dict.fromkeys(self.intervals)
+
+    def update(self, candle):
+        """
+        :param candle: dict with timestamp, open, high, low, close, volume and optionally bid, ask
+        :return: list of completed coarser candles as OHLCV table records
+        """
+        if self._pending is not None and candle['timestamp'] < self._pending['timestamp']:
+            return []
+        if self._pending is None or candle['timestamp'] == self._pending['timestamp']:
+            self._pending = dict(candle)
+            return []
+        closed, self._pending = self._pending, dict(candle)
+        return self._fold(closed)
+
+    def flush(self):
+        """Fold the pending 1m candle, treating it as closed, i.e. at the end of a backfill"""
+        if self._pending is None:
+            return []
+        closed, self._pending = self._pending, None
+        return self._fold(closed)
+
+    def partial(self, interval):
+        """:return: the still-open candle of an interval, or None"""
+        return self._current[interval]
+
+    def _fold(self, candle):
+        completed = []
+        for interval in self.intervals:
+            start = bucket_start(candle['timestamp'], interval)
+            current = self._current[interval]
+            if current is not None and current['timestamp'] != start:
+                completed.append(current)
+                current = None
+            if current is None:
+                current = {'timestamp': start, 'datetime': _to_datetime(start),
+                           'exchange': self.exchange, 'symbol': self.market_pair, 'interval': interval,
+                           'open': candle['open'], 'high': candle['high'], 'low': candle['low'],
+                           'close': candle['close'], 'volume': candle['volume'] or 0}
+            else:
+                current['high'] = max(current['high'], candle['high'])
+                current['low'] = min(current['low'], candle['low'])
+                current['close'] = candle['close']
+                current['volume'] += candle['volume'] or 0
+            current['bid'] = candle.get('bid')
+            current['ask'] = candle.get('ask')
+
+            if candle['timestamp'] + self.base_step >= start + interval_to_seconds(interval) * 1000:
+                completed.append(current)
+                current = None
+            self._current[interval] = current
+        return completed
@@ -0,0 +1,189 @@
+# Publish the latest candles per market to shared memory so strategy workers read them without the database
+
+import hashlib
+import logging
+import numpy as np
+
+from market.candles import Candles
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:  # python < 3.8, callers fall back to the database
+    shared_memory = None
+
+logger = logging.getLogger(__name__)
+
+MAGIC = 0x59474243  # 'YGBC'
+LAYOUT_VERSION = 1
+PRICE_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+# header slots, all int64
+_MAGIC, _LAYOUT, _SEQ, _CAPACITY, _COUNT, _HEAD = range(6)
+_HEADER_SIZE = 8 * 8
+
+
+def buffer_name(exchange, market_pair, interval):
+    """Shared memory block name for a market; hashed to stay under platform name limits"""
+    key = '{}|{}|{}'.format(exchange, market_pair, interval).encode()
+    return 'ygb_' + hashlib.md5(key).hexdigest()[:20]
+
+
+def _layout(buf, capacity):
+    """
+    Map header and columns onto a shared memory buffer
+
+    Every row is written twice, at i and i + capacity, so the latest n rows are always one
+    contiguous slice and can be handed out as views however the ring has wrapped.
+    """
+    header = np.ndarray((8,), dtype=np.int64, buffer=buf, offset=0)
+    timestamp = np.ndarray((2 * capacity,), dtype=np.int64, buffer=buf, offset=_HEADER_SIZE)
+    prices = np.ndarray((len(PRICE_COLUMNS), 2 * capacity), dtype=np.float32, buffer=buf,
+                        offset=_HEADER_SIZE + 8 * 2 * capacity)
+    return header, timestamp, prices
+
+
+def _size(capacity):
+    return _HEADER_SIZE + 8 * 2 * capacity + 4 * len(PRICE_COLUMNS) * 2 * capacity
+
+
+class SharedCandleWriter:
+    """
+    Single-writer ring buffer of the latest candles of one market
+
+    Readers detect concurrent writes through a sequence counter in the header that is odd
+    while a write is in progress (a seqlock), so no cross-process lock is needed.
+    """
+
+    def __init__(self, exchange, market_pair, interval, capacity=1024):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory requires python 3.8+")
+        self.name = buffer_name(exchange, market_pair, interval)
+        self.capacity = capacity
+        try:
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=_size(capacity))
+        except FileExistsError:
+            # left over by a crashed process
+            stale = shared_memory.SharedMemory(name=self.name)
+            stale.close()
+            stale.unlink()
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=_size(capacity))
+        self.header, self.timestamp, self.prices = _layout(self.shm.buf, capacity)
+        self.header[:] = 0
+        self.header[_MAGIC] = MAGIC
+        self.header[_LAYOUT] = LAYOUT_VERSION
+        self.header[_CAPACITY] = capacity
+
+    def _write(self, rows):
+        head = int(self.header[_HEAD])
+        last = head - 1 if head else self.capacity - 1
+        for row in rows:
+            ts = int(row[0])
+            # a repeated timestamp updates the still-open candle in place
+            i = last if self.header[_COUNT] and self.timestamp[last] == ts else head
+            self.timestamp[i] = self.timestamp[i + self.capacity] = ts
+            self.prices[:, i] = self.prices[:, i + self.capacity] = row[1:6]
+            if i == head:
+                last = head
+                head = (head + 1) % self.capacity
+                self.header[_COUNT] = min(self.header[_COUNT] + 1, self.capacity)
+        self.header[_HEAD] = head
+
+    def publish(self, rows):
+        """
+        :param rows: Candles, or iterable of [timestamp, open, high, low, close, volume], ascending
+        """
+        if isinstance(rows, Candles):
+            rows = zip(rows.timestamp, *[getattr(rows, col) for col in PRICE_COLUMNS])
+        self.header[_SEQ] += 1
+        try:
+            self._write(rows)
+        finally:
+            self.header[_SEQ] += 1
+
+    def append(self, timestamp, open, high, low, close, volume):
+        self.publish([(timestamp, open, high, low, close, volume)])
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class SharedCandleReader:
+    """Read-only view of a market's SharedCandleWriter from another process"""
+
+    def __init__(self, exchange, market_pair, interval):
+        if shared_memory is None:
+            raise RuntimeError("multiprocessing.shared_memory requires python 3.8+")
+        self.exchange = exchange
+        self.market_pair = market_pair
+        self.interval = interval
+        self.shm = shared_memory.SharedMemory(name=buffer_name(exchange, market_pair, interval))
+        # the writer owns the block; don't let this process' resource tracker unlink it on exit
+        resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        header = np.ndarray((8,), dtype=np.int64, buffer=self.shm.buf)
+        if header[_MAGIC] != MAGIC or header[_LAYOUT] != LAYOUT_VERSION:
+            self.shm.close()
+            raise ValueError("Incompatible shared candle buffer layout")
+        self.capacity = int(header[_CAPACITY])
+        self.header, self.timestamp, self.prices = _layout(self.shm.buf, self.capacity)
+        self.timestamp.flags.writeable = False
+        self.prices.flags.writeable = False
+
+    @property
+    def version(self):
+        """Sequence number of the last completed write"""
+        return int(self.header[_SEQ])
+
+    def latest(self, periods, retries=100):
+        """
+        Latest candles, ascending, copied out of shared memory
+
+        The copies are taken between two reads of the sequence number and kept only if no
+        write started in between, so they are a consistent snapshot as of the returned version.
+
+        :param periods: number of latest candles
+        :return: (version, timestamp array, dict of price column arrays)
+        """
+        for _ in range(retries):
+            seq = int(self.header[_SEQ])
+            if seq % 2:
+                continue
+            count = int(self.header[_COUNT])
+            head = int(self.header[_HEAD])
+            n = min(periods, count)
+            end = head + self.capacity
+            timestamp = self.timestamp[end - n:end].copy()
+            prices = self.prices[:, end - n:end].copy()
+            if int(self.header[_SEQ]) == seq:
+                return seq, timestamp, dict(zip(PRICE_COLUMNS, prices))
+        raise RuntimeError("Shared candle buffer kept changing while reading")
+
+    def latest_candles(self, periods):
+        """
+        :return: Candles of a snapshot of the shared memory, like datafeed.get_latest_data_from_db, ascending
+        """
+        version, timestamp, prices = self.latest(periods)
+        return Candles(timestamp, *[prices[col] for col in PRICE_COLUMNS],
+                       exchange=self.exchange, symbol=self.market_pair, interval=self.interval)
+
+    def close(self):
+        self.shm.close()
+
+
+_readers = {}
+
+
+def get_reader(exchange, market_pair, interval):
+    """
+    :return: a cached SharedCandleReader, or None if nothing is published for the market
+    """
+    key = (exchange, market_pair, interval)
+    if key not in _readers:
+        if shared_memory is None:
+            return None
+        try:
+            _readers[key] = SharedCandleReader(exchange, market_pair, interval)
+        except (FileNotFoundError, ValueError):
+            return None
+    return _readers[key]
@@ -0,0 +1,249 @@
+# Counters and latency histograms of the live pipeline, exported in the Prometheus text format
+
+import functools
+import logging
+import os
+import time as time_
+from bisect import bisect_left
+from threading import Thread, Lock
+
+logger = logging.getLogger(__name__)
+
+# upper bounds in seconds, from sub-millisecond lock waits to slow exchange calls
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_enabled = False
+_lock = Lock()
+_counters = {}    # (name, labels) -> value
+_histograms = {}  # (name, labels) -> [bucket counts, sum, count]
+
+
+def enabled():
+    return _enabled
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    """Add to a counter; a no-op while metrics are disabled"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def observe(name, seconds, **labels):
+    """Record a duration in a histogram; a no-op while metrics are disabled"""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    i = bisect_left(BUCKETS, seconds)
+    with _lock:
+        histogram = _histograms.get(key)
+        if histogram is None:
+            histogram = _histograms[key] = [[0] * (len(BUCKETS) + 1), 0.0, 0]
+        histogram[0][i] += 1
+        histogram[1] += seconds
+        histogram[2] += 1
+
+
+class timed:
+    """
+    Time a block or a function into a histogram
+
+        with metrics.timed('refit_seconds', strategy='CDL_Test'):
+            ...
+
+        @metrics.timed('risk_control_seconds', method='position_control')
+        def control(...):
+    """
+
+    __slots__ = ('name', 'labels', '_start')
+
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+        self._start = None
+
+    def __enter__(self):
+        self._start = time_.perf_counter() if _enabled else None
+        return self
+
+    def __exit__(self, *exc):
+        if self._start is not None:
+            observe(self.name, time_.perf_counter() - self._start, **self.labels)
+
+    def __call__(self, func):
+        name, labels = self.name, self.labels
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            start = time_.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe(name, time_.perf_counter() - start, **labels)
+        return wrapper
+
+
+class TimedLock:
+    """
+    threading.Lock that records how long callers wait for it and hold it
+
+    Only a flag check is added while metrics are disabled.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self._lock = Lock()
+        self._acquired = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        if not _enabled:
+            return self._lock.acquire(blocking, timeout)
+        start = time_.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquired = time_.perf_counter()
+            observe('lock_wait_seconds', self._acquired - start, lock=self.name)
+        return acquired
+
+    def release(self):
+        acquired, self._acquired = self._acquired, None
+        self._lock.release()
+        if acquired is not None:
+            observe('lock_hold_seconds', time_.perf_counter() - acquired, lock=self.name)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+def _labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in pairs) + '}'
+
+
+def render():
+    """:return: every metric in the Prometheus text exposition format"""
+    with _lock:
+        counters = sorted(_counters.items())
+        histograms = sorted((key, (list(h[0]), h[1], h[2])) for key, h in _histograms.items())
+    lines = []
+    typed = set()
+    for (name, labels), value in counters:
+        if name not in typed:
+            lines.append('# TYPE {} counter'.format(name))
+            typed.add(name)
+        lines.append('{}{} {}'.format(name, _labels(labels), value))
+    for (name, labels), (buckets, total, count) in histograms:
+        if name not in typed:
+            lines.append('# TYPE {} histogram'.format(name))
+            typed.add(name)
+        cumulative = 0
+        for bound, n in zip(list(BUCKETS) + ['+Inf'], buckets):
+            cumulative += n
+            lines.append('{}_bucket{} {}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+        lines.append('{}_sum{} {}'.format(name, _labels(labels), total))
+        lines.append('{}_count{} {}'.format(name, _labels(labels), count))
+    return '\n'.join(lines) + '\n'
+
+
+def serve(port, host='127.0.0.1'):
+    """Serve the metrics over HTTP from a background thread, for Prometheus to scrape"""
+    # http.server pulls in ssl and email, only processes that serve pay for it
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = HTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, name='metrics-http', daemon=True).start()
+    logger.info("Serving metrics on http://{}:{}/metrics".format(host, port))
+    return server
+
+
+def write_file(path):
+    """Write the metrics to a file atomically, i.e. for the node exporter's textfile collector"""
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(render())
+    os.replace(tmp, path)
+
+
+def _write_every(path, every):
+    while True:
+        time_.sleep(every)
+        try:
+            write_file(path)
+        except OSError:
+            logger.exception("Writing metrics to {} failed".format(path))
+
+
+def instance_path(path, instance=None):
+    """
+    :return: path with the process' instance number before the file's extensions, i.e.
+        yigebot.prom -> yigebot.3.prom, so collectors matching the extension still find it
+    """
+    if instance is None:
+        return path
+    directory, base = os.path.split(path)
+    name, dot, ext = base.partition('.')
+    return os.path.join(directory, '{}.{}{}{}'.format(name, instance, dot, ext))
+
+
+def start_metrics(config=None, instance=None):
+    """
+    :param config: the metrics section of config.yml
+    :param instance: optional number of this process among several, i.e. a runner shard;
+        offsets the port and suffixes the file so processes don't collide
+    :return: True if metrics are enabled
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return False
+    enable()
+    if config.get('port'):
+        serve(config['port'] + (instance + 1 if instance is not None else 0), config.get('host', '127.0.0.1'))
+    if config.get('path'):
+        Thread(target=_write_every, args=(instance_path(config['path'], instance), config.get('every', 15)),
+               name='metrics-file', daemon=True).start()
+    return True
@@ -0,0 +1,221 @@
+# Track open orders across exchanges with batched status polling, emit fill events and record fills
+
+import logging
+import time as time_
+from threading import Thread, Event, Lock, Condition
+
+import ccxt
+
+from market import database
+
+logger = logging.getLogger(__name__)
+
+# ccxt order statuses after which an order no longer changes
+DONE = ('closed', 'canceled', 'expired', 'rejected')
+
+
+class OrderTracker(Thread):
+    """
+    Watches every tracked order and reports fills as they happen
+
+    Each poll costs one or two requests per (exchange, symbol) with tracked orders, however many
+    orders are open there: the open and recently closed orders of the market are fetched with
+    since= set to the oldest tracked order, and the account's trades are only fetched, from the
+    last one in the exchange interface's TradeIndex, when an order's filled amount moved.
+    fetch_order is only used for orders the batched calls do not return, i.e. on exchanges
+    without fetchClosedOrders.
+
+    Fills and status changes are passed to subscribed callbacks as event dicts; fills are
+    buffered and written to TradeBook in batches, once per poll.
+    """
+
+    def __init__(self, exchangeInterface, interval=None, batch_size=500):
+        """
+        :param exchangeInterface: ExchangeInterface whose clients are polled
+        :param interval: seconds between polls, defaults to the slowest exchange's rateLimit
+        :param batch_size: TradeBook rows inserted at once
+        """
+        super().__init__(name='order-tracker', daemon=True)
+        self.exchangeInterface = exchangeInterface
+        self.interval = interval
+        self.batch_size = batch_size
+        self.conn = database.engine.connect()
+        self._orders = {}       # (exchange, symbol) -> {orderID: state}
+        self._done = {}         # (exchange, orderID) -> state of finished orders
+        self._pending = []
+        self._callbacks = []
+        self._lock = Lock()
+        self._changed = Condition()
+        self._halt = Event()
+
+    def track(self, exchange, order):
+        """
+        :param order: ccxt order structure, as returned by create_order
+        """
+        key = (exchange, order['symbol'])
+        state = {'exchange': exchange,
+                 'symbol': order['symbol'],
+                 'orderID': str(order['id']),
+                 'side': order.get('side'),
+                 'timestamp': order.get('timestamp') or int(time_.time() * 1000),
+                 'status': order.get('status') or 'open',
+                 'filled': order.get('filled') or 0}
+        with self._lock:
+            self._orders.setdefault(key, {})[state['orderID']] = state
+
+    def subscribe(self, callback):
+        """
+        :param callback: called with every event dict; 'type' is 'fill' or the order's final status
+        """
+        self._callbacks.append(callback)
+
+    def status(self, exchange, orderID):
+        """:return: last known status of a tracked order, None if it is not tracked"""
+        orderID = str(orderID)
+        with self._lock:
+            if (exchange, orderID) in self._done:
+                return self._done[(exchange, orderID)]['status']
+            for (exchange_, _), orders in self._orders.items():
+                if exchange_ == exchange and orderID in orders:
+                    return orders[orderID]['status']
+        return None
+
+    def open_orders(self, exchange, symbol):
+        """:return: states of the tracked orders of a market that are not finished yet"""
+        with self._lock:
+            return [dict(state) for state in self._orders.get((exchange, symbol), {}).values()]
+
+    def wait(self, exchange, orderID, timeout=120):
+        """
+        Block until a tracked order is finished, polling in this thread if the tracker is not running
+
+        :return: the order's status, which is not final if the timeout expired
+        """
+        deadline = time_.time() + timeout
+        finished = lambda: self.status(exchange, orderID) in DONE
+        while not finished() and time_.time() < deadline:
+            if self.is_alive():
+                with self._changed:
+                    self._changed.wait_for(finished, max(0, deadline - time_.time()))
+            else:
+                self.poll()
+                if not finished():
+                    time_.sleep(min(self._sleep_time(), max(0, deadline - time_.time())))
+        return self.status(exchange, orderID)
+
+    def run(self):
+        logger.info("Order tracker running")
+        while not self._halt.is_set():
+            try:
+                self.poll()
+            except Exception:
+                logger.exception("Order tracker poll failed")
+            self._halt.wait(self._sleep_time())
+
+    def stop(self):
+        self._halt.set()
+        self.flush()
+
+    def poll(self):
+        """
+        Poll every market with tracked orders once
+
+        :return: list of the events emitted
+        """
+        with self._lock:
+            markets = [(key, list(orders.values())) for key, orders in self._orders.items() if orders]
+        events = []
+        for (exchange, symbol), orders in markets:
+            try:
+                events.extend(self._poll_market(exchange, symbol, orders))
+            except ccxt.NetworkError as e:
+                logger.warning("Polling {} {} orders failed: {}".format(exchange, symbol, e))
+        self.flush()
+
+        for event in events:
+            for callback in self._callbacks:
+                # the events are not emitted again, so one failing subscriber must not cost the others theirs
+                try:
+                    callback(event)
+                except Exception:
+                    logger.exception("Order tracker callback {} failed on {}".format(callback, event))
+        with self._changed:
+            self._changed.notify_all()
+        return events
+
+    def flush(self):
+        """Write buffered fills to TradeBook"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.batch_size):
+            with database.lock:
+                # a trade seen again after a restart is already stored
+                self.conn.execute(database.TradeBook.insert().prefix_with('OR IGNORE'), pending[i:i + self.batch_size])
+
+    def _sleep_time(self):
+        if self.interval is not None:
+            return self.interval
+        return max([client.rateLimit / 1000 for client in self.exchangeInterface.exchanges.values()] or [1])
+
+    def _fetch_orders(self, client, symbol, orders):
+        """:return: dict of orderID: ccxt order for the tracked orders the exchange reported"""
+        since = min(state['timestamp'] for state in orders)
+        ids = set(state['orderID'] for state in orders)
+        if client.has.get('fetchOrders'):
+            fetched = client.fetch_orders(symbol, since=since)
+        else:
+            fetched = []
+            if client.has.get('fetchOpenOrders'):
+                fetched += client.fetch_open_orders(symbol, since=since)
+            if client.has.get('fetchClosedOrders'):
+                fetched += client.fetch_closed_orders(symbol, since=since)
+        found = dict((str(order['id']), order) for order in fetched if str(order['id']) in ids)
+
+        missing = ids - set(found)
+        if missing and client.has.get('fetchOrder'):
+            # no longer open and not listed as closed, i.e. the exchange has no fetchClosedOrders
+            for orderID in missing:
+                found[orderID] = client.fetch_order(orderID, symbol)
+        return found
+
+    def _fetch_trades(self, client, exchange, symbol, ids):
+        """:return: fill events of the given orders' trades made since the last trade indexed"""
+        records = self.exchangeInterface.trade_index.update(client, exchange, symbol, persist=False)
+        with self._lock:
+            # the index won't return these again, so store the other orders' trades too
+            self._pending.extend(records)
+        return [dict(record, type='fill') for record in records if record['orderID'] in ids]
+
+    def _poll_market(self, exchange, symbol, orders):
+        client = self.exchangeInterface.exchanges[exchange]
+        found = self._fetch_orders(client, symbol, orders)
+        reported = dict((orderID, (order.get('filled') or 0, order.get('status'))) for orderID, order in found.items())
+
+        events = []
+        if any(state['orderID'] in reported and reported[state['orderID']][0] > state['filled'] for state in orders):
+            events.extend(self._fetch_trades(client, exchange, symbol, set(state['orderID'] for state in orders)))
+
+        finished = []
+        for state in orders:
+            if state['orderID'] not in reported:
+                continue
+            filled, status = reported[state['orderID']]
+            if filled > state['filled']:
+                traded = sum(record['amount'] for record in
+                             self.exchangeInterface.trade_index.trades(exchange, symbol, state['orderID']))
+                if traded < filled * (1 - 1e-9):
+                    # the exchange lists an order's trades after reporting its fill: leave the order
+                    # as it was, so the next poll sees the fill move and fetches the trades again
+                    continue
+                state['filled'] = filled
+            state['status'] = status or state['status']
+            if state['status'] in DONE:
+                finished.append(state)
+
+        for state in finished:
+            events.append(dict(state, type=state['status']))
+        with self._lock:
+            for state in finished:
+                self._orders[(exchange, symbol)].pop(state['orderID'], None)
+                self._done[(exchange, state['orderID'])] = state
+        return events
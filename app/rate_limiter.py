@@ -0,0 +1,53 @@
+# Pace requests to an exchange across threads and processes
+
+import multiprocessing
+import time as time_
+from threading import Lock
+
+
+class RateLimiter:
+    """
+    Hands out request slots at most every `interval` seconds, to any number of threads
+
+    Each caller reserves the next free slot under the lock and sleeps until it outside of it,
+    so concurrent callers queue up one interval apart instead of all sleeping a full
+    interval after their own request.
+    """
+
+    def __init__(self, interval):
+        """
+        :param interval: minimum seconds between two requests, i.e. a ccxt exchange's rateLimit / 1000
+        """
+        self.interval = interval
+        self._next = 0
+        self._lock = Lock()
+
+    def wait(self):
+        """Block until this caller may send its request"""
+        with self._lock:
+            now = time_.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+        if slot > now:
+            time_.sleep(slot - now)
+
+
+class SharedRateLimiter:
+    """
+    RateLimiter whose next free slot lives in shared memory, so processes share one budget
+
+    Create it before starting the processes that use it; they inherit the shared value.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._next = multiprocessing.Value('d', 0.0)
+
+    def wait(self):
+        with self._next.get_lock():
+            # wall clock, the one clock every process agrees on
+            now = time_.time()
+            slot = max(now, self._next.value)
+            self._next.value = slot + self.interval
+        if slot > now:
+            time_.sleep(slot - now)
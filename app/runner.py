@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+"""Live runner trading every configured exchange and market pair, sharded across processes
+"""
+import logging
+import multiprocessing
+import os
+import sys
+import time as tm
+import yaml
+
+import metrics
+import tracing
+from market import database
+from rate_limiter import SharedRateLimiter
+
+logger = logging.getLogger(__name__)
+
+
+def list_markets(config):
+    """
+    :param config: loaded config.yml
+    :return: list of (exchange, market pair); an exchange's own market_pairs override the global ones
+    """
+    markets = []
+    for exchange, exchange_config in config['exchanges'].items():
+        for market_pair in exchange_config.get('market_pairs', config['settings']['market_pairs']):
+            markets.append((exchange, market_pair))
+    return markets
+
+
+def partition(markets, n_shards):
+    """
+    Spread markets over shards round robin, ordered by exchange so each exchange's markets are spread evenly
+
+    :return: list of non-empty lists of markets
+    """
+    shards = [[] for _ in range(n_shards)]
+    for i, market in enumerate(sorted(markets)):
+        shards[i % n_shards].append(market)
+    return [shard for shard in shards if shard]
+
+
+def _cancel_stale(exchangeInterface, tracker, exchange, market_pair, max_age):
+    """
+    Cancel the market's tracked orders older than max_age seconds
+
+    :return: True if the market still has working orders
+    """
+    working = tracker.open_orders(exchange, market_pair)
+    now = tm.time() * 1000
+    for state in working:
+        if now - state['timestamp'] > max_age * 1000:
+            logger.info("Canceling stale {} {} order {}".format(exchange, market_pair, state['orderID']))
+            # the tracker sees it canceled on its next poll, which releases its reservation
+            exchangeInterface.cancel_order(exchange, state['orderID'], symbol=market_pair)
+    return bool(working)
+
+
+def _cycle(exchangeInterface, exchange, market_pair, interval, strategies, ledger, runner_config, tracker=None,
+           pool=None):
+    """
+    One data -> strategy -> risk pass over a market
+
+    A market with orders still working is skipped, after canceling the ones older than
+    runner.order_timeout, so an unfilled order is not placed again every cycle.
+
+    :param tracker: optional OrderTracker of the shard's orders
+    :param pool: optional Pool the strategies are refit in
+    :return: order intents
+    """
+    from app import start_strategy
+    from market import datafeed
+    from logics.risk_management import position_control, order_control
+
+    with tracing.span('market', exchange=exchange, symbol=market_pair) as span:
+        if tracker is not None and _cancel_stale(exchangeInterface, tracker, exchange, market_pair,
+                                                 runner_config.get('order_timeout', 300)):
+            span.mark(skipped='working orders')
+            return []
+        if tracing.current() is not None:
+            # the candle the cycle acts on, to line the trace up with the feed_tick that stored it
+            latest = datafeed.get_latest_data_from_db(exchange, market_pair, interval)
+            span.mark(candle=int(latest.timestamp[-1]) if len(latest) else None)
+        signals = start_strategy(exchange, market_pair, interval, strategies, pool=pool)
+        positions = ledger.snapshot(exchange, market_pair)
+        intents = []
+        if len(positions):
+            candles = datafeed.get_latest_data_from_db(exchange, market_pair, interval)
+            risk = position_control.Position_Control(positions, candles, runner_config.get('target', 0.2),
+                                                     runner_config.get('stop_loss', 0.2)).control()
+            if any(signals['sell']) or risk['sell'].any():
+                # close by side: longs are sold, shorts bought back, opposite ones net out
+                net = float(positions['amount'].where(positions['position'] == 'long', -positions['amount']).sum())
+                if net:
+                    intents.append({'exchange': exchange, 'symbol': market_pair, 'type': 'market',
+                                    'side': 'sell' if net > 0 else 'buy', 'amount': abs(net)})
+        elif signals['buy'] and all(signals['buy']):
+            quote = market_pair.split('/')[1]
+            control = order_control.Order_Control(exchange, market_pair,
+                                                  exchangeInterface.get_free_balance(exchange, quote), 'long', None,
+                                                  exchangeInterface.get_order_book(exchange, market_pair))
+            price, size = control.simple_control()
+            intents.append({'exchange': exchange, 'symbol': market_pair, 'type': 'limit', 'side': 'buy',
+                            'amount': size, 'price': price})
+    return intents
+
+
+def run_shard(shard_id, markets, config, limiters, processes=None):
+    """
+    Worker process: owns the clients and feeds of its markets and runs their pipeline every cycle
+
+    :param markets: list of (exchange, market pair) this shard trades
+    :param limiters: dict of exchange: SharedRateLimiter, shared by every shard
+    :param processes: size of the shard's strategy pool, its share of the cores by default
+    """
+    from exchange import ExchangeInterface
+    from exchange_cache import start_exchange_cache
+    from market import datafeed
+    from order_tracker import OrderTracker
+    from logics.risk_management.position_ledger import Position_Ledger
+
+    logging.basicConfig(level=logging.INFO)
+    metrics.start_metrics(config.get('metrics'), instance=shard_id)
+    tracing.start_tracing(config.get('tracing'), instance=shard_id)
+    exchanges = sorted(set(exchange for exchange, _ in markets))
+    exchangeInterface = ExchangeInterface(dict((exchange, config['exchanges'][exchange]) for exchange in exchanges))
+    for exchange in exchanges:
+        exchangeInterface.use_rate_limiter(exchange, limiters[exchange])
+    # every shard reads the same files; one of them refreshes an exchange when its entry is stale
+    start_exchange_cache(exchangeInterface, config.get('exchange_cache'))
+
+    settings = config['settings']
+    runner_config = config.get('runner', {})
+    interval = settings['update_interval']
+    for exchange, market_pair in markets:
+        datafeed.start_ticker(exchangeInterface, exchange, market_pair, interval=interval,
+                              derived_intervals=settings.get('derived_intervals', ()))
+
+    ledger = Position_Ledger()
+    ledger.rebuild()
+    tracker = OrderTracker(exchangeInterface)
+    tracker.subscribe(ledger.on_event)
+    tracker.subscribe(exchangeInterface.balances.on_event)
+    tracker.start()
+
+    # one pool for the life of the shard, not one per market and cycle
+    pool = multiprocessing.Pool(processes or 1)
+
+    logger.info("Shard {} running {} markets".format(shard_id, len(markets)))
+    cycle = runner_config.get('cycle', 60)
+    while True:
+        started = tm.time()
+        intents = []
+        with tracing.cycle('cycle', shard=shard_id):
+            for exchange, market_pair in markets:
+                try:
+                    intents += _cycle(exchangeInterface, exchange, market_pair, interval, config['strategies'],
+                                      ledger, runner_config, tracker=tracker, pool=pool)
+                except Exception:
+                    logger.exception("Shard {}: {} {} cycle failed".format(shard_id, exchange, market_pair))
+            if intents and runner_config.get('trade', False):
+                for result in exchangeInterface.create_orders(intents):
+                    if result['order'] is not None:
+                        tracker.track(result['intent']['exchange'], result['order'])
+            elif intents:
+                logger.info("Shard {}: not trading, skipped {} orders: {}".format(shard_id, len(intents), intents))
+            ledger.flush()
+        tm.sleep(max(0, cycle - (tm.time() - started)))
+
+
+class Supervisor:
+    """
+    Starts one process per shard and restarts the ones that die
+
+    Shard processes are not daemonic, since each runs its strategies in a process pool of its
+    own, sized to its share of the cores. A shard that keeps failing is restarted with an exponential backoff and given
+    up on after max_restarts restarts within restart_window seconds.
+    """
+
+    def __init__(self, config, n_shards=None, max_restarts=5, restart_window=600):
+        self.config = config
+        markets = list_markets(config)
+        self.shards = partition(markets, n_shards or min(len(markets), os.cpu_count() or 1))
+        self.processes_per_shard = max(1, (os.cpu_count() or 1) // max(1, len(self.shards)))
+        # one budget per exchange, however many shards talk to it
+        self.limiters = {}
+        for exchange in set(exchange for exchange, _ in markets):
+            rate_limit = config['exchanges'][exchange].get('rate_limit')
+            if rate_limit is None:
+                import ccxt
+                rate_limit = getattr(ccxt, exchange)().rateLimit
+            self.limiters[exchange] = SharedRateLimiter(rate_limit / 1000)
+        self.max_restarts = max_restarts
+        self.restart_window = restart_window
+        self.processes = {}
+        self.restarts = dict((i, []) for i in range(len(self.shards)))
+
+    def _start(self, shard_id):
+        process = multiprocessing.Process(target=run_shard, name='shard-{}'.format(shard_id),
+                                          args=(shard_id, self.shards[shard_id], self.config, self.limiters,
+                                                self.processes_per_shard))
+        process.daemon = False
+        process.start()
+        self.processes[shard_id] = process
+        logger.info("Started shard {} (pid {}): {}".format(shard_id, process.pid, self.shards[shard_id]))
+
+    def run(self, poll=5):
+        for shard_id in range(len(self.shards)):
+            self._start(shard_id)
+        try:
+            while self.processes:
+                tm.sleep(poll)
+                for shard_id, process in list(self.processes.items()):
+                    if process.is_alive():
+                        continue
+                    now = tm.time()
+                    recent = [t for t in self.restarts[shard_id] if now - t < self.restart_window]
+                    self.restarts[shard_id] = recent
+                    if len(recent) >= self.max_restarts:
+                        logger.error("Shard {} failed {} times in {}s, giving up on {}".format(
+                            shard_id, len(recent), self.restart_window, self.shards[shard_id]))
+                        del self.processes[shard_id]
+                        continue
+                    logger.warning("Shard {} exited with {}, restarting".format(shard_id, process.exitcode))
+                    tm.sleep(min(2 ** len(recent), 60))
+                    self.restarts[shard_id].append(tm.time())
+                    self._start(shard_id)
+        finally:
+            self.stop()
+
+    def stop(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join()
+
+
+def main():
+    with open("app/config.yml", 'r') as stream:
+        config = yaml.load(stream)
+    logging.basicConfig(level=logging.INFO)
+    # shards only append to the tables, the supervisor creates them once
+    database.create_tables()
+    runner_config = config.get('runner', {})
+    Supervisor(config, n_shards=runner_config.get('shards'),
+               max_restarts=runner_config.get('max_restarts', 5)).run()
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(0)
@@ -0,0 +1,137 @@
+# CallPolicy against a FakeExchange with injected latency and errors
+
+import os
+import sys
+import time as time_
+import unittest
+
+APP = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if APP not in sys.path:
+    sys.path.insert(0, APP)
+
+import ccxt
+
+from call_policy import CallPolicy, CircuitBreaker, CircuitOpen, DeadlineExceeded
+from fake_exchange import FakeExchange
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def test_opens_after_consecutive_failures(self):
+        breaker = CircuitBreaker(failures=2, cooldown=60)
+        breaker.record_failure()
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(breaker.allow())
+
+    def test_half_open_probes_one_at_a_time_and_closes(self):
+        breaker = CircuitBreaker(failures=1, cooldown=0.01, recovery=2)
+        breaker.record_failure()
+        time_.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(breaker.allow())
+        breaker.record_success()
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+
+    def test_failed_probe_reopens_for_longer(self):
+        breaker = CircuitBreaker(failures=1, cooldown=0.01, max_cooldown=0.03)
+        breaker.record_failure()
+        time_.sleep(0.02)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(breaker.cooldown, 0.02)
+        time_.sleep(0.03)
+        self.assertTrue(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.cooldown, 0.03)
+
+
+class CallPolicyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.policy = CallPolicy('fake', deadline=1, backoff=0.001, hedge_min_samples=5, failures=3, cooldown=60)
+
+    def tearDown(self):
+        self.policy.shutdown()
+
+    def test_idempotent_calls_are_retried(self):
+        client = FakeExchange(error_rate={'fetch_ticker': 1.0})
+        with self.assertRaises(ccxt.NetworkError):
+            self.policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        self.assertEqual(client.requests['fetch_ticker'], self.policy.attempts)
+
+    def test_circuit_rejects_without_a_request(self):
+        client = FakeExchange(error_rate={'fetch_ticker': 1.0})
+        policy = CallPolicy('fake', attempts=1, failures=2, cooldown=60)
+        for _ in range(2):
+            with self.assertRaises(ccxt.NetworkError):
+                policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        with self.assertRaises(CircuitOpen):
+            policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        self.assertEqual(client.requests['fetch_ticker'], 2)
+        policy.shutdown()
+
+    def test_exchange_errors_are_not_failures(self):
+        client = FakeExchange(error_rate={'fetch_ticker': 1.0}, error=ccxt.InsufficientFunds)
+        for _ in range(5):
+            with self.assertRaises(ccxt.InsufficientFunds):
+                self.policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        self.assertEqual(self.policy.breaker('fetch_ticker').state, CircuitBreaker.CLOSED)
+        self.assertEqual(client.requests['fetch_ticker'], 5)
+
+    def test_deadline_covers_a_slow_read(self):
+        client = FakeExchange(latency={'fetch_ticker': 0.5})
+        policy = CallPolicy('fake', deadline=0.05)
+        start = time_.monotonic()
+        with self.assertRaises(DeadlineExceeded):
+            policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        self.assertLess(time_.monotonic() - start, 0.3)
+        policy.shutdown()
+
+    def test_slow_read_is_hedged(self):
+        calls = []
+
+        def latency(method):
+            # quick calls to learn the p95, then one stuck request answered by its hedge
+            calls.append(method)
+            return 1.0 if len(calls) == 6 else 0.001
+        client = FakeExchange(latency=latency)
+        for _ in range(5):
+            self.policy.call('fetch_order_book', client.fetch_order_book, 'BTC/USD', idempotent=True, hedge=True)
+        start = time_.monotonic()
+        order_book = self.policy.call('fetch_order_book', client.fetch_order_book, 'BTC/USD',
+                                      idempotent=True, hedge=True)
+        self.assertLess(time_.monotonic() - start, 0.5)
+        self.assertTrue(order_book['bids'])
+        self.assertEqual(client.requests['fetch_order_book'], 7)
+
+    def test_unhedged_read_is_not_duplicated(self):
+        client = FakeExchange(latency={'fetch_ticker': 0.01})
+        for _ in range(10):
+            self.policy.call('fetch_ticker', client.fetch_ticker, 'BTC/USD', idempotent=True)
+        self.assertEqual(client.requests['fetch_ticker'], 10)
+
+    def test_orders_are_sent_once(self):
+        client = FakeExchange(error_rate={'create_order': 1.0})
+        with self.assertRaises(ccxt.NetworkError):
+            self.policy.call('create_order', client.create_order, 'BTC/USD', 'market', 'buy', 1.0)
+        self.assertEqual(client.requests['create_order'], 1)
+
+    def test_orders_are_not_abandoned_at_the_deadline(self):
+        client = FakeExchange(latency={'create_order': 0.2})
+        policy = CallPolicy('fake', deadline=0.05)
+        order = policy.call('create_order', client.create_order, 'BTC/USD', 'market', 'buy', 1.0)
+        self.assertEqual(order['status'], 'closed')
+        self.assertEqual(list(client.orders), [order['id']])
+        policy.shutdown()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,81 @@
+# Order book segments: price keyed deltas written and decoded back, in bounded memory
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import tracemalloc
+import unittest
+
+APP = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+if APP not in sys.path:
+    sys.path.insert(0, APP)
+
+import numpy as np
+
+from market.orderbook_recorder import SegmentWriter, book_vector, read_segment
+
+
+def drifting_books(count, depth=20, seed=0):
+    """:return: count BTC-like books whose mid walks by up to $3, so most prices are seen only briefly"""
+    rng = random.Random(seed)
+    mid = 950000
+    for _ in range(count):
+        mid += rng.choice([-1, 1]) * rng.randint(0, 300)
+        book = {}
+        for side, sign in [('bids', -1), ('asks', 1)]:
+            # distinct levels, best first, a cent or two apart
+            ticks = np.cumsum([rng.randint(1, 2) for _ in range(rng.randint(depth - 2, depth))])
+            book[side] = [[(mid + sign * int(tick)) / 100, rng.uniform(0.01, 2)] for tick in ticks]
+        yield book
+
+
+class SegmentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.path = os.path.join(self.root, '0.obs')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, books, depth=20):
+        writer = SegmentWriter(self.path, depth)
+        vectors = []
+        for i, book in enumerate(books):
+            vectors.append(book_vector(book, depth))
+            writer.write(i, vectors[-1])
+        writer.close()
+        return np.vstack(vectors)
+
+    def test_round_trip(self):
+        expected = self.write(drifting_books(1000, depth=5), depth=5)
+        (timestamps, books), depth = read_segment(self.path, chunk_snapshots=64)
+        self.assertEqual(depth, 5)
+        np.testing.assert_array_equal(timestamps, np.arange(1000))
+        np.testing.assert_array_equal(books, expected)
+
+    def test_truncated_record_ends_the_segment(self):
+        expected = self.write(drifting_books(10))
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 20)
+        (timestamps, books), _ = read_segment(self.path)
+        self.assertEqual(len(timestamps), 9)
+        np.testing.assert_array_equal(books, expected[:9])
+
+    def test_drifting_segment_decodes_in_bounded_memory(self):
+        expected = self.write(drifting_books(3000))
+        tracemalloc.start()
+        try:
+            (_, books), _ = read_segment(self.path)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        np.testing.assert_array_equal(books, expected)
+        # the decoded books are 3000 * 80 float32s, ~1MB; a dense decode over every price took over 1GB
+        self.assertLess(peak, 64 * 2 ** 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
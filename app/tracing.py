@@ -0,0 +1,276 @@
+# Opt-in per-cycle tracing of the live loop, exported as a Chrome trace timeline or collapsed stacks
+
+import functools
+import gzip
+import json
+import logging
+import os
+import random
+import threading
+import time as time_
+from collections import deque
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_enabled = False
+_sample_rate = 1.0
+_path = None
+_flush_every = 10
+_cycles = deque(maxlen=1000)
+_lock = threading.Lock()
+_local = threading.local()
+_finished = 0
+
+
+def _now_us():
+    # wall clock, so spans recorded in pool workers line up with the parent's
+    return int(time_.time() * 1e6)
+
+
+class Trace:
+    """Spans of one cycle, as (name, start us, duration us, depth, pid, thread, args)"""
+
+    __slots__ = ('name', 'markers', 'spans', '_stack')
+
+    def __init__(self, name, markers):
+        self.name = name
+        self.markers = dict(markers)
+        self.spans = []
+        self._stack = []
+
+    def mark(self, **markers):
+        """Attach markers to the cycle, i.e. the timestamp of the candle that triggered it"""
+        self.markers.update(markers)
+
+    def add(self, spans):
+        """Add spans recorded elsewhere, i.e. returned by a pool worker, below the current span"""
+        depth = len(self._stack)
+        for name, start, duration, span_depth, pid, tid, args in spans:
+            self.spans.append((name, start, duration, depth + span_depth, pid, tid, args))
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'args', 'start', 'depth')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.depth = len(self.trace._stack)
+        self.trace._stack.append(self.name)
+        self.start = _now_us()
+        return self
+
+    def mark(self, **args):
+        self.args.update(args)
+
+    def __exit__(self, *exc):
+        duration = _now_us() - self.start
+        self.trace._stack.pop()
+        self.trace.spans.append((self.name, self.start, duration, self.depth, os.getpid(),
+                                 threading.get_ident(), self.args))
+
+
+class _NoSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def mark(self, **markers):
+        pass
+
+    def add(self, spans):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+def configure(enabled=False, sample_rate=1.0, max_cycles=1000, path=None, flush_every=10):
+    """
+    :param sample_rate: share of cycles traced
+    :param max_cycles: traced cycles kept in memory, oldest dropped first
+    :param path: optional file the kept cycles are written to; .json(.gz) for a Chrome trace,
+        anything else for collapsed stacks
+    :param flush_every: traced cycles between writes of path
+    """
+    global _enabled, _sample_rate, _cycles, _path, _flush_every
+    _sample_rate = sample_rate
+    _cycles = deque(maxlen=max_cycles)
+    _path = path
+    _flush_every = flush_every
+    _enabled = enabled
+
+
+def current():
+    """:return: the Trace of the cycle running in this thread, or None"""
+    return getattr(_local, 'trace', None)
+
+
+class cycle:
+    """
+    Trace a cycle of the live loop, if tracing is enabled and the cycle is sampled
+
+        with tracing.cycle('cycle', exchange=exchange, symbol=market_pair) as trace:
+            ...
+    """
+
+    __slots__ = ('name', 'markers', 'trace', 'span')
+
+    def __init__(self, name, **markers):
+        self.name = name
+        self.markers = markers
+        self.trace = None
+
+    def __enter__(self):
+        if not _enabled or current() is not None or random.random() >= _sample_rate:
+            return _NO_SPAN
+        self.trace = _local.trace = Trace(self.name, self.markers)
+        self.span = _Span(self.trace, self.name, self.trace.markers)
+        self.span.__enter__()
+        return self.trace
+
+    def __exit__(self, *exc):
+        global _finished
+        if self.trace is None:
+            return
+        self.span.__exit__(*exc)
+        _local.trace = None
+        with _lock:
+            _cycles.append(self.trace)
+            _finished += 1
+            due = _path is not None and _finished % _flush_every == 0
+        if due:
+            try:
+                dump(_path)
+            except OSError:
+                logger.exception("Writing the trace to {} failed".format(_path))
+
+
+def span(name, **args):
+    """Time a block as a span of the current cycle; a no-op outside a traced cycle"""
+    trace = current() if _enabled else None
+    if trace is None:
+        return _NO_SPAN
+    return _Span(trace, name, args)
+
+
+def traced(name=None):
+    """Decorator recording each call as a span of the current cycle"""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            trace = current() if _enabled else None
+            if trace is None:
+                return func(*args, **kwargs)
+            with _Span(trace, span_name, {}):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class collect:
+    """
+    Record spans in a process without the cycle, i.e. a pool worker, to hand back to the parent
+
+        with tracing.collect(enabled) as trace:
+            ...
+        return dict(result, spans=trace.spans if trace else None)
+    """
+
+    __slots__ = ('enabled', 'trace', '_outer')
+
+    def __init__(self, enabled):
+        self.enabled = enabled
+        self.trace = None
+
+    def __enter__(self):
+        global _enabled
+        if not self.enabled:
+            return None
+        _enabled = True
+        self._outer = current()
+        self.trace = _local.trace = Trace('worker', {})
+        return self.trace
+
+    def __exit__(self, *exc):
+        if self.trace is not None:
+            _local.trace = self._outer
+
+
+def cycles():
+    with _lock:
+        return list(_cycles)
+
+
+def chrome_trace(traces=None):
+    """:return: dict in the Chrome trace event format, for chrome://tracing or ui.perfetto.dev"""
+    events = []
+    for trace in traces if traces is not None else cycles():
+        for name, start, duration, depth, pid, tid, args in trace.spans:
+            events.append({'name': name, 'ph': 'X', 'ts': start, 'dur': duration, 'pid': pid, 'tid': tid,
+                           'args': dict((k, str(v)) for k, v in args.items())})
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def collapsed_stacks(traces=None):
+    """:return: lines of 'frame;frame;frame self-time-us', the input of flamegraph.pl and speedscope"""
+    totals = {}
+    for trace in traces if traces is not None else cycles():
+        # spans are appended as they end, so sort them back into call order
+        spans = sorted(trace.spans, key=lambda s: (s[1], s[3]))
+        stack = []
+        for name, start, duration, depth, pid, tid, args in spans:
+            del stack[depth:]
+            stack.append([name, duration])
+            if depth:
+                stack[depth - 1][1] -= duration
+            # entries are updated in place as later children subtract their time
+            totals.setdefault(tuple(f[0] for f in stack), []).append(stack[-1])
+    lines = []
+    for frames, entries in totals.items():
+        self_time = sum(max(entry[1], 0) for entry in entries)
+        lines.append('{} {}'.format(';'.join(frames), self_time))
+    return lines
+
+
+def dump(path):
+    """Write the kept cycles to path, atomically; see configure"""
+    tmp = path + '.tmp'
+    if path.endswith('.json.gz'):
+        with gzip.open(tmp, 'wt') as f:
+            json.dump(chrome_trace(), f, separators=(',', ':'))
+    elif path.endswith('.json'):
+        with open(tmp, 'w') as f:
+            json.dump(chrome_trace(), f, separators=(',', ':'))
+    else:
+        with open(tmp, 'w') as f:
+            f.write('\n'.join(collapsed_stacks()) + '\n')
+    os.replace(tmp, path)
+
+
+def start_tracing(config=None, instance=None):
+    """
+    :param config: the tracing section of config.yml
+    :param instance: optional number of this process among several, suffixes the file
+    :return: True if tracing is enabled
+    """
+    config = config or {}
+    if not config.get('enabled', False):
+        return False
+    path = config.get('path')
+    if path:
+        path = metrics.instance_path(path, instance)
+    configure(True, config.get('sample_rate', 1.0), config.get('max_cycles', 1000), path,
+              config.get('flush_every', 10))
+    return True
@@ -0,0 +1,115 @@
+# Per-market index of the account's trades by order ID, filled incrementally from the exchange
+
+import logging
+from threading import Lock
+
+from sqlalchemy import select, and_
+
+from market import database
+
+logger = logging.getLogger(__name__)
+
+
+def trade_record(exchange, symbol, trade):
+    """
+    :param trade: ccxt trade structure
+    :return: dict ready to insert into the TradeBook table
+    """
+    fee = trade.get('fee')
+    return {'tradeID': str(trade['id']),
+            'timestamp': trade['timestamp'],
+            'datetime': trade['datetime'],
+            'orderID': str(trade['order']),
+            'exchange': exchange,
+            'symbol': symbol,
+            'side': trade.get('side'),
+            'amount': trade['amount'],
+            'price': trade['price'],
+            'cost': trade['cost'],
+            'fee': fee.get('cost') if isinstance(fee, dict) else fee}
+
+
+class _Market:
+    __slots__ = ('since', 'seen', 'by_order')
+
+    def __init__(self):
+        self.since = None    # timestamp of the latest trade indexed
+        self.seen = set()    # trade IDs at that timestamp, since= is inclusive on most exchanges
+        self.by_order = {}   # orderID -> list of TradeBook records
+
+
+class TradeIndex:
+    """
+    The account's trades per (exchange, symbol), indexed by order ID
+
+    A market is loaded from TradeBook the first time it is used and from then on only the
+    trades after the latest one indexed are fetched, so finding the fills of an order is a
+    dict lookup after a small delta fetch instead of a scan of the whole trade history.
+    New trades are written to TradeBook unless the caller persists them itself.
+    """
+
+    def __init__(self):
+        self._markets = {}
+        self._lock = Lock()
+        self.conn = database.engine.connect()
+
+    def _market(self, exchange, symbol):
+        key = (exchange, symbol)
+        if key not in self._markets:
+            market = _Market()
+            s = select([database.TradeBook]).where(and_(database.TradeBook.c.exchange == exchange,
+                                                        database.TradeBook.c.symbol == symbol)) \
+                .order_by(database.TradeBook.c.timestamp)
+            with database.lock:
+                rows = self.conn.execute(s).fetchall()
+            for row in rows:
+                self._add(market, dict(row))
+            self._markets[key] = market
+        return self._markets[key]
+
+    @staticmethod
+    def _add(market, record):
+        if market.since is None or record['timestamp'] > market.since:
+            market.since = record['timestamp']
+            market.seen = set()
+        market.seen.add(record['tradeID'])
+        market.by_order.setdefault(record['orderID'], []).append(record)
+
+    def update(self, client, exchange, symbol, persist=True):
+        """
+        Fetch and index the trades of a market made since the latest one indexed
+
+        :param client: ccxt exchange
+        :param persist: write the new trades to TradeBook
+        :return: list of the new TradeBook records, ascending
+        """
+        with self._lock:
+            market = self._market(exchange, symbol)
+            since = market.since
+        trades = client.fetch_my_trades(symbol, since=since)
+
+        new = []
+        with self._lock:
+            for trade in sorted(trades, key=lambda t: t['timestamp']):
+                if market.since is not None and (trade['timestamp'] < market.since or
+                                                 (trade['timestamp'] == market.since and str(trade['id']) in market.seen)):
+                    continue
+                record = trade_record(exchange, symbol, trade)
+                self._add(market, record)
+                new.append(record)
+        if persist and new:
+            with database.lock:
+                self.conn.execute(database.TradeBook.insert().prefix_with('OR IGNORE'), new)
+        return new
+
+    def trades(self, exchange, symbol, orderID):
+        """:return: indexed TradeBook records of an order, without fetching"""
+        with self._lock:
+            return list(self._market(exchange, symbol).by_order.get(str(orderID), []))
+
+    def lookup(self, client, exchange, symbol, orderID):
+        """
+        :return: TradeBook records of an order, after fetching the market's new trades
+        """
+        self.update(client, exchange, symbol)
+        return self.trades(exchange, symbol, orderID)
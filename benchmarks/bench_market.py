@@ -0,0 +1,79 @@
+# Market data: paginated backfill, inserts into the OHLCV table and reads of the latest candles
+
+import contextlib
+import io
+import itertools
+
+from common import benchmark, use_temp_database, synthetic_candles, fake_interface
+
+
+@benchmark('market.get_historical_data', repeat=5, items=2000)
+def get_historical_data():
+    # 2000 1m candles in pages of 100, no rate limit
+    exchangeInterface = fake_interface(ohlcv_limit=100)
+
+    def run():
+        # get_historical_data prints every page
+        with contextlib.redirect_stdout(io.StringIO()):
+            exchangeInterface.get_historical_data('fake', 'BTC/USD', '1m', max_periods=2000)
+    return run
+
+
+@benchmark('datafeed.insert_backfill', repeat=5, items=10000)
+def insert_backfill():
+    # the ticker's backfill: one executemany of the fetched candles
+    database = use_temp_database()
+    offsets = itertools.count()
+
+    def run():
+        # a new market each run, so the primary keys never collide
+        candles = synthetic_candles(10000, symbol='BF{}/USD'.format(next(offsets)))
+        with database.lock:
+            database.connection().execute(database.OHLCV.insert(), candles.to_records())
+    return run
+
+
+@benchmark('datafeed.insert_ticks', repeat=5, items=1000)
+def insert_ticks():
+    # the ticker's live loop: one insert per tick
+    database = use_temp_database()
+    offsets = itertools.count()
+
+    def run():
+        records = synthetic_candles(1000, symbol='TK{}/USD'.format(next(offsets))).to_records()
+        for record in records:
+            with database.lock:
+                database.connection().execute(database.OHLCV.insert().values(**record))
+    return run
+
+
+def _stored_market(symbol, periods=10000):
+    database = use_temp_database()
+    from market import datafeed
+    candles = synthetic_candles(periods, symbol=symbol)
+    with database.lock:
+        database.connection().execute(database.OHLCV.insert(), candles.to_records())
+    return datafeed, candles
+
+
+@benchmark('datafeed.get_latest_data_from_db', repeat=5, number=100)
+def get_latest_data_from_db():
+    # nothing cached: the indexed query for the latest 300 candles
+    datafeed, _ = _stored_market('DB/USD')
+
+    def run():
+        datafeed.candle_cache.clear()
+        datafeed.get_latest_data_from_db('fake', 'DB/USD', '1m', periods=300)
+    return run
+
+
+@benchmark('datafeed.get_latest_data_from_cache', repeat=5, number=1000)
+def get_latest_data_from_cache():
+    # a ticker running in the process answers from memory
+    datafeed, candles = _stored_market('MEM/USD')
+
+    def run():
+        if not datafeed.candle_cache.is_warm('fake', 'MEM/USD', '1m'):
+            datafeed.candle_cache.extend('fake', 'MEM/USD', '1m', candles)
+        datafeed.get_latest_data_from_db('fake', 'MEM/USD', '1m', periods=300)
+    return run
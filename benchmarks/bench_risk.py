@@ -0,0 +1,42 @@
+# Risk checks of a live cycle: position control over open positions and order sizing from the book
+
+import random
+
+from common import benchmark, synthetic_candles
+
+SYMBOLS = ['S{}/USD'.format(i) for i in range(10)]
+
+
+@benchmark('position_control.control', repeat=5, number=100, items=100)
+def position_control():
+    # 100 positions over 10 markets, checked against each market's latest candle
+    import pandas as pd
+    from logics.risk_management.position_control import Position_Control
+    rng = random.Random(0)
+    candles = [synthetic_candles(10, symbol=symbol) for symbol in SYMBOLS]
+    positions = pd.DataFrame([{'exchange': 'fake', 'symbol': SYMBOLS[i % len(SYMBOLS)],
+                               'position': 'long' if i % 3 else 'short', 'amount': rng.uniform(0.1, 2),
+                               'price': candles[i % len(SYMBOLS)].last()['close'] * rng.uniform(0.7, 1.3)}
+                              for i in range(100)])
+
+    def run():
+        Position_Control(positions, candles, 0.2, 0.2).control()
+    return run
+
+
+@benchmark('order_control.simple_control', repeat=5, number=1000)
+def order_control():
+    # sizing a buy into an existing position from a 20 level book
+    import pandas as pd
+    from logics.risk_management.order_control import Order_Control
+    rng = random.Random(0)
+    mid = synthetic_candles(1).last()['close']
+    order_book = dict((side, pd.DataFrame({'price': [mid * (1 + sign * 0.0001 * (i + 1)) for i in range(20)],
+                                           'volume': [rng.uniform(0.01, 2) for _ in range(20)]}))
+                      for side, sign in (('bids', -1), ('asks', 1)))
+    position = pd.DataFrame([{'exchange': 'fake', 'symbol': 'BTC/USD', 'position': 'long', 'amount': 0.5,
+                              'price': 9500.0, 'cost': 4750.0}])
+
+    def run():
+        Order_Control('fake', 'BTC/USD', 10000.0, 'long', position, order_book).simple_control()
+    return run
@@ -0,0 +1,70 @@
+# Strategies: zipline backtests, the parameter search and live refits
+
+import contextlib
+import io
+
+from common import benchmark, synthetic_candles
+
+EMA_PARAMS = {'trailing_window': 30, 'ema_s': 5, 'ema_l': 20, 'bb': 20}
+
+
+@benchmark('backtest_optim.run_algorithm.minute', repeat=3)
+def run_algorithm_minute():
+    # three days of 1m bars traded on 5m candles
+    from logics.strategies.backtest_optim import Backtest_Optim
+    strategy = Backtest_Optim(synthetic_candles(3 * 1440), frequency='minute', interval='5m')
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            strategy.run_algorithm(EMA_PARAMS)
+    return run
+
+
+@benchmark('backtest_optim.run_algorithm.daily', repeat=3)
+def run_algorithm_daily():
+    # two years of daily bars
+    from logics.strategies.backtest_optim import Backtest_Optim
+    strategy = Backtest_Optim(synthetic_candles(730, interval='1d'), frequency='daily')
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            strategy.run_algorithm(EMA_PARAMS)
+    return run
+
+
+@benchmark('backtest_optim.optim_algo', repeat=1, items=4)
+def optim_algo():
+    # a 2x2 grid, one backtest per point
+    from logics.strategies.backtest_optim import Backtest_Optim
+    strategy = Backtest_Optim(synthetic_candles(365, interval='1d'), frequency='daily')
+    grid = {'trailing_window': [30], 'ema_s': [5, 10], 'ema_l': [20, 25], 'bb': [20]}
+
+    def run():
+        with contextlib.redirect_stdout(io.StringIO()):
+            strategy.optim_algo(grid)
+    return run
+
+
+@benchmark('cdl_test.refit', repeat=5, number=1000)
+def cdl_test_refit():
+    # one live signal from the latest 15 candles, as start_strategy_ asks for it
+    import talib
+    from logics.strategies.cdl_test import CDL_Test
+    candles = synthetic_candles(16)
+    params = {'trailing_window': 15, 'indicator': talib.CDLHARAMI}
+    strategy = CDL_Test()
+
+    def run():
+        strategy.refit(ohlcv=candles, params=params)
+    return run
+
+
+@benchmark('backtest_optim.refit', repeat=5, number=1000)
+def backtest_optim_refit():
+    from logics.strategies.backtest_optim import Backtest_Optim
+    candles = synthetic_candles(31)
+    strategy = Backtest_Optim()
+
+    def run():
+        strategy.refit(ohlcv=candles, params=EMA_PARAMS)
+    return run
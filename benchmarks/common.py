@@ -0,0 +1,86 @@
+# Shared setup of the benchmarks: the app on sys.path, a throwaway database, synthetic data and the registry
+
+import os
+import statistics
+import sys
+import tempfile
+import time as time_
+from collections import OrderedDict
+
+APP = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'app')
+if APP not in sys.path:
+    sys.path.insert(0, APP)
+
+# 2020-01-01 UTC; synthetic data starts here so every run sees the same candles
+EPOCH = 1577836800000
+
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, repeat=5, number=1, items=None):
+    """
+    Register a benchmark
+
+    The decorated function prepares its data, untimed, and returns the callable to time.
+
+    :param repeat: timed runs; the statistics are over these
+    :param number: calls per run, for calls too quick to time one by one
+    :param items: optional units of work per call, i.e. rows inserted, reported per second
+    """
+    def decorator(factory):
+        BENCHMARKS[name] = dict(factory=factory, repeat=repeat, number=number, items=items)
+        return factory
+    return decorator
+
+
+def measure(func, repeat=5, number=1, items=None):
+    """:return: dict of seconds per call (min, median, mean, stdev) over repeat runs of number calls"""
+    times = []
+    for _ in range(repeat):
+        start = time_.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time_.perf_counter() - start) / number)
+    result = {'repeat': repeat, 'number': number,
+              'min': min(times), 'median': statistics.median(times), 'mean': statistics.mean(times),
+              'stdev': statistics.stdev(times) if len(times) > 1 else 0.0}
+    if items:
+        result['items'] = items
+        result['items_per_second'] = items / result['median']
+    return result
+
+
+_database_dir = None
+
+
+def use_temp_database():
+    """Point market.database at an empty database in a temporary directory, once per process"""
+    global _database_dir
+    from market import database
+    import sqlalchemy as db
+    if _database_dir is None:
+        _database_dir = tempfile.mkdtemp(prefix='yigebot-bench-')
+        database.engine = db.create_engine('sqlite:///{}'.format(os.path.join(_database_dir, 'bench.db')),
+                                           connect_args={'check_same_thread': False}, echo=False)
+        database._conn = None
+        database.create_tables()
+    return database
+
+
+def synthetic_candles(periods, interval='1m', symbol='BTC/USD', exchange='fake', start=EPOCH, seed=0):
+    """:return: Candles of a deterministic random walk, with a bid and ask around each close"""
+    from fake_exchange import synthetic_ohlcv, symbol_seed
+    from market.candles import Candles
+    rows = synthetic_ohlcv(start, periods, interval, symbol_seed(symbol, seed))
+    rows = [row + [row[4] * 0.9999, row[4] * 1.0001] for row in rows]
+    return Candles.from_ohlcv(rows, exchange=exchange, symbol=symbol, interval=interval)
+
+
+def fake_interface(**fake_exchange_kwargs):
+    """:return: ExchangeInterface trading only a FakeExchange, on the temporary database"""
+    use_temp_database()
+    from exchange import ExchangeInterface
+    from fake_exchange import FakeExchange
+    exchangeInterface = ExchangeInterface({})
+    exchangeInterface.add_exchange(FakeExchange(**fake_exchange_kwargs))
+    return exchangeInterface
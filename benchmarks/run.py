@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Run the benchmarks offline and save the results as JSON
+
+    python benchmarks/run.py [-k substring] [-o results.json] [--compare baseline.json]
+
+Everything runs against fake_exchange.FakeExchange, synthetic candles and a temporary
+database, so results only depend on the code and the machine. Results are written to
+benchmarks/results/<commit>.json by default; --compare prints each benchmark's median
+against an earlier file.
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time as time_
+
+from common import BENCHMARKS, measure
+
+import bench_market  # noqa: F401, registers the benchmarks
+import bench_strategies  # noqa: F401
+import bench_risk  # noqa: F401
+
+ROOT = os.path.dirname(os.path.realpath(__file__))
+
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                                       stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run(selected):
+    results = {}
+    for name in selected:
+        spec = BENCHMARKS[name]
+        try:
+            func = spec['factory']()
+            results[name] = measure(func, spec['repeat'], spec['number'], spec['items'])
+            print('{:45s} {:12.6f}s median {:12.6f}s min'.format(name, results[name]['median'], results[name]['min']))
+        except Exception as e:
+            # i.e. zipline missing from a live-only install; the other benchmarks still count
+            results[name] = {'error': '{}: {}'.format(type(e).__name__, e)}
+            print('{:45s} failed: {}'.format(name, results[name]['error']))
+    return results
+
+
+def compare(results, baseline):
+    print('\n{:45s} {:>12s} {:>12s} {:>8s}'.format('benchmark', 'baseline', 'current', 'ratio'))
+    for name, result in results.items():
+        old = baseline['results'].get(name, {})
+        if 'median' not in result or 'median' not in old:
+            continue
+        print('{:45s} {:12.6f} {:12.6f} {:8.2f}'.format(name, old['median'], result['median'],
+                                                       result['median'] / old['median']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('-k', dest='keyword', help='only run benchmarks whose name contains this')
+    parser.add_argument('-o', dest='output', help='JSON file to write, benchmarks/results/<commit>.json by default')
+    parser.add_argument('--compare', help='earlier results to compare against')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    selected = [name for name in BENCHMARKS if not args.keyword or args.keyword in name]
+    commit = _commit()
+    report = {'commit': commit,
+              'timestamp': int(time_.time()),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'processor': platform.processor(),
+              'results': run(selected)}
+
+    output = args.output or os.path.join(ROOT, 'results', '{}.json'.format(commit))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('\nSaved {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(report['results'], json.load(f))
+    sys.exit(1 if any('error' in result for result in report['results'].values()) else 0)
+
+
+if __name__ == "__main__":
+    main()